@@ -1,7 +1,9 @@
 """Main application entry point for KileKitabu backend."""
 import os
+import traceback
 import firebase_admin
 from firebase_admin import credentials
+from core import auth_warmup
 from core.app_factory import create_app
 from core.logging_config import init_logging
 from config import Config
@@ -27,7 +29,7 @@ from routes.googlepay import bp as googlepay_bp
 from routes.unified_checkout import bp as unified_checkout_bp
 
 # Initialize logging
-init_logging()
+init_logging(Config.LOG_LEVEL)
 
 # Create Flask app
 app = create_app(Config)
@@ -101,12 +103,20 @@ class MockFirebaseReference:
         if self.path in self.data_store:
             self.data_store[self.path].update(value)
         return self
+    
+    def transaction(self, transaction_update):
+        new_value = transaction_update(self.get())
+        self.data_store[self.path] = new_value
+        return new_value
 
 
 # Fallback to mock service when Firebase DB is unavailable
 if db is None:
     db = MockFirebaseService()
     print("Using mock Firebase service")
+else:
+    # Prefetch ID token certs so the first authenticated request does not pay for it
+    auth_warmup.start()
 
 # Initialize M-Pesa Client
 mpesa_client = None
@@ -148,7 +158,6 @@ try:
         print(f"❌ M-Pesa not configured; missing: {', '.join(missing)}")
 except Exception as e:
     print(f"❌ M-Pesa initialization error: {e}")
-    import traceback
     print(f"Traceback: {traceback.format_exc()}")
 
 cybersource_client = None
@@ -192,7 +201,6 @@ try:
         print(f"❌ CyberSource not configured; missing: {', '.join(missing)}")
 except Exception as e:
     print(f"❌ CyberSource initialization error: {e}")
-    import traceback
     print(f"Traceback: {traceback.format_exc()}")
 
 # Initialize CyberSource helper microservice client (Node.js backend)
@@ -305,4 +313,12 @@ def health_check():
 
 
 if __name__ == '__main__':
-    app.run(debug=Config.DEBUG, host='0.0.0.0', port=5000)
+    # Reloader disabled: it re-imports this module and would start every
+    # scheduler twice
+    app.run(
+        debug=Config.DEBUG,
+        host='0.0.0.0',
+        port=int(os.environ.get('PORT', '5000')),
+        threaded=True,
+        use_reloader=False,
+    )
@@ -1,105 +1,139 @@
 """Configuration settings for KileKitabu backend."""
 import os
+import re
+from types import MappingProxyType
 from dotenv import load_dotenv
 
-load_dotenv()
+# Load .env only when present and not already loaded into this process tree
+# (Render and similar hosts inject settings directly and ship no .env file).
+# An explicit path also skips find_dotenv()'s directory walk.
+_DOTENV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
+if not os.environ.get('ENV_LOADED') and os.path.exists(_DOTENV_PATH):
+    load_dotenv(_DOTENV_PATH)
+    os.environ['ENV_LOADED'] = '1'
 
+# Single reference to the process environment for the class body below
+_env = os.environ
 
-class Config:
-    """Application configuration."""
+
+# Read-only lookup tables shared by Config and its callers
+_VALIDATION_RULES = MappingProxyType({
+    'min_amount': 10.0,
+    'max_amount': 1000000.0,
+    # Precompiled once at import; use .match(value) directly
+    'phone_regex': re.compile(r'^\+?254\d{9}$'),
+    'email_regex': re.compile(r'^[\w\.-]+@[\w\.-]+\.\w+$'),
+})
+
+_PAYMENT_STATUS = MappingProxyType({
+    'PENDING': 'PENDING',
+    'COMPLETED': 'COMPLETED',
+    'FAILED': 'FAILED',
+    'CANCELLED': 'CANCELLED',
+})
+
+
+class _FrozenConfig(type):
+    """Metaclass that makes configuration class attributes read-only."""
+    
+    def __setattr__(cls, name, value):
+        raise AttributeError(f"{cls.__name__}.{name} is read-only")
+    
+    def __delattr__(cls, name):
+        raise AttributeError(f"{cls.__name__}.{name} is read-only")
+
+
+class Config(metaclass=_FrozenConfig):
+    """Application configuration (values are fixed at import time)."""
     
     # Firebase Configuration
-    FIREBASE_CREDENTIALS_PATH = os.getenv(
+    FIREBASE_CREDENTIALS_PATH = _env.get(
         'FIREBASE_CREDENTIALS_PATH',
         'kile-kitabu-firebase-adminsdk-pjk21-68cbd0c3b4.json'
     )
-    FIREBASE_DATABASE_URL = os.getenv(
+    FIREBASE_DATABASE_URL = _env.get(
         'FIREBASE_DATABASE_URL',
         'https://kile-kitabu-default-rtdb.firebaseio.com'
     )
     
     # Application Configuration
-    DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
-    BASE_URL = os.getenv('BASE_URL', 'https://kilekitabu-backend.onrender.com')
-    SECRET_KEY = os.getenv('SECRET_KEY', 'your-secret-key-here')
-    CRON_SECRET_KEY = os.getenv('CRON_SECRET_KEY', SECRET_KEY)  # Defaults to SECRET_KEY if not set
-    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    DEBUG = _env.get('DEBUG', 'False').lower() == 'true'
+    BASE_URL = _env.get('BASE_URL', 'https://kilekitabu-backend.onrender.com')
+    SECRET_KEY = _env.get('SECRET_KEY', 'your-secret-key-here')
+    CRON_SECRET_KEY = _env.get('CRON_SECRET_KEY', SECRET_KEY)  # Defaults to SECRET_KEY if not set
+    LOG_LEVEL = _env.get('LOG_LEVEL', 'INFO')
+    
+    # Firebase ID token verification
+    AUTH_CACHE_TTL = int(_env.get('AUTH_CACHE_TTL', '300'))  # Seconds a verified token is reused without re-verifying
+    # Leeway for iat/exp against a skewed client clock; the SDK accepts 0-60
+    AUTH_CLOCK_SKEW_SECONDS = min(60, max(0, int(_env.get('AUTH_CLOCK_SKEW_SECONDS', '60'))))
     
     # Test flags
-    ALLOW_UNAUTH_TEST = os.getenv('ALLOW_UNAUTH_TEST', 'False').lower() == 'true'
-    FORCE_TRIAL_END = os.getenv('FORCE_TRIAL_END', 'False').lower() == 'true'
+    ALLOW_UNAUTH_TEST = _env.get('ALLOW_UNAUTH_TEST', 'False').lower() == 'true'
+    FORCE_TRIAL_END = _env.get('FORCE_TRIAL_END', 'False').lower() == 'true'
     
     # Google Pay (structure)
-    GOOGLE_PAY_ENABLED = os.getenv('GOOGLE_PAY_ENABLED', 'True').lower() == 'true'
-    GOOGLE_PAY_MIN_AMOUNT = float(os.getenv('GOOGLE_PAY_MIN_AMOUNT', '1.0'))
-    GOOGLE_PAY_PROCESSOR = os.getenv('GOOGLE_PAY_PROCESSOR', 'cybersource')  # Default to 'cybersource'
-    GOOGLE_PAY_CURRENCY = os.getenv('GOOGLE_PAY_CURRENCY', 'USD')
+    GOOGLE_PAY_ENABLED = _env.get('GOOGLE_PAY_ENABLED', 'True').lower() == 'true'
+    GOOGLE_PAY_MIN_AMOUNT = float(_env.get('GOOGLE_PAY_MIN_AMOUNT', '1.0'))
+    GOOGLE_PAY_PROCESSOR = _env.get('GOOGLE_PAY_PROCESSOR', 'cybersource')  # Default to 'cybersource'
+    GOOGLE_PAY_CURRENCY = _env.get('GOOGLE_PAY_CURRENCY', 'USD')
     
     # User Reset Configuration
     # Automatic reset behavior:
     # - Users without registration_date will automatically get a fresh 14-day trial on login
     # - If RESET_USERS_ON_LOGIN=True, ALL users (including those with registration_date) will get reset on login
     # - This ensures all users (existing and new) get a fresh trial period
-    TRIAL_RESET_DATE = os.getenv('TRIAL_RESET_DATE', '')  # e.g., '2024-01-15' or empty to disable (legacy)
-    RESET_USERS_ON_LOGIN = os.getenv('RESET_USERS_ON_LOGIN', 'True').lower() == 'true'  # Enable automatic reset on login (default: True)
+    TRIAL_RESET_DATE = _env.get('TRIAL_RESET_DATE', '')  # e.g., '2024-01-15' or empty to disable (legacy)
+    RESET_USERS_ON_LOGIN = _env.get('RESET_USERS_ON_LOGIN', 'True').lower() == 'true'  # Enable automatic reset on login (default: True)
     
     # Subscription Configuration
-    DAILY_RATE = float(os.getenv('DAILY_RATE', '5.0'))  # Cost per day in KES
-    FREE_TRIAL_DAYS = int(os.getenv('FREE_TRIAL_DAYS', '14'))  # Free trial period in days
-    MONTHLY_CAP_KES = float(os.getenv('MONTHLY_CAP_KES', '150'))  # Monthly cap in KES
-    MAX_PREPAY_MONTHS = int(os.getenv('MAX_PREPAY_MONTHS', '12'))  # Allow paying up to N months in advance (max 12 months)
-    USD_TO_KES_RATE = float(os.getenv('USD_TO_KES_RATE', '130.0'))  # Exchange rate: 1 USD = X KES
+    DAILY_RATE = float(_env.get('DAILY_RATE', '5.0'))  # Cost per day in KES
+    FREE_TRIAL_DAYS = int(_env.get('FREE_TRIAL_DAYS', '14'))  # Free trial period in days
+    MONTHLY_CAP_KES = float(_env.get('MONTHLY_CAP_KES', '150'))  # Monthly cap in KES
+    MAX_PREPAY_MONTHS = int(_env.get('MAX_PREPAY_MONTHS', '12'))  # Allow paying up to N months in advance (max 12 months)
+    USD_TO_KES_RATE = float(_env.get('USD_TO_KES_RATE', '130.0'))  # Exchange rate: 1 USD = X KES
     
     # M-Pesa Daraja Configuration
-    # HARDCODED FOR PRODUCTION
-    MPESA_ENV = 'production'  # Hardcoded to production
-    MPESA_CONSUMER_KEY = 'rs7K6PTbaAzDFIcmkK0Rcg8u6GphrzUTAwfpuyd4DeSv43Og'  # Production Consumer Key
-    MPESA_CONSUMER_SECRET = 'xshsALdAGkdfwjxALLBZCI7udGWB8dDSAubXs6tbbbUABvxqwfPuXml0hb7cbUYV'  # Production Consumer Secret
-    MPESA_SHORT_CODE = '3576603'  # Production BusinessShortCode (Go Live shortcode)
-    MPESA_TILL_NUMBER = '5695092'  # Production Till Number (PartyB)
-    MPESA_PASSKEY = 'bcfeb194a2df8ca55f17c2816a55234c837516ce016dcade10621ce0ffc9e84d'  # Production passkey
+    # Credentials come from the environment (.env locally, service env vars on Render)
+    MPESA_ENV = _env.get('MPESA_ENV', 'production')  # sandbox | production
+    MPESA_CONSUMER_KEY = _env.get('MPESA_CONSUMER_KEY', '')
+    MPESA_CONSUMER_SECRET = _env.get('MPESA_CONSUMER_SECRET', '')
+    MPESA_SHORT_CODE = _env.get('MPESA_SHORT_CODE', '3576603')  # BusinessShortCode (Go Live shortcode)
+    MPESA_TILL_NUMBER = _env.get('MPESA_TILL_NUMBER', '5695092')  # Till Number (PartyB)
+    MPESA_PASSKEY = _env.get('MPESA_PASSKEY', '')
     MPESA_CALLBACK_URL = f"{BASE_URL}/api/mpesa/callback"
     
     # CyberSource Configuration
-    CYBERSOURCE_ENV = os.getenv('CYBERSOURCE_ENV', 'sandbox')  # sandbox | production
-    CYBERSOURCE_MERCHANT_ID = os.getenv('CYBERSOURCE_MERCHANT_ID', '')
-    CYBERSOURCE_API_KEY_ID = os.getenv('CYBERSOURCE_API_KEY_ID', '')
-    CYBERSOURCE_SECRET_KEY = os.getenv('CYBERSOURCE_SECRET_KEY', '')
-    CYBERSOURCE_WEBHOOK_SECRET = os.getenv('CYBERSOURCE_WEBHOOK_SECRET', '')  # For signature validation
+    CYBERSOURCE_ENV = _env.get('CYBERSOURCE_ENV', 'sandbox')  # sandbox | production
+    CYBERSOURCE_IS_SANDBOX = CYBERSOURCE_ENV == 'sandbox'
+    CYBERSOURCE_MERCHANT_ID = _env.get('CYBERSOURCE_MERCHANT_ID', '')
+    CYBERSOURCE_API_KEY_ID = _env.get('CYBERSOURCE_API_KEY_ID', '')
+    CYBERSOURCE_SECRET_KEY = _env.get('CYBERSOURCE_SECRET_KEY', '')
+    CYBERSOURCE_WEBHOOK_SECRET = _env.get('CYBERSOURCE_WEBHOOK_SECRET', '')  # For signature validation
+    CYBERSOURCE_PREVIEW = _env.get('CYBERSOURCE_PREVIEW') == '1'  # Echo the would-be capture context payload
     
     # CyberSource API URLs
     CYBERSOURCE_API_BASE = (
-        'https://apitest.cybersource.com' if CYBERSOURCE_ENV == 'sandbox' 
+        'https://apitest.cybersource.com' if CYBERSOURCE_IS_SANDBOX
         else 'https://api.cybersource.com'
     )
     # Flex Sessions API base (for card tokenization capture-context)
     CYBERSOURCE_FLEX_API_BASE = (
-        'https://testflex.cybersource.com' if CYBERSOURCE_ENV == 'sandbox'
+        'https://testflex.cybersource.com' if CYBERSOURCE_IS_SANDBOX
         else 'https://flex.cybersource.com'
     )
-    CYBERSOURCE_CALLBACK_URL = os.getenv(
-        'CYBERSOURCE_CALLBACK_URL',
-        f"{BASE_URL}/api/cybersource/webhook"
+    # Only build the default when the env var is unset (or empty)
+    CYBERSOURCE_CALLBACK_URL = (
+        _env.get('CYBERSOURCE_CALLBACK_URL')
+        or f"{BASE_URL}/api/cybersource/webhook"
     )
     # Optional Node.js helper service for CyberSource (cards + Google Pay)
     # Defaults to production URL
     # Override with CYBERSOURCE_HELPER_BASE_URL environment variable for local testing
-    CYBERSOURCE_HELPER_BASE_URL = os.getenv(
+    CYBERSOURCE_HELPER_BASE_URL = _env.get(
         'CYBERSOURCE_HELPER_BASE_URL',
         'https://card-payment-hso8.onrender.com'  # Default to production helper service
     )
-    # Validation Rules
-    VALIDATION_RULES = {
-        'min_amount': 10.0,
-        'max_amount': 1000000.0,
-        'phone_regex': r'^\+?254\d{9}$',
-        'email_regex': r'^[\w\.-]+@[\w\.-]+\.\w+$',
-    }
-    
-    # Payment Status Codes
-    PAYMENT_STATUS = {
-        'PENDING': 'PENDING',
-        'COMPLETED': 'COMPLETED',
-        'FAILED': 'FAILED',
-        'CANCELLED': 'CANCELLED',
-    }
+    # Validation Rules / Payment Status Codes (read-only, see module constants)
+    VALIDATION_RULES = _VALIDATION_RULES
+    PAYMENT_STATUS = _PAYMENT_STATUS
@@ -1,47 +1,109 @@
 """Cybersource Unified Checkout - Capture Context scaffolding."""
+import logging
+import math
+from decimal import Decimal, ROUND_HALF_UP
+from types import MappingProxyType
+
 from flask import request, jsonify, current_app
+
+from config import Config
 from controllers.subscription_controller import require_auth
 
+logger = logging.getLogger(__name__)
+
+# Shared read-only default for missing nested request objects
+_EMPTY = MappingProxyType({})
+
+_TWOPLACES = Decimal("0.01")
+
+# Echo the would-be Cybersource payload in the 501 response (always on in debug)
+_PREVIEW_MODE = Config.CYBERSOURCE_PREVIEW
+
+# Capture context requests are a few hundred bytes; refuse anything larger
+# before parsing it
+_MAX_BODY_BYTES = 8192
+
+# Static payload defaults, shared across requests and never mutated.
+# Tuples serialize as JSON arrays; captureMandate stays a plain dict
+# because JSON encoders do not accept MappingProxyType.
+_DEFAULT_CLIENT_VERSION = "0.31"
+_DEFAULT_COUNTRY = "US"
+_DEFAULT_LOCALE = "en_US"
+_DEFAULT_CARD_NETWORKS = ("VISA", "MASTERCARD", "AMEX")
+_DEFAULT_PAYMENT_TYPES = ("GOOGLEPAY", "PANENTRY", "CLICKTOPAY")
+_DEFAULT_CAPTURE_MANDATE = {
+    "billingType": "FULL",
+    "requestEmail": True,
+    "requestPhone": True,
+    "requestShipping": False,
+    "showAcceptedNetworkIcons": True
+}
+
+
+def _format_amount(amount: float) -> str:
+    """Format a currency amount with half-up rounding to cents.
+
+    Goes through str() so the decimal the client sent is rounded, not its
+    binary float approximation (f"{2.675:.2f}" gives '2.67').
+    """
+    return str(Decimal(str(amount)).quantize(_TWOPLACES, rounding=ROUND_HALF_UP))
+
 
 @require_auth
 def generate_capture_context():
     """
     Scaffold endpoint to generate Unified Checkout Capture Context.
-    Does not call Cybersource yet; validates input and returns 501 with the payload that would be sent.
+    Does not call Cybersource yet; validates input and returns 501, including the
+    payload that would be sent when running in debug or CYBERSOURCE_PREVIEW=1.
     """
     try:
-        cfg = current_app.config.get('CONFIG')
-        cybersource_client = current_app.config.get('cybersource_client')
+        app_config = current_app.config
+        cfg = app_config.get('CONFIG')
+        cybersource_client = app_config.get('cybersource_client')
+        min_amt = getattr(cfg, 'GOOGLE_PAY_MIN_AMOUNT', 1.0)
+        default_currency = getattr(cfg, 'GOOGLE_PAY_CURRENCY', 'USD')
 
         if not cybersource_client:
             return jsonify({'error': 'Cybersource client not configured'}), 503
 
-        body = request.get_json(force=True) or {}
-        amount = float((body.get('orderInformation') or {}).get('amountDetails', {}).get('totalAmount') or 0)
-        currency = (body.get('orderInformation') or {}).get('amountDetails', {}).get('currency') or getattr(cfg, 'GOOGLE_PAY_CURRENCY', 'USD')
+        if request.content_length and request.content_length > _MAX_BODY_BYTES:
+            return jsonify({'error': 'Payload too large'}), 413
+
+        body = request.get_json(force=True, silent=True) or _EMPTY
+        order_info = body.get('orderInformation') or _EMPTY
+        amt_details = order_info.get('amountDetails') or _EMPTY
+        raw_amount = amt_details.get('totalAmount')
+        try:
+            amount = float(raw_amount) if raw_amount else 0.0
+        except (TypeError, ValueError):
+            amount = math.nan
+        # float() accepts "nan" and "inf", which no check below would catch
+        if not math.isfinite(amount):
+            return jsonify({'error': 'Invalid amount format'}), 400
+        currency = amt_details.get('currency') or default_currency
 
         # Enforce $1.00 min for digital wallets like Google Pay
-        if amount < getattr(cfg, 'GOOGLE_PAY_MIN_AMOUNT', 1.0):
-            return jsonify({'error': f"Minimum amount is {currency} {getattr(cfg, 'GOOGLE_PAY_MIN_AMOUNT', 1.0):.2f}"}), 400
+        if amount < min_amt:
+            return jsonify({'error': f"Minimum amount is {currency} {min_amt:.2f}"}), 400
+
+        if not (current_app.debug or _PREVIEW_MODE):
+            return jsonify({
+                "success": False,
+                "message": "Capture Context generation not wired to Cybersource yet"
+            }), 501
 
         # Default payload scaffold based on docs, merge client-provided overrides
         payload = {
-            "clientVersion": body.get("clientVersion") or "0.31",
+            "clientVersion": body.get("clientVersion") or _DEFAULT_CLIENT_VERSION,
             "targetOrigins": body.get("targetOrigins") or [cfg.BASE_URL],
-            "allowedCardNetworks": body.get("allowedCardNetworks") or ["VISA", "MASTERCARD", "AMEX"],
-            "allowedPaymentTypes": body.get("allowedPaymentTypes") or ["GOOGLEPAY", "PANENTRY", "CLICKTOPAY"],
-            "country": body.get("country") or "US",
-            "locale": body.get("locale") or "en_US",
-            "captureMandate": body.get("captureMandate") or {
-                "billingType": "FULL",
-                "requestEmail": True,
-                "requestPhone": True,
-                "requestShipping": False,
-                "showAcceptedNetworkIcons": True
-            },
+            "allowedCardNetworks": body.get("allowedCardNetworks") or _DEFAULT_CARD_NETWORKS,
+            "allowedPaymentTypes": body.get("allowedPaymentTypes") or _DEFAULT_PAYMENT_TYPES,
+            "country": body.get("country") or _DEFAULT_COUNTRY,
+            "locale": body.get("locale") or _DEFAULT_LOCALE,
+            "captureMandate": body.get("captureMandate") or _DEFAULT_CAPTURE_MANDATE,
             "orderInformation": {
                 "amountDetails": {
-                    "totalAmount": f"{amount:.2f}",
+                    "totalAmount": _format_amount(amount),
                     "currency": currency
                 }
             }
@@ -54,9 +116,7 @@ def generate_capture_context():
             "request_preview": payload
         }), 501
     except Exception as e:
-        import traceback
-        print(f"[capture_context] ERROR: {e}")
-        traceback.print_exc()
+        logger.exception("[capture_context] ERROR: %s", e)
         return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
 
 
@@ -1,55 +1,335 @@
 """CyberSource payment controller."""
 import datetime
-import uuid
+import hashlib
+import logging
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
 from flask import request, jsonify, current_app
 from functools import wraps
+from operator import itemgetter
 from firebase_admin import auth, db
 from config import Config
 from services.exchange_rate_service import convert_amount_to_kes, compute_credit_days_from_kes
 from services.cybersource_helper_client import CyberSourceHelperError
+from core import auth_cache, background, db_refs, user_credit
+
+logger = logging.getLogger(__name__)
+
+# Webhook status/event groups (frozensets: checked on every webhook)
+_WEBHOOK_COMPLETED_STATUSES = frozenset({'AUTHORIZED', 'COMPLETED'})
+_WEBHOOK_CREDIT_STATUSES = frozenset({'AUTHORIZED', 'COMPLETED', 'SUCCESS'})
+_CAPTURE_EVENTS = frozenset({'payments.capture.status.accepted', 'payments.capture.status.updated'})
+# Card payment statuses treated as approved (with processor responseCode 100)
+_APPROVED_STATUSES = frozenset({'AUTHORIZED', 'CAPTURED', 'COMPLETED'})
+
+# Config is read-only, so bind the per-request limits once at import
+_MIN_AMOUNT = Config.VALIDATION_RULES['min_amount']
+_MAX_AMOUNT = Config.VALIDATION_RULES['max_amount']
+_DAILY_RATE = Config.DAILY_RATE or 1
+
+# Request fields both card endpoints require to be present and non-empty
+_REQUIRED_CARD_FIELDS = ('number', 'expirationMonth', 'expirationYear', 'cvv')
+_REQUIRED_BILLING_FIELDS = (
+    'firstName', 'lastName', 'email', 'phoneNumber',
+    'address1', 'locality', 'country',
+)
+# Read the fields above in one call once validation has ensured they exist
+_card_details = itemgetter(*_REQUIRED_CARD_FIELDS)
+_billing_contact = itemgetter('firstName', 'lastName', 'email', 'phoneNumber')
+
+# Request bodies are a few KB at most; refuse anything larger before reading it
+_MAX_PAYMENT_BODY_BYTES = 32 * 1024
+_MAX_WEBHOOK_BODY_BYTES = 256 * 1024
+
+# Compiled once; strips spaces, dashes etc. from card numbers
+_NON_DIGITS = re.compile(r'\D')
+
+# CyberSource response fields kept on payment records; the full response is
+# archived separately in the background
+_RESPONSE_KEEP = ('id', 'status', 'reconciliationId', 'processorInformation', 'errorInformation')
+
+# Prefixes of the reference codes this service creates (card payments and
+# subscriptions); both are indexed in payments_index
+_REFERENCE_PREFIXES = ('CS_', 'SUB_')
+
+# Payment reference -> uid. A reference never changes owner, so resolved
+# lookups are kept (bounded LRU) and not re-read from RTDB
+_REFERENCE_UIDS_MAX = 4096
+_reference_uids: 'OrderedDict[str, str]' = OrderedDict()
+_reference_uids_lock = threading.Lock()
+
+# Webhook dedupe key -> time first received. Only an optimisation: a retry
+# this worker has already seen is acknowledged without an RTDB round trip.
+# It does not stop duplicates across workers or concurrent threads; that is
+# the transactional claim on webhook_seen in handle_webhook
+_SEEN_EVENTS_TTL_SECONDS = 24 * 3600
+_SEEN_EVENTS_MAX = 4096
+_seen_events: 'OrderedDict[str, float]' = OrderedDict()
+_seen_events_lock = threading.Lock()
+
+# Webhook events are acknowledged before they are applied, so CyberSource
+# never retries one that fails; the cron sweep replays events still
+# unfinished this long after their last update, up to a few attempts
+_WEBHOOK_UNFINISHED_STATUSES = ('RECEIVED', 'RETRYING', 'FAILED')
+_WEBHOOK_REPLAY_AFTER_SECONDS = 15 * 60
+_WEBHOOK_MAX_ATTEMPTS = 5
+# PROCESSED markers only need to outlive CyberSource's retry window; the
+# sweep deletes older ones so webhook_seen does not grow without bound
+_WEBHOOK_SEEN_RETENTION_SECONDS = _SEEN_EVENTS_TTL_SECONDS
+
+
+_UTC = datetime.timezone.utc
+
+
+# Bound once when the blueprint is registered (init_app); app.config stays
+# the fallback for an app that sets the clients after registration
+_cybersource_client = None
+_cybersource_helper = None
+
+
+def init_app(app):
+    """Bind the app's CyberSource clients for the request handlers."""
+    global _cybersource_client, _cybersource_helper
+    _cybersource_client = app.config.get('cybersource_client')
+    _cybersource_helper = app.config.get('cybersource_helper')
+
+
+def get_cybersource_client():
+    return _cybersource_client or current_app.config.get('cybersource_client')
+
+
+def get_cybersource_helper():
+    return _cybersource_helper or current_app.config.get('cybersource_helper')
+
+
+def _now_utc():
+    """Current UTC time and its ISO string, for stamping one request's writes."""
+    now = datetime.datetime.now(_UTC)
+    return now, now.isoformat()
+
+
+def _missing_fields(obj, required):
+    """Names from required that are absent or empty in obj."""
+    return [name for name in required if not obj.get(name)]
+
+
+def archive_cybersource_response(payment_id, response_data):
+    """Queue the full response for audit/cybersource/{payment_id}; return the
+    slim copy stored on the payment record."""
+    background.submit(db.reference(f'audit/cybersource/{payment_id}').set, response_data)
+    return {key: response_data[key] for key in _RESPONSE_KEEP if key in response_data}
+
+
+def _billing_record(billing_info):
+    """Contact details stored on the payment record (billing_info validated)."""
+    first_name, last_name, email, phone = _billing_contact(billing_info)
+    return {'name': f"{first_name} {last_name}", 'email': email, 'phone': phone}
+
+
+def _record_uncredited(user_id, payment_id, record_fields, credit, subscription=None):
+    """Record a charged card payment whose credit transaction failed.
+
+    The payment is marked PAID_UNCREDITED (not FAILED: the card was charged)
+    and payments_uncredited/{payment_id} keeps the credit_user() arguments,
+    plus the subscription to activate, for retry_uncredited_payments().
+    """
+    payment_path = f'payments/{user_id}/{payment_id}'
+    updates = {f'{payment_path}/{key}': value for key, value in record_fields.items()}
+    updates[f'{payment_path}/status'] = 'PAID_UNCREDITED'
+    updates[f'{payment_path}/credit_days'] = credit['credit_days']
+    entry = {'user_id': user_id, 'recorded_at': record_fields.get('updated_at'), **credit}
+    if subscription:
+        entry['subscription'] = subscription
+    updates[f'payments_uncredited/{payment_id}'] = entry
+    try:
+        db.reference('/').update(updates)
+    except Exception as e:
+        # Nothing will retry this one; log everything needed to credit it by hand
+        logger.exception(
+            "[cybersource_credit] ❌ Could not record uncredited payment %s for user %s (%s): %s",
+            payment_id, user_id, credit, e,
+        )
+
+
+def _credit_pending_response(fields):
+    """202 for a charged payment whose credit is left to the retry sweep."""
+    return jsonify({
+        'success': True,
+        'credit_pending': True,
+        'status': 'PAID_UNCREDITED',
+        'message': 'Payment received. Your credit will be applied shortly.',
+        **fields,
+    }), 202
+
+
+def retry_uncredited_payments():
+    """Apply the credit for card payments left PAID_UNCREDITED.
+
+    Each payment is claimed (PAID_UNCREDITED -> CREDITING) in a transaction
+    so overlapping sweeps credit it once, then marked COMPLETED and, for a
+    subscription, the subscription is written ACTIVE. A failed credit goes
+    back to PAID_UNCREDITED for the next run. A payment left CREDITING (the
+    process died between the credit and the record) is not retried
+    automatically and needs checking by hand. Returns counts for the caller.
+    """
+    _, now_iso = _now_utc()
+    results = {'credited': 0, 'failed': 0, 'skipped': 0}
+    
+    for payment_id, entry in (db.reference('payments_uncredited').get() or {}).items():
+        user_id = (entry or {}).get('user_id')
+        if not user_id:
+            continue
+        payment_path = f'payments/{user_id}/{payment_id}'
+        payment_ref = db.reference(payment_path)
+        claim_id = secrets.token_hex(8)
+        
+        def _claim(current):
+            if not current or current.get('status') != 'PAID_UNCREDITED':
+                return current
+            current.update({'status': 'CREDITING', 'claim_id': claim_id, 'updated_at': now_iso})
+            return current
+        
+        claimed = payment_ref.transaction(_claim) or {}
+        if claimed.get('claim_id') != claim_id:
+            if claimed.get('status') == 'COMPLETED':
+                # Credited already; only the queue entry was left behind
+                db.reference(f'payments_uncredited/{payment_id}').delete()
+            results['skipped'] += 1
+            continue
+        
+        try:
+            user_credit.credit_user(
+                db, user_id, entry['credit_days'], entry['amount'],
+                now_iso,
+                month_key=entry.get('month_key'), month_kes=entry.get('month_kes', 0.0),
+            )
+        except Exception as e:
+            logger.exception("[cybersource_credit] ❌ Credit retry failed for %s: %s", payment_id, e)
+            payment_ref.update({'status': 'PAID_UNCREDITED', 'claim_id': None, 'updated_at': now_iso})
+            results['failed'] += 1
+            continue
+        
+        updates = {
+            f'{payment_path}/status': 'COMPLETED',
+            f'{payment_path}/claim_id': None,
+            f'{payment_path}/credited_at': now_iso,
+            f'{payment_path}/updated_at': now_iso,
+            f'payments_uncredited/{payment_id}': None,
+        }
+        subscription = entry.get('subscription')
+        if subscription:
+            updates[f"subscriptions/{user_id}/{subscription['subscription_id']}"] = subscription
+        db.reference('/').update(updates)
+        logger.info("[cybersource_credit] ✅ Credited %s days for payment %s", entry['credit_days'], payment_id)
+        results['credited'] += 1
+    
+    return results
+
+
+def _remember_reference(reference_code, user_id):
+    with _reference_uids_lock:
+        _reference_uids[reference_code] = user_id
+        _reference_uids.move_to_end(reference_code)
+        while len(_reference_uids) > _REFERENCE_UIDS_MAX:
+            _reference_uids.popitem(last=False)
+
+
+def _recently_seen(dedupe_key):
+    cutoff = time.monotonic() - _SEEN_EVENTS_TTL_SECONDS
+    with _seen_events_lock:
+        # Oldest first; drop everything past the TTL
+        while _seen_events and next(iter(_seen_events.values())) < cutoff:
+            _seen_events.popitem(last=False)
+        return dedupe_key in _seen_events
+
+
+def _remember_event(dedupe_key):
+    with _seen_events_lock:
+        _seen_events.setdefault(dedupe_key, time.monotonic())
+        while len(_seen_events) > _SEEN_EVENTS_MAX:
+            _seen_events.popitem(last=False)
+
+
+def _lookup_user_id(reference_code):
+    parts = reference_code.split('_')
+    if len(parts) < 3 or not parts[1]:
+        return None
+    indexed_uid = db.reference(f'payments_index/{reference_code}').get()
+    if indexed_uid:
+        return indexed_uid
+    user_id_part = parts[1]
+    matches = (
+        db.reference('registeredUser')
+        .order_by_key()
+        .start_at(user_id_part)
+        .end_at(user_id_part + '\uf8ff')
+        .limit_to_first(1)
+        .get()
+    ) or {}
+    for uid in matches:
+        if uid.startswith(user_id_part):
+            return uid
+    return None
+
+
+def _user_id_for_reference(reference_code):
+    """Resolve the full uid from a CS_/SUB_{uid[:8]}_{random} reference code.
+
+    Served from an in-process cache when this worker created the payment or
+    has resolved it before (webhook retries, several events per payment).
+    Otherwise reads payments_index/{reference_code}, written when the
+    payment is initiated; payments made before the index existed fall back
+    to a key-range query on registeredUser, which downloads only the
+    matching user (if any) instead of the whole collection.
+    """
+    with _reference_uids_lock:
+        user_id = _reference_uids.get(reference_code)
+        if user_id is not None:
+            _reference_uids.move_to_end(reference_code)
+            return user_id
+    user_id = _lookup_user_id(reference_code)
+    if user_id:
+        _remember_reference(reference_code, user_id)
+    return user_id
 
 
 def require_auth(f):
     """Decorator to require Firebase authentication."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
+        # CORS preflights carry no credentials; answer them without auth work
+        if request.method == 'OPTIONS':
+            return '', 204
         auth_header = request.headers.get('Authorization', '')
         
-        print(f"[Auth] Checking authentication for {request.path}")
-        print(f"[Auth] Authorization header present: {bool(auth_header)}")
+        logger.debug("[Auth] Checking authentication for %s", request.path)
+        logger.debug("[Auth] Authorization header present: %s", bool(auth_header))
         
         if not auth_header or not auth_header.startswith('Bearer '):
-            print(f"[Auth] ❌ Missing or malformed Authorization header")
+            logger.warning("[Auth] ⚠️ Missing or malformed Authorization header")
             return jsonify({'error': 'Unauthorized - Missing token'}), 401
         
-        token = auth_header.split('Bearer ')[1]
-        print(f"[Auth] Token extracted (length: {len(token)})")
+        token = auth_header[7:].strip()
+        logger.debug("[Auth] Token extracted (length: %s)", len(token))
+        
+        cached_uid = auth_cache.get_uid(token)
+        if cached_uid:
+            request.user_id = cached_uid
+            return f(*args, **kwargs)
         
         try:
-            print(f"[Auth] Attempting to verify Firebase ID token...")
-            decoded_token = auth.verify_id_token(token)
+            logger.debug("[Auth] Attempting to verify Firebase ID token...")
+            decoded_token = auth.verify_id_token(token, clock_skew_seconds=Config.AUTH_CLOCK_SKEW_SECONDS)
+            auth_cache.remember(token, decoded_token)
             user_id = decoded_token['uid']
-            print(f"[Auth] ✅ Token verified successfully, User ID: {user_id}")
+            logger.info("[Auth] ✅ Token verified successfully, User ID: %s", user_id)
             request.user_id = user_id
             return f(*args, **kwargs)
         except Exception as e:
-            error_str = str(e).lower()
-            print(f"[Auth] ❌ Token verification failed: {e}")
-            
-            # Handle clock skew errors
-            if 'clock' in error_str or 'too early' in error_str or 'too late' in error_str:
-                print(f"[Auth] ⚠️ Clock skew detected, waiting 2 seconds and retrying...")
-                import time as time_module
-                time_module.sleep(2)
-                try:
-                    decoded_token = auth.verify_id_token(token)
-                    user_id = decoded_token['uid']
-                    print(f"[Auth] ✅ Token verified after delay, User ID: {user_id}")
-                    request.user_id = user_id
-                    return f(*args, **kwargs)
-                except Exception as retry_error:
-                    print(f"[Auth] ❌ Retry after delay failed: {retry_error}")
-            
+            logger.warning("[Auth] ⚠️ Token verification failed: %s", e)
             return jsonify({'error': f'Unauthorized - {str(e)}'}), 401
     
     return decorated_function
@@ -82,7 +362,7 @@ def initiate_card_payment():
         }
     }
     """
-    print(f"[cybersource_initiate] ========== Card Payment Initiation (RAW CARD) ==========")
+    logger.info("[cybersource_initiate] ========== Card Payment Initiation (RAW CARD) ==========")
     # NOTE: This endpoint proxies to the Node.js helper service for card payments.
     # The Node.js service handles direct communication with CyberSource API.
     # Alternative flows:
@@ -93,60 +373,62 @@ def initiate_card_payment():
     user_id = getattr(request, 'user_id', None)
     
     if not user_id:
-        print(f"[cybersource_initiate] ❌ No user_id found in request")
+        logger.warning("[cybersource_initiate] ⚠️ No user_id found in request")
         return jsonify({'error': 'Unauthorized'}), 401
     
-    print(f"[cybersource_initiate] User ID: {user_id}")
+    logger.info("[cybersource_initiate] User ID: %s", user_id)
+    
+    if (request.content_length or 0) > _MAX_PAYMENT_BODY_BYTES:
+        logger.warning("[cybersource_initiate] ⚠️ Payload too large: %s bytes", request.content_length)
+        return jsonify({'error': 'Payload too large'}), 413
+    if not request.is_json:
+        logger.warning("[cybersource_initiate] ⚠️ Unsupported content type: %s", request.content_type)
+        return jsonify({'error': 'Expected application/json'}), 415
     
     # Parse request body
     try:
         data = request.get_json()
-        print(f"[cybersource_initiate] 📥 Raw request data keys: {list(data.keys()) if data else 'None'}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[cybersource_initiate] 📥 Raw request data keys: %s", list(data.keys()) if data else 'None')
         
         amount = float(data.get('amount', 0))
         currency = data.get('currency', 'KES')
         card = data.get('card', {})
         billing_info = data.get('billingInfo', {})
         
-        print(f"[cybersource_initiate] 💰 Amount: {amount} {currency}")
-        print(f"[cybersource_initiate] 💳 Card details:")
-        print(f"[cybersource_initiate]   - Number: ****{card.get('number', '')[-4:] if len(card.get('number', '')) >= 4 else 'N/A'}")
-        print(f"[cybersource_initiate]   - Expiry: {card.get('expirationMonth', 'N/A')}/{card.get('expirationYear', 'N/A')}")
-        print(f"[cybersource_initiate]   - CVV: {'***' if card.get('cvv') else 'MISSING'}")
-        print(f"[cybersource_initiate] 📍 Billing info:")
-        print(f"[cybersource_initiate]   - Name: {billing_info.get('firstName', 'N/A')} {billing_info.get('lastName', 'N/A')}")
-        print(f"[cybersource_initiate]   - Email: {billing_info.get('email', 'N/A')}")
-        print(f"[cybersource_initiate]   - Phone: {billing_info.get('phoneNumber', 'N/A')}")
-        print(f"[cybersource_initiate]   - Address: {billing_info.get('address1', 'N/A')}, {billing_info.get('locality', 'N/A')}")
-        print(f"[cybersource_initiate]   - Country: {billing_info.get('country', 'N/A')}, Postal: {billing_info.get('postalCode', 'N/A')}")
+        logger.info("[cybersource_initiate] 💰 Amount: %s %s", amount, currency)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[cybersource_initiate] 💳 Card details:")
+            logger.debug("[cybersource_initiate]   - Expiry: %s/%s", card.get('expirationMonth', 'N/A'), card.get('expirationYear', 'N/A'))
+            logger.debug("[cybersource_initiate]   - CVV: %s", '***' if card.get('cvv') else 'MISSING')
+            logger.debug("[cybersource_initiate] 📍 Billing info:")
+            logger.debug("[cybersource_initiate]   - Name: %s %s", billing_info.get('firstName', 'N/A'), billing_info.get('lastName', 'N/A'))
+            logger.debug("[cybersource_initiate]   - Email: %s", billing_info.get('email', 'N/A'))
+            logger.debug("[cybersource_initiate]   - Phone: %s", billing_info.get('phoneNumber', 'N/A'))
+            logger.debug("[cybersource_initiate]   - Address: %s, %s", billing_info.get('address1', 'N/A'), billing_info.get('locality', 'N/A'))
+            logger.debug("[cybersource_initiate]   - Country: %s, Postal: %s", billing_info.get('country', 'N/A'), billing_info.get('postalCode', 'N/A'))
         
         # Validate amount
         # Use lower minimum for USD card payments
-        min_amount = 1.0 if str(currency).upper() == 'USD' else Config.VALIDATION_RULES['min_amount']
-        max_amount = Config.VALIDATION_RULES['max_amount']
-        print(f"[cybersource_initiate] ✅ Amount validation: {amount} (min: {min_amount}, max: {max_amount})")
+        min_amount = 1.0 if str(currency).upper() == 'USD' else _MIN_AMOUNT
+        max_amount = _MAX_AMOUNT
+        logger.info("[cybersource_initiate] ✅ Amount validation: %s (min: %s, max: %s)", amount, min_amount, max_amount)
         
         if amount < min_amount:
-            print(f"[cybersource_initiate] ❌ Amount validation failed: {amount} < {min_amount}")
+            logger.warning("[cybersource_initiate] ⚠️ Amount validation failed: %s < %s", amount, min_amount)
             return jsonify({
                 'error': f"Amount must be at least {min_amount}"
             }), 400
         
         if amount > max_amount:
-            print(f"[cybersource_initiate] ❌ Amount validation failed: {amount} > {max_amount}")
+            logger.warning("[cybersource_initiate] ⚠️ Amount validation failed: %s > %s", amount, max_amount)
             return jsonify({
                 'error': f"Amount must not exceed {max_amount}"
             }), 400
         
         # Clean and validate card number (remove spaces, dashes, etc.)
         card_number_raw = card.get('number', '')
-        if card_number_raw:
-            # Remove all non-digit characters (spaces, dashes, etc.)
-            card_number_clean = ''.join(filter(str.isdigit, str(card_number_raw)))
-            print(f"[cybersource_initiate]   - Card number (raw): {card_number_raw[:4]}...{card_number_raw[-4:] if len(card_number_raw) >= 4 else ''}")
-            print(f"[cybersource_initiate]   - Card number (cleaned): {card_number_clean[:4]}...{card_number_clean[-4:] if len(card_number_clean) >= 4 else ''} (length: {len(card_number_clean)})")
-        else:
-            card_number_clean = ''
+        card_number_clean = _NON_DIGITS.sub('', str(card_number_raw)) if card_number_raw else ''
         
         # Validate card fields
         card_fields = {
@@ -155,56 +437,58 @@ def initiate_card_payment():
             'expirationYear': card.get('expirationYear'),
             'cvv': card.get('cvv'),
         }
-        missing_card_fields = [k for k, v in card_fields.items() if not v]
-        print(f"[cybersource_initiate] ✅ Card fields validation: {len(missing_card_fields)} missing")
+        missing_card_fields = _missing_fields(card_fields, _REQUIRED_CARD_FIELDS)
+        logger.info("[cybersource_initiate] ✅ Card fields validation: %s missing", len(missing_card_fields))
         
         if missing_card_fields:
-            print(f"[cybersource_initiate] ❌ Missing card fields: {missing_card_fields}")
+            logger.warning("[cybersource_initiate] ⚠️ Missing card fields: %s", missing_card_fields)
             return jsonify({'error': 'Missing required card fields'}), 400
+        _, expiration_month, expiration_year, cvv = _card_details(card_fields)
         
         # Validate card number length (should be 13-19 digits)
         if len(card_number_clean) < 13 or len(card_number_clean) > 19:
-            print(f"[cybersource_initiate] ❌ Invalid card number length: {len(card_number_clean)}")
+            logger.warning("[cybersource_initiate] ⚠️ Invalid card number length: %s", len(card_number_clean))
             return jsonify({'error': 'Invalid card number format'}), 400
         
+        # Only the last four digits are used for logging from here on
+        card_last4 = card_number_clean[-4:]
+        logger.debug("[cybersource_initiate]   - Card: ****%s (length: %s)", card_last4, len(card_number_clean))
+        
         # Validate billing info
-        required_billing_fields = [
-            'firstName', 'lastName', 'email', 'phoneNumber',
-            'address1', 'locality', 'country'
-        ]
-        missing_fields = [f for f in required_billing_fields if not billing_info.get(f)]
-        print(f"[cybersource_initiate] ✅ Billing fields validation: {len(missing_fields)} missing")
+        missing_fields = _missing_fields(billing_info, _REQUIRED_BILLING_FIELDS)
+        logger.info("[cybersource_initiate] ✅ Billing fields validation: %s missing", len(missing_fields))
         
         if missing_fields:
-            print(f"[cybersource_initiate] ❌ Missing billing fields: {missing_fields}")
+            logger.warning("[cybersource_initiate] ⚠️ Missing billing fields: %s", missing_fields)
             return jsonify({
-                'error': f"Missing required billing fields: {', '.join(missing_fields)}"
+                'error': 'Missing required billing fields',
+                'fields': missing_fields,
             }), 400
         
-        print(f"[cybersource_initiate] ✅ All validations passed")
+        logger.info("[cybersource_initiate] ✅ All validations passed")
         
     except (ValueError, TypeError) as e:
-        print(f"[cybersource_initiate] ❌ Invalid request data: {e}")
+        logger.warning("[cybersource_initiate] ⚠️ Invalid request data: %s", e)
         return jsonify({'error': 'Invalid request data'}), 400
     
     # Convert to KES for monthly-cap & credit calculations
     amount_in_kes = convert_amount_to_kes(amount, currency)
-    print(
-        f"[cybersource_initiate] 💱 Currency conversion: {amount} {currency} "
-        f"= {amount_in_kes:.2f} KES"
+    logger.info(
+        "[cybersource_initiate] 💱 Currency conversion: %s %s = %.2f KES",
+        amount, currency, amount_in_kes,
     )
     
-    # Fetch user record for monthly spend calculations
-    print(f"[cybersource_initiate] 📊 Monthly cap disabled for legacy endpoint (use Flex for new flows)")
-    user_ref = db.reference(f'registeredUser/{user_id}')
-    user_data = user_ref.get() or {}
+    logger.info("[cybersource_initiate] 📊 Monthly cap disabled for legacy endpoint (use Flex for new flows)")
     
     # Generate unique reference
-    payment_id = f"CS_{user_id[:8]}_{uuid.uuid4().hex[:12]}"
-    print(f"[cybersource_initiate] 🆔 Generated Payment ID: {payment_id}")
+    payment_id = f"CS_{user_id[:8]}_{secrets.token_hex(6)}"
+    logger.info("[cybersource_initiate] 🆔 Generated Payment ID: %s", payment_id)
+    
+    now, now_iso = _now_utc()
     
     # Store payment initiation in Firebase
-    print(f"[cybersource_initiate] 💾 Storing payment record in Firebase...")
+    logger.info("[cybersource_initiate] 💾 Storing payment record in Firebase...")
+    pending_write = None
     try:
         payments_ref = db.reference(f'payments/{user_id}')
         payment_data = {
@@ -215,29 +499,30 @@ def initiate_card_payment():
             'payment_method': 'CARD',
             'provider': 'CYBERSOURCE',
             'status': 'PENDING',
-            'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-            'billing_info': {
-                'name': f"{billing_info.get('firstName')} {billing_info.get('lastName')}",
-                'email': billing_info.get('email'),
-                'phone': billing_info.get('phoneNumber'),
-            }
+            'created_at': now_iso,
+            'billing_info': _billing_record(billing_info),
         }
         
-        payments_ref.child(payment_id).set(payment_data)
-        print(f"[cybersource_initiate] ✅ Payment record stored in Firebase: payments/{user_id}/{payment_id}")
-        print(f"[cybersource_initiate]   - Status: PENDING")
-        print(f"[cybersource_initiate]   - Created at: {payment_data['created_at']}")
+        # Nothing before the CyberSource call needs the PENDING record, so it is
+        # written on the background pool while enrollment and payment run.
+        # The reference -> uid index lets the webhook find the payment directly.
+        pending_write = background.submit(db.reference('/').update, {
+            f'payments/{user_id}/{payment_id}': payment_data,
+            f'payments_index/{payment_id}': user_id,
+        })
+        _remember_reference(payment_id, user_id)
+        logger.info("[cybersource_initiate] ✅ Payment record queued for Firebase: payments/%s/%s", user_id, payment_id)
+        logger.debug("[cybersource_initiate]   - Status: PENDING")
+        logger.debug("[cybersource_initiate]   - Created at: %s", payment_data['created_at'])
         
     except Exception as e:
-        print(f"[cybersource_initiate] ⚠️ Failed to store payment in Firebase: {e}")
-        import traceback
-        print(f"[cybersource_initiate] Firebase error traceback: {traceback.format_exc()}")
+        logger.warning("[cybersource_initiate] ⚠️ Failed to store payment in Firebase: %s", e, exc_info=True)
         # Continue anyway - we can still process the payment
     
     # Get CyberSource helper client
-    cybersource_helper = current_app.config.get('cybersource_helper')
+    cybersource_helper = get_cybersource_helper()
     if not cybersource_helper:
-        print(f"[cybersource_initiate] ❌ CyberSource helper not configured")
+        logger.error("[cybersource_initiate] ❌ CyberSource helper not configured")
         return jsonify({
             'success': False,
             'error': 'Card payments are unavailable right now. Please try again later.'
@@ -245,15 +530,15 @@ def initiate_card_payment():
     
     try:
         # Step 1: Check payer authentication enrollment (3D Secure) via Node.js backend
-        print(f"[cybersource_initiate] 🔐 Checking 3D Secure enrollment via Node.js backend...")
-        print(f"[cybersource_initiate]   - Node.js endpoint: /api/payer-auth/enroll")
+        logger.info("[cybersource_initiate] 🔐 Checking 3D Secure enrollment via Node.js backend...")
+        logger.debug("[cybersource_initiate]   - Node.js endpoint: /api/payer-auth/enroll")
         enrollment_check_payload = {
             'amount': amount,
             'currency': currency,
             'card': {
                 'number': card_number_clean,
-                'expirationMonth': card['expirationMonth'],
-                'expirationYear': card['expirationYear'],
+                'expirationMonth': expiration_month,
+                'expirationYear': expiration_year,
             },
             'billingInfo': billing_info,
             'referenceCode': payment_id,
@@ -265,7 +550,7 @@ def initiate_card_payment():
         
         try:
             enrollment_response = cybersource_helper.check_payer_auth_enrollment(enrollment_check_payload)
-            print(f"[cybersource_initiate] ✅ Enrollment check completed via Node.js backend")
+            logger.info("[cybersource_initiate] ✅ Enrollment check completed via Node.js backend")
             
             # Extract enrollment data from response
             enrollment_status = enrollment_response.get('status', '').upper()
@@ -288,51 +573,52 @@ def initiate_card_payment():
                 (enrollment_status == 'AUTHENTICATION_SUCCESSFUL' and authentication_transaction_id is not None)
             )
             
-            print(f"[cybersource_initiate] 🔐 Enrollment check result:")
-            print(f"[cybersource_initiate]   - Status: {enrollment_status}")
-            print(f"[cybersource_initiate]   - Veres Enrolled: {veres_enrolled} (Y=enrolled, N=not enrolled, U=unavailable)")
-            print(f"[cybersource_initiate]   - Enrolled: {enrollment_enrolled}")
-            if enrollment_step_up_url:
-                print(f"[cybersource_initiate]   - Step-up URL: {enrollment_step_up_url[:80]}...")
-            if authentication_transaction_id:
-                print(f"[cybersource_initiate]   - Auth Transaction ID: {authentication_transaction_id}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[cybersource_initiate] 🔐 Enrollment check result:")
+                logger.debug("[cybersource_initiate]   - Status: %s", enrollment_status)
+                logger.debug("[cybersource_initiate]   - Veres Enrolled: %s (Y=enrolled, N=not enrolled, U=unavailable)", veres_enrolled)
+                logger.debug("[cybersource_initiate]   - Enrolled: %s", enrollment_enrolled)
+                if enrollment_step_up_url:
+                    logger.debug("[cybersource_initiate]   - Step-up URL: %s...", enrollment_step_up_url[:80])
+                if authentication_transaction_id:
+                    logger.debug("[cybersource_initiate]   - Auth Transaction ID: %s", authentication_transaction_id)
             
             if enrollment_status == 'AUTHENTICATION_SUCCESSFUL' and authentication_transaction_id:
-                print(f"[cybersource_initiate]   - ✅ Authentication successful, will use 3D Secure")
+                logger.info("[cybersource_initiate]   - ✅ Authentication successful, will use 3D Secure")
         except CyberSourceHelperError as enroll_err:
             error_status = getattr(enroll_err, 'status_code', None)
             if error_status == 404:
-                print(f"[cybersource_initiate] ⚠️ Enrollment endpoint not found (404) - Node.js backend may need update")
-                print(f"[cybersource_initiate]   - Endpoint: /api/payer-auth/enroll")
-                print(f"[cybersource_initiate]   - Note: Ensure Node.js backend is deployed with latest code")
+                logger.warning("[cybersource_initiate] ⚠️ Enrollment endpoint not found (404) - Node.js backend may need update")
+                logger.info("[cybersource_initiate]   - Endpoint: /api/payer-auth/enroll")
+                logger.info("[cybersource_initiate]   - Note: Ensure Node.js backend is deployed with latest code")
             else:
-                print(f"[cybersource_initiate] ⚠️ Enrollment check failed (proceeding without 3D Secure): {enroll_err}")
+                logger.warning("[cybersource_initiate] ⚠️ Enrollment check failed (proceeding without 3D Secure): %s", enroll_err)
             # Continue without 3D Secure if enrollment check fails
             enrollment_enrolled = False
         
         # Step 2: Process payment via Node.js backend
-        print(f"[cybersource_initiate] 🚀 Processing payment via Node.js backend...")
-        print(f"[cybersource_initiate]   - Node.js endpoint: /api/cards/pay")
-        print(f"[cybersource_initiate]   - Reference code: {payment_id}")
-        print(f"[cybersource_initiate]   - Amount: {amount} {currency}")
-        print(f"[cybersource_initiate]   - Card: ****{card_number_clean[-4:] if len(card_number_clean) >= 4 else 'N/A'}")
-        print(f"[cybersource_initiate]   - Expiry: {card['expirationMonth']}/{card['expirationYear']}")
-        print(f"[cybersource_initiate]   - 3D Secure: {'ENABLED' if enrollment_enrolled else 'NOT REQUIRED'}")
+        logger.info("[cybersource_initiate] 🚀 Processing payment via Node.js backend...")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[cybersource_initiate]   - Node.js endpoint: /api/cards/pay")
+            logger.debug("[cybersource_initiate]   - Reference code: %s", payment_id)
+            logger.debug("[cybersource_initiate]   - Amount: %s %s", amount, currency)
+            logger.debug("[cybersource_initiate]   - Card: ****%s", card_last4)
+            logger.debug("[cybersource_initiate]   - Expiry: %s/%s", expiration_month, expiration_year)
+            logger.debug("[cybersource_initiate]   - 3D Secure: %s", 'ENABLED' if enrollment_enrolled else 'NOT REQUIRED')
         
         helper_payload = {
             'amount': amount,
             'currency': currency,
             'card': {
                 'number': card_number_clean,
-                'expirationMonth': card['expirationMonth'],
-                'expirationYear': card['expirationYear'],
+                'expirationMonth': expiration_month,
+                'expirationYear': expiration_year,
+                'securityCode': cvv,
             },
             'billingInfo': billing_info,
             'referenceCode': payment_id,
             'capture': True,
         }
-        if card.get('cvv'):
-            helper_payload['card']['securityCode'] = card.get('cvv')
         
         # Include 3D Secure authentication data if we have authenticationTransactionId
         # This applies when:
@@ -344,19 +630,19 @@ def initiate_card_payment():
         if authentication_transaction_id:
             helper_payload['authenticationTransactionId'] = authentication_transaction_id
             if enrollment_step_up_url:
-                print(f"[cybersource_initiate] ⚠️ 3D Secure CHALLENGE URL available (proceeding with auth transaction ID)")
-                print(f"[cybersource_initiate]   - Step-up URL: {enrollment_step_up_url}")
+                logger.warning("[cybersource_initiate] ⚠️ 3D Secure CHALLENGE URL available (proceeding with auth transaction ID)")
+                logger.info("[cybersource_initiate]   - Step-up URL: %s", enrollment_step_up_url)
             else:
-                print(f"[cybersource_initiate] ✅ Using 3D Secure authentication (frictionless flow)")
-            print(f"[cybersource_initiate]   - Authentication Transaction ID: {authentication_transaction_id}")
+                logger.info("[cybersource_initiate] ✅ Using 3D Secure authentication (frictionless flow)")
+            logger.info("[cybersource_initiate]   - Authentication Transaction ID: %s", authentication_transaction_id)
         elif enrollment_enrolled:
-            print(f"[cybersource_initiate] ⚠️ Card enrolled but no authenticationTransactionId available")
+            logger.warning("[cybersource_initiate] ⚠️ Card enrolled but no authenticationTransactionId available")
         
         try:
             # Payment will use createCardPaymentWithAuth if authenticationTransactionId is provided
             # Node.js backend automatically routes to authenticated flow when auth data is present
             response_data = cybersource_helper.create_card_payment(helper_payload)
-            print(f"[cybersource_initiate] ✅ Payment request sent to Node.js backend")
+            logger.info("[cybersource_initiate] ✅ Payment request sent to Node.js backend")
             helper_ok = True
             helper_error = None
             helper_status = 200
@@ -365,18 +651,27 @@ def initiate_card_payment():
             helper_ok = False
             helper_error = helper_err.response or helper_err.args[0]
             helper_status = helper_err.status_code or 500
-            print(f"[cybersource_initiate] ❌ Node.js backend error: {helper_err}")
+            logger.error("[cybersource_initiate] ❌ Node.js backend error: %s", helper_err)
+        
+        # The PENDING write replaces the whole node; let it land before any
+        # update below so it cannot overwrite the final status
+        if pending_write is not None:
+            background.settle(pending_write)
+        
+        # One timestamp for every record written from this response
+        now, now_iso = _now_utc()
         
-        print(f"[cybersource_initiate] 📥 CyberSource helper response received")
-        print(f"[cybersource_initiate]   - Success: {helper_ok}")
-        print(f"[cybersource_initiate]   - Status code: {helper_status}")
+        logger.info("[cybersource_initiate] 📥 CyberSource helper response received")
+        logger.debug("[cybersource_initiate]   - Success: %s", helper_ok)
+        logger.debug("[cybersource_initiate]   - Status code: %s", helper_status)
         
         if helper_ok and response_data:
-            print(f"[cybersource_initiate]   - Transaction ID: {response_data.get('id', 'N/A')}")
-            print(f"[cybersource_initiate]   - Status: {response_data.get('status', 'N/A')}")
-            print(f"[cybersource_initiate]   - Response keys: {list(response_data.keys())}")
+            logger.debug("[cybersource_initiate]   - Transaction ID: %s", response_data.get('id', 'N/A'))
+            logger.debug("[cybersource_initiate]   - Status: %s", response_data.get('status', 'N/A'))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[cybersource_initiate]   - Response keys: %s", list(response_data.keys()))
         else:
-            print(f"[cybersource_initiate]   - Error: {helper_error}")
+            logger.info("[cybersource_initiate]   - Error: %s", helper_error)
         
         if helper_ok and response_data:
             # Normalize success/decline using CyberSource fields
@@ -385,26 +680,26 @@ def initiate_card_payment():
             error_info = response_data.get('errorInformation') or {}
             processor_info = response_data.get('processorInformation') or {}
             response_code = (processor_info.get('responseCode') or '').strip()
-            approved = (status in ['AUTHORIZED', 'CAPTURED', 'COMPLETED']) or (response_code == '100')
+            approved = status in _APPROVED_STATUSES or response_code == '100'
 
-            print(f"[cybersource_initiate]   - Transaction ID: {transaction_id}")
-            print(f"[cybersource_initiate]   - Status: {status}")
+            logger.info("[cybersource_initiate]   - Transaction ID: %s", transaction_id)
+            logger.info("[cybersource_initiate]   - Status: %s", status)
             if response_code:
-                print(f"[cybersource_initiate]   - Processor responseCode: {response_code}")
+                logger.info("[cybersource_initiate]   - Processor responseCode: %s", response_code)
 
             if not approved:
                 # Treat as declined
                 decline_reason = error_info.get('message') or error_info.get('details') or 'Payment declined'
-                print(f"[cybersource_initiate] ❌ Payment declined by CyberSource: {decline_reason}")
+                logger.warning("[cybersource_initiate] ⚠️ Payment declined by CyberSource: %s", decline_reason)
                 try:
                     payments_ref.child(payment_id).update({
                         'transaction_id': transaction_id,
                         'status': 'DECLINED',
-                        'cybersource_response': response_data,
-                        'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                        'cybersource_response': archive_cybersource_response(payment_id, response_data),
+                        'updated_at': now_iso,
                     })
                 except Exception as e:
-                    print(f"[cybersource_initiate] ⚠️ Failed to update declined payment: {e}")
+                    logger.warning("[cybersource_initiate] ⚠️ Failed to update declined payment: %s", e)
                 return jsonify({
                     'success': False,
                     'error': decline_reason,
@@ -413,98 +708,96 @@ def initiate_card_payment():
                     'status': 'DECLINED',
                 }), 402
 
-            print(f"[cybersource_initiate] ✅ Payment authorized by CyberSource")
-            print(f"[cybersource_initiate]   - Transaction ID: {transaction_id}")
-            print(f"[cybersource_initiate]   - Status: {status}")
+            logger.info("[cybersource_initiate] ✅ Payment authorized by CyberSource")
+            logger.info("[cybersource_initiate]   - Transaction ID: %s", transaction_id)
+            logger.info("[cybersource_initiate]   - Status: %s", status)
             
-            # Update payment record
-            print(f"[cybersource_initiate] 💾 Updating payment record in Firebase...")
-            try:
-                update_data = {
-                    'transaction_id': transaction_id,
-                    'status': 'COMPLETED' if status == 'AUTHORIZED' else status,
-                    'cybersource_response': response_data,
-                    'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                }
-                payments_ref.child(payment_id).update(update_data)
-                print(f"[cybersource_initiate] ✅ Payment record updated: status={update_data['status']}")
+            payment_path = f'payments/{user_id}/{payment_id}'
+            final_status = 'COMPLETED' if status == 'AUTHORIZED' else status
+            cybersource_response = archive_cybersource_response(payment_id, response_data)
+            updates = {
+                f'{payment_path}/transaction_id': transaction_id,
+                f'{payment_path}/status': final_status,
+                f'{payment_path}/cybersource_response': cybersource_response,
+                f'{payment_path}/updated_at': now_iso,
+            }
+            
+            # Add credits to user account. The record is only marked COMPLETED
+            # once the credit has been applied, so it never claims days the
+            # user did not get
+            credited = status == 'AUTHORIZED' or response_code == '100'
+            if credited:
+                logger.info("[cybersource_initiate] 💰 Processing credit addition...")
                 
-                # Add credits to user account
-                if status == 'AUTHORIZED' or response_code == '100':
-                    print(f"[cybersource_initiate] 💰 Processing credit addition...")
-                    # Re-fetch latest user data for accuracy
-                    latest_user_data = user_ref.get() or {}
-                    print(f"[cybersource_initiate]   - Fetched latest user data from Firebase")
-                    
-                    current_credit_raw = latest_user_data.get('credit_balance', 0)
-                    if isinstance(current_credit_raw, float):
-                        current_credit = int(current_credit_raw)
-                    elif isinstance(current_credit_raw, int):
-                        current_credit = current_credit_raw
-                    else:
-                        try:
-                            current_credit = int(float(current_credit_raw))
-                        except (ValueError, TypeError):
-                            current_credit = 0
-                    
-                    print(f"[cybersource_initiate]   - Current credit balance: {current_credit} days")
-                    
-                    # Use amount_in_kes (already converted earlier) for credit calculation.
-                    # Round the KES amount so it's a multiple of 5, then convert to days using DAILY_RATE.
-                    daily_rate = Config.DAILY_RATE if Config.DAILY_RATE else 1
-                    credit_days, rounded_kes = compute_credit_days_from_kes(amount_in_kes, daily_rate)
-                    new_credit = current_credit + credit_days
-                    
-                    print(f"[cybersource_initiate]   - Daily rate: {daily_rate} KES/day")
-                    print(f"[cybersource_initiate]   - Credit days to add: {credit_days} (amount: {rounded_kes:.2f} KES / rate: {daily_rate} KES/day)")
-                    print(f"[cybersource_initiate]   - New credit balance: {new_credit} days")
-                    
-                    # Track monthly spend in KES so everything is on the same unit
-                    month_key = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m')
-                    updated_monthly = latest_user_data.get('monthly_paid', {}) or {}
-                    latest_month_spend = float(updated_monthly.get(month_key, 0) or 0)
-                    # Store monthly spend in KES (amount_in_kes already converted if USD)
-                    latest_month_spend += amount_in_kes
-                    updated_monthly[month_key] = latest_month_spend
-                    
-                    print(f"[cybersource_initiate]   - Updated monthly spend for {month_key}: {latest_month_spend:.2f} KES")
-                    
-                    user_update_data = {
-                        'credit_balance': int(new_credit),
-                        'total_payments': float(latest_user_data.get('total_payments', 0)) + amount,
-                        'monthly_paid': updated_monthly,
-                        'last_payment_date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                        'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                    }
-                    user_ref.update(user_update_data)
-                    print(f"[cybersource_initiate] ✅ User credit balance updated in Firebase")
-                    
-                    payments_ref.child(payment_id).update({
-                        'credit_days': credit_days
+                # Use amount_in_kes (already converted earlier) for credit calculation.
+                # Round the KES amount so it's a multiple of 5, then convert to days using DAILY_RATE.
+                daily_rate = _DAILY_RATE
+                credit_days, rounded_kes = compute_credit_days_from_kes(amount_in_kes, daily_rate)
+                
+                logger.info("[cybersource_initiate]   - Daily rate: %s KES/day", daily_rate)
+                logger.info("[cybersource_initiate]   - Credit days to add: %s (amount: %.2f KES / rate: %s KES/day)", credit_days, rounded_kes, daily_rate)
+                
+                # Balance, totals and monthly spend (in KES) are read-modify-written
+                # atomically so concurrent payments cannot overwrite each other
+                month_key = now.strftime('%Y-%m')
+                try:
+                    updated_user = user_credit.credit_user(
+                        db, user_id, credit_days, amount,
+                        now_iso,
+                        month_key=month_key, month_kes=amount_in_kes,
+                    )
+                except Exception as e:
+                    # The card is charged: never report this as a failed payment
+                    logger.exception("[cybersource_initiate] ❌ Payment authorized but credit failed: %s", e)
+                    _record_uncredited(user_id, payment_id, {
+                        'transaction_id': transaction_id,
+                        'cybersource_response': cybersource_response,
+                        'updated_at': now_iso,
+                    }, {
+                        'credit_days': credit_days,
+                        'amount': amount,
+                        'month_key': month_key,
+                        'month_kes': amount_in_kes,
+                    })
+                    return _credit_pending_response({
+                        'payment_id': payment_id,
+                        'transaction_id': transaction_id,
+                        'amount': amount,
+                        'currency': currency,
                     })
-                    print(f"[cybersource_initiate] ✅ Payment record updated with credit_days: {credit_days}")
-                    
-                    print(f"[cybersource_initiate] ✅✅✅ Payment completed successfully!")
-                    print(f"[cybersource_initiate]   - Added {credit_days} credit days")
-                    print(f"[cybersource_initiate]   - New balance: {new_credit} days")
-                    print(f"[cybersource_initiate]   - Total payments: {user_update_data['total_payments']} {currency}")
                 
+                new_credit = updated_user['credit_balance']
+                total_payments = updated_user['total_payments']
+                logger.info("[cybersource_initiate] ✅ User credit balance updated in Firebase")
+                logger.info("[cybersource_initiate]   - Updated monthly spend for %s: %.2f KES", month_key, updated_user['monthly_paid'][month_key])
+                updates[f'{payment_path}/credit_days'] = credit_days
+            
+            # Update payment record
+            logger.info("[cybersource_initiate] 💾 Updating payment record in Firebase...")
+            try:
+                db.reference('/').update(updates)
+                logger.info("[cybersource_initiate] ✅ Payment record updated: status=%s", final_status)
             except Exception as e:
-                print(f"[cybersource_initiate] ⚠️ Failed to update records: {e}")
-                import traceback
-                print(f"[cybersource_initiate] Update error traceback: {traceback.format_exc()}")
+                logger.warning("[cybersource_initiate] ⚠️ Failed to update payment record: %s", e, exc_info=True)
+            
+            if credited:
+                logger.info("[cybersource_initiate] ✅✅✅ Payment completed successfully!")
+                logger.info("[cybersource_initiate]   - Added %s credit days", credit_days)
+                logger.info("[cybersource_initiate]   - New balance: %s days", new_credit)
+                logger.info("[cybersource_initiate]   - Total payments: %s %s", total_payments, currency)
             
             # Search for payment by reference code to verify status via Node.js backend
-            print(f"[cybersource_initiate] 🔍 Searching for payment by reference code: {payment_id}")
-            print(f"[cybersource_initiate]   - Using Node.js backend via cybersource_helper")
-            print(f"[cybersource_initiate]   - Helper client type: {type(cybersource_helper).__name__ if cybersource_helper else 'None'}")
+            logger.info("[cybersource_initiate] 🔍 Searching for payment by reference code: %s", payment_id)
+            logger.debug("[cybersource_initiate]   - Using Node.js backend via cybersource_helper")
+            logger.debug("[cybersource_initiate]   - Helper client type: %s", type(cybersource_helper).__name__ if cybersource_helper else 'None')
             try:
                 if cybersource_helper:
-                    print(f"[cybersource_initiate]   - Helper client available, calling search_transactions_by_reference...")
-                    print(f"[cybersource_initiate]   - Helper client has method: {hasattr(cybersource_helper, 'search_transactions_by_reference')}")
+                    logger.debug("[cybersource_initiate]   - Helper client available, calling search_transactions_by_reference...")
+                    logger.debug("[cybersource_initiate]   - Helper client has method: %s", hasattr(cybersource_helper, 'search_transactions_by_reference'))
                     search_result = cybersource_helper.search_transactions_by_reference(payment_id, limit=1)
-                    print(f"[cybersource_initiate]   - Search result received from helper client")
-                    print(f"[cybersource_initiate]   - Search result keys: {list(search_result.keys()) if isinstance(search_result, dict) else 'Not a dict'}")
+                    logger.debug("[cybersource_initiate]   - Search result received from helper client")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("[cybersource_initiate]   - Search result keys: %s", list(search_result.keys()) if isinstance(search_result, dict) else 'Not a dict')
                     transactions = search_result.get('transactions', [])
                     count = search_result.get('count', 0)
                     
@@ -512,32 +805,30 @@ def initiate_card_payment():
                         found_tx = transactions[0]
                         found_status = found_tx.get('status', 'UNKNOWN')
                         found_id = found_tx.get('id', 'N/A')
-                        print(f"[cybersource_initiate] ✅ Payment verified via transaction search")
-                        print(f"[cybersource_initiate]   - Found Transaction ID: {found_id}")
-                        print(f"[cybersource_initiate]   - Verified Status: {found_status}")
+                        logger.info("[cybersource_initiate] ✅ Payment verified via transaction search")
+                        logger.info("[cybersource_initiate]   - Found Transaction ID: %s", found_id)
+                        logger.info("[cybersource_initiate]   - Verified Status: %s", found_status)
                         
                         # Update payment record with verified status if different
-                        if found_status != status and found_status in ['AUTHORIZED', 'CAPTURED', 'COMPLETED']:
-                            print(f"[cybersource_initiate] ⚠️ Status mismatch - updating to verified status")
+                        if found_status != status and found_status in _APPROVED_STATUSES:
+                            logger.warning("[cybersource_initiate] ⚠️ Status mismatch - updating to verified status")
                             try:
                                 payments_ref.child(payment_id).update({
                                     'verified_status': found_status,
-                                    'verified_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                                    'verified_at': now_iso,
                                 })
                             except Exception as update_err:
-                                print(f"[cybersource_initiate] ⚠️ Failed to update verified status: {update_err}")
+                                logger.warning("[cybersource_initiate] ⚠️ Failed to update verified status: %s", update_err)
                     else:
-                        print(f"[cybersource_initiate] ⚠️ No transactions found in search (may need time to index)")
-                        print(f"[cybersource_initiate]   - Count: {count}")
+                        logger.warning("[cybersource_initiate] ⚠️ No transactions found in search (may need time to index)")
+                        logger.info("[cybersource_initiate]   - Count: %s", count)
                 else:
-                    print(f"[cybersource_initiate] ⚠️ CyberSource helper not available for search")
+                    logger.warning("[cybersource_initiate] ⚠️ CyberSource helper not available for search")
             except CyberSourceHelperError as search_err:
                 search_error = search_err.response or str(search_err)
-                print(f"[cybersource_initiate] ⚠️ Transaction search failed: {search_error}")
+                logger.warning("[cybersource_initiate] ⚠️ Transaction search failed: %s", search_error)
             except Exception as search_err:
-                print(f"[cybersource_initiate] ⚠️ Error during transaction search: {search_err}")
-                import traceback
-                print(f"[cybersource_initiate] Search error traceback: {traceback.format_exc()}")
+                logger.warning("[cybersource_initiate] ⚠️ Error during transaction search: %s", search_err, exc_info=True)
                 # Don't fail the payment if search fails - payment already succeeded
             
             return jsonify({
@@ -552,22 +843,20 @@ def initiate_card_payment():
         else:
             # Payment failed
             error = helper_error or 'Unknown error'
-            print(f"[cybersource_initiate] ❌ Payment failed via helper")
-            print(f"[cybersource_initiate]   - Error: {error}")
+            logger.error("[cybersource_initiate] ❌ Payment failed via helper")
+            logger.info("[cybersource_initiate]   - Error: %s", error)
             
             # Update payment record
-            print(f"[cybersource_initiate] 💾 Updating payment record with FAILED status...")
+            logger.info("[cybersource_initiate] 💾 Updating payment record with FAILED status...")
             try:
                 payments_ref.child(payment_id).update({
                     'status': 'FAILED',
                     'error': str(error),
-                    'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    'updated_at': now_iso,
                 })
-                print(f"[cybersource_initiate] ✅ Payment record updated: status=FAILED")
+                logger.info("[cybersource_initiate] ✅ Payment record updated: status=FAILED")
             except Exception as e:
-                print(f"[cybersource_initiate] ⚠️ Failed to update payment record: {e}")
-                import traceback
-                print(f"[cybersource_initiate] Update error traceback: {traceback.format_exc()}")
+                logger.warning("[cybersource_initiate] ⚠️ Failed to update payment record: %s", e, exc_info=True)
             
             return jsonify({
                 'success': False,
@@ -575,9 +864,7 @@ def initiate_card_payment():
                 'payment_id': payment_id,
             }), helper_status
     except Exception as e:
-        print(f"[cybersource_initiate] ❌ Unexpected error: {e}")
-        import traceback
-        print(f"[cybersource_initiate] Traceback: {traceback.format_exc()}")
+        logger.exception("[cybersource_initiate] ❌ Unexpected error: %s", e)
         
         return jsonify({
             'success': False,
@@ -592,14 +879,13 @@ def check_payment_status():
     Expected query parameter:
     - transaction_id: CyberSource transaction ID
     """
-    print(f"[cybersource_status] ========== Check Payment Status ==========")
+    logger.info("[cybersource_status] ========== Check Payment Status ==========")
     
     # Get the CyberSource client from app context
-    from flask import current_app
-    cybersource_client = current_app.config.get('cybersource_client')
+    cybersource_client = get_cybersource_client()
     
     if not cybersource_client:
-        print(f"[cybersource_status] ❌ CyberSource client not initialized")
+        logger.error("[cybersource_status] ❌ CyberSource client not initialized")
         return jsonify({
             'success': False,
             'error': 'Card payments are currently unavailable.',
@@ -607,32 +893,34 @@ def check_payment_status():
         }), 503
     
     # Get transaction ID from query parameter
-    transaction_id = request.args.get('transaction_id') or request.json.get('transaction_id') if request.is_json else None
+    transaction_id = request.args.get('transaction_id')
+    if not transaction_id and request.is_json:
+        transaction_id = (request.get_json(silent=True) or {}).get('transaction_id')
     
     if not transaction_id:
-        print(f"[cybersource_status] ❌ No transaction_id provided")
+        logger.warning("[cybersource_status] ⚠️ No transaction_id provided")
         return jsonify({
             'success': False,
             'error': 'transaction_id is required'
         }), 400
     
-    print(f"[cybersource_status] Transaction ID: {transaction_id}")
+    logger.info("[cybersource_status] Transaction ID: %s", transaction_id)
     
     try:
         result = cybersource_client.check_payment_status(transaction_id)
         
-        print(f"[cybersource_status] 📥 CyberSource API response received")
-        print(f"[cybersource_status]   - Success: {result.get('ok', False)}")
-        print(f"[cybersource_status]   - Status code: {result.get('status_code', 'N/A')}")
+        logger.info("[cybersource_status] 📥 CyberSource API response received")
+        logger.info("[cybersource_status]   - Success: %s", result.get('ok', False))
+        logger.info("[cybersource_status]   - Status code: %s", result.get('status_code', 'N/A'))
         
         if result.get('ok'):
             response_data = result.get('response', {})
             status = response_data.get('status', 'UNKNOWN')
             transaction_id_response = response_data.get('id', transaction_id)
             
-            print(f"[cybersource_status] ✅ Status check successful")
-            print(f"[cybersource_status]   - Transaction ID: {transaction_id_response}")
-            print(f"[cybersource_status]   - Status: {status}")
+            logger.info("[cybersource_status] ✅ Status check successful")
+            logger.info("[cybersource_status]   - Transaction ID: %s", transaction_id_response)
+            logger.info("[cybersource_status]   - Status: %s", status)
             
             return jsonify({
                 'success': True,
@@ -642,8 +930,8 @@ def check_payment_status():
             }), 200
         else:
             error = result.get('error', 'Unknown error')
-            print(f"[cybersource_status] ❌ Status check failed")
-            print(f"[cybersource_status]   - Error: {error}")
+            logger.error("[cybersource_status] ❌ Status check failed")
+            logger.info("[cybersource_status]   - Error: %s", error)
             
             return jsonify({
                 'success': False,
@@ -652,9 +940,7 @@ def check_payment_status():
             }), result.get('status_code', 400)
     
     except Exception as e:
-        print(f"[cybersource_status] ❌ Unexpected error: {e}")
-        import traceback
-        print(f"[cybersource_status] Traceback: {traceback.format_exc()}")
+        logger.exception("[cybersource_status] ❌ Unexpected error: %s", e)
         
         return jsonify({
             'success': False,
@@ -662,6 +948,326 @@ def check_payment_status():
         }), 500
 
 
+def _process_webhook(event_type, payloads, now_iso, seen_ref):
+    """Apply a verified webhook's payloads; runs on the background job pool.
+
+    seen_ref holds the persisted event until it is marked PROCESSED here.
+    If any payload fails, the event is marked FAILED and keeps just those
+    payloads for replay_unfinished_webhooks(). Returns True when all applied.
+    """
+    failed_payloads = []
+    
+    # Process each payload
+    for payload_item in payloads:
+        data = payload_item.get('data', {})
+        organization_id_payload = payload_item.get('organizationId')
+        
+        # Extract relevant payment information
+        if event_type == 'payByLink.merchant.payment':
+            # Pay by Link payment completed
+            transaction_id = data.get('transactionId') or data.get('id')
+            try:
+                amount = float(data.get('amount', 0))
+            except (TypeError, ValueError):
+                logger.error("[cybersource_webhook] ❌ Invalid amount in payload: %r", data.get('amount'))
+                failed_payloads.append(payload_item)
+                continue
+            currency = data.get('currency', 'USD')
+            status = data.get('status', 'UNKNOWN')
+            customer_email = data.get('email') or data.get('customerEmail')
+            reference_code = data.get('referenceCode') or data.get('clientReferenceCode')
+            
+            logger.info("[cybersource_webhook] Pay by Link Payment:")
+            logger.info("[cybersource_webhook]   Transaction ID: %s", transaction_id)
+            logger.info("[cybersource_webhook]   Amount: %s %s", amount, currency)
+            logger.info("[cybersource_webhook]   Status: %s", status)
+            logger.info("[cybersource_webhook]   Reference: %s", reference_code)
+            logger.info("[cybersource_webhook]   Customer: %s", customer_email)
+            
+            # Find user by email or reference code
+            # For now, we'll use reference code to match user
+            if reference_code and reference_code.startswith(_REFERENCE_PREFIXES):
+                # Reference code format: CS_ or SUB_{user_id[:8]}_{random}
+                try:
+                    matched_user_id = _user_id_for_reference(reference_code)
+                    if not matched_user_id:
+                        logger.warning("[cybersource_webhook] ⚠️ No user matched for reference: %s", reference_code)
+                        continue
+                    
+                    logger.info("[cybersource_webhook] ✅ Matched user: %s", matched_user_id)
+                    
+                    # Update payment record
+                    payment_ref = db_refs.user_payment_ref(db, matched_user_id, reference_code)
+                    payment_record = payment_ref.get()
+                    
+                    if payment_record:
+                        payment_ref.update({
+                            'transaction_id': transaction_id,
+                            'status': 'COMPLETED' if status in _WEBHOOK_COMPLETED_STATUSES else status,
+                            'webhook_data': data,
+                            'updated_at': now_iso,
+                        })
+                    
+                    # Add credits if payment successful (and not already added
+                    # by an earlier attempt at this event)
+                    if status not in _WEBHOOK_CREDIT_STATUSES or amount <= 0:
+                        continue
+                    if payment_record and payment_record.get('webhook_credited_at'):
+                        logger.info("[cybersource_webhook] ↩️ Credits already added for %s", reference_code)
+                        continue
+                    
+                    def _add_amount(user_data):
+                        user_data = user_data or {}
+                        user_data.update({
+                            'credit_balance': user_credit.as_float(user_data, 'credit_balance') + amount,
+                            'total_payments': user_credit.as_float(user_data, 'total_payments') + amount,
+                            'last_payment_date': now_iso,
+                            'updated_at': now_iso,
+                        })
+                        return user_data
+                    
+                    user_ref = db_refs.user_ref(db, matched_user_id)
+                    new_credit = user_ref.transaction(_add_amount)['credit_balance']
+                    
+                    if payment_record:
+                        payment_ref.update({'webhook_credited_at': now_iso})
+                    
+                    logger.info("[cybersource_webhook] ✅ Added %s credits. New balance: %s", amount, new_credit)
+                
+                except Exception as e:
+                    logger.exception("[cybersource_webhook] ❌ Error processing payment: %s", e)
+                    failed_payloads.append(payload_item)
+        
+        elif event_type in _CAPTURE_EVENTS:
+            # Standard payment events
+            logger.info("[cybersource_webhook] Payment capture event: %s", event_type)
+            # Similar processing logic as above
+            pass
+        
+        # Decision Manager (Fraud Management) Events
+        elif event_type == 'risk.profile.decision.reject':
+            # Transaction rejected by fraud profile
+            logger.warning("[cybersource_webhook] ⚠️ Fraud Decision: Transaction REJECTED")
+            transaction_id = data.get('id') or data.get('transactionId')
+            reference_code = data.get('clientReferenceInformation', {}).get('code') or data.get('referenceCode')
+            risk_score = data.get('riskInformation', {}).get('score', {}).get('value')
+            risk_factors = data.get('riskInformation', {}).get('factors', [])
+            
+            logger.info("[cybersource_webhook]   Transaction ID: %s", transaction_id)
+            logger.info("[cybersource_webhook]   Reference Code: %s", reference_code)
+            logger.info("[cybersource_webhook]   Risk Score: %s", risk_score)
+            logger.info("[cybersource_webhook]   Risk Factors: %s", risk_factors)
+            
+            # Find and update payment record to mark as fraud-rejected
+            if reference_code and reference_code.startswith(_REFERENCE_PREFIXES):
+                try:
+                    matched_user_id = _user_id_for_reference(reference_code)
+                    
+                    if matched_user_id:
+                        payment_ref = db_refs.user_payment_ref(db, matched_user_id, reference_code)
+                        payment_record = payment_ref.get()
+                        
+                        if payment_record:
+                            payment_ref.update({
+                                'status': 'FRAUD_REJECTED',
+                                'fraud_decision': 'REJECT',
+                                'fraud_score': risk_score,
+                                'fraud_factors': risk_factors,
+                                'webhook_data': data,
+                                'updated_at': now_iso,
+                            })
+                            logger.info("[cybersource_webhook] ✅ Payment marked as FRAUD_REJECTED")
+                except Exception as e:
+                    logger.exception("[cybersource_webhook] ❌ Error processing fraud rejection: %s", e)
+                    failed_payloads.append(payload_item)
+        
+        elif event_type == 'risk.casemanagement.decision.reject':
+            # Fraud case rejected
+            logger.warning("[cybersource_webhook] ⚠️ Fraud Case Decision: REJECTED")
+            case_id = data.get('id') or data.get('caseId')
+            transaction_id = data.get('transactionId')
+            reference_code = data.get('clientReferenceInformation', {}).get('code') or data.get('referenceCode')
+            
+            logger.info("[cybersource_webhook]   Case ID: %s", case_id)
+            logger.info("[cybersource_webhook]   Transaction ID: %s", transaction_id)
+            logger.info("[cybersource_webhook]   Reference Code: %s", reference_code)
+            
+            # Update payment record if found
+            if reference_code and reference_code.startswith(_REFERENCE_PREFIXES):
+                try:
+                    matched_user_id = _user_id_for_reference(reference_code)
+                    
+                    if matched_user_id:
+                        payment_ref = db_refs.user_payment_ref(db, matched_user_id, reference_code)
+                        payment_record = payment_ref.get()
+                        
+                        if payment_record:
+                            payment_ref.update({
+                                'status': 'FRAUD_CASE_REJECTED',
+                                'fraud_case_id': case_id,
+                                'fraud_decision': 'CASE_REJECT',
+                                'webhook_data': data,
+                                'updated_at': now_iso,
+                            })
+                            logger.info("[cybersource_webhook] ✅ Payment marked as FRAUD_CASE_REJECTED")
+                except Exception as e:
+                    logger.exception("[cybersource_webhook] ❌ Error processing fraud case rejection: %s", e)
+                    failed_payloads.append(payload_item)
+        
+        elif event_type == 'risk.casemanagement.decision.accept':
+            # Fraud case accepted (transaction approved after review)
+            logger.info("[cybersource_webhook] ✅ Fraud Case Decision: ACCEPTED")
+            case_id = data.get('id') or data.get('caseId')
+            transaction_id = data.get('transactionId')
+            reference_code = data.get('clientReferenceInformation', {}).get('code') or data.get('referenceCode')
+            
+            logger.info("[cybersource_webhook]   Case ID: %s", case_id)
+            logger.info("[cybersource_webhook]   Transaction ID: %s", transaction_id)
+            logger.info("[cybersource_webhook]   Reference Code: %s", reference_code)
+            
+            # Update payment record - case was reviewed and accepted
+            if reference_code and reference_code.startswith(_REFERENCE_PREFIXES):
+                try:
+                    matched_user_id = _user_id_for_reference(reference_code)
+                    
+                    if matched_user_id:
+                        payment_ref = db_refs.user_payment_ref(db, matched_user_id, reference_code)
+                        payment_record = payment_ref.get()
+                        
+                        if payment_record:
+                            payment_ref.update({
+                                'fraud_case_id': case_id,
+                                'fraud_decision': 'CASE_ACCEPT',
+                                'fraud_reviewed': True,
+                                'webhook_data': data,
+                                'updated_at': now_iso,
+                            })
+                            logger.info("[cybersource_webhook] ✅ Payment fraud case ACCEPTED after review")
+                except Exception as e:
+                    logger.exception("[cybersource_webhook] ❌ Error processing fraud case acceptance: %s", e)
+                    failed_payloads.append(payload_item)
+        
+        else:
+            # Unknown event type - log for debugging
+            logger.warning("[cybersource_webhook] ⚠️ Unknown event type: %s", event_type)
+            logger.debug("[cybersource_webhook]   Data: %s", data)
+    
+    _, done_iso = _now_utc()
+    if failed_payloads:
+        # Keep only what still has to be applied, for the replay sweep
+        seen_ref.update({
+            'status': 'FAILED',
+            'payloads': failed_payloads,
+            'updated_at': done_iso,
+        })
+        logger.error("[cybersource_webhook] ❌ %s of %s payloads failed; event kept for replay", len(failed_payloads), len(payloads))
+        return False
+    
+    # Keep the marker for retries but drop the stored payloads
+    seen_ref.update({
+        'status': 'PROCESSED',
+        'processed_at': done_iso,
+        'updated_at': done_iso,
+        'payloads': None,
+    })
+    logger.info("[cybersource_webhook] ✅ Webhook processed successfully")
+    return True
+
+
+def _sweep_targets(expired_before_iso):
+    """Unfinished events and PROCESSED keys older than expired_before_iso.
+
+    Returns ({key: event}, [key]) for the replay sweep.
+    """
+    seen_root = db.reference('webhook_seen')
+    candidates = {}
+    try:
+        # Needs ".indexOn": ["status", "processed_at"] on /webhook_seen
+        for status in _WEBHOOK_UNFINISHED_STATUSES:
+            candidates.update(seen_root.order_by_child('status').equal_to(status).get() or {})
+        # start_at('') skips entries without processed_at (nulls sort first)
+        expired = list((
+            seen_root.order_by_child('processed_at')
+            .start_at('')
+            .end_at(expired_before_iso)
+            .get()
+        ) or {})
+    except Exception as e:
+        logger.warning("[cybersource_webhook] ⚠️ Indexed query failed (%s), scanning all events", e)
+        candidates, expired = {}, []
+        for key, event in (seen_root.get() or {}).items():
+            if not isinstance(event, dict):
+                continue
+            if event.get('status') in _WEBHOOK_UNFINISHED_STATUSES:
+                candidates[key] = event
+            elif event.get('status') == 'PROCESSED' and (event.get('processed_at') or '') <= expired_before_iso:
+                expired.append(key)
+    return candidates, expired
+
+
+def replay_unfinished_webhooks():
+    """Re-apply webhook events that were acknowledged but never finished.
+
+    Picks up events left RECEIVED or RETRYING (worker recycled or crashed
+    mid-processing) and FAILED ones, once they have been idle for
+    _WEBHOOK_REPLAY_AFTER_SECONDS. Each is claimed in a transaction so
+    overlapping sweeps do not apply it twice. PROCESSED markers past the
+    retention window are deleted. Returns counts for the caller.
+    """
+    now, now_iso = _now_utc()
+    cutoff_iso = (now - datetime.timedelta(seconds=_WEBHOOK_REPLAY_AFTER_SECONDS)).isoformat()
+    retention_iso = (now - datetime.timedelta(seconds=_WEBHOOK_SEEN_RETENTION_SECONDS)).isoformat()
+    results = {'replayed': 0, 'failed': 0, 'exhausted': 0, 'pruned': 0}
+    
+    candidates, expired = _sweep_targets(retention_iso)
+    if expired:
+        db.reference('/').update({f'webhook_seen/{key}': None for key in expired})
+        results['pruned'] = len(expired)
+        logger.info("[cybersource_webhook] 🧹 Pruned %s processed webhook markers", len(expired))
+    
+    def _due(event):
+        return (
+            isinstance(event, dict)
+            and event.get('status') in _WEBHOOK_UNFINISHED_STATUSES
+            and (event.get('updated_at') or event.get('received_at') or '') <= cutoff_iso
+            and event.get('attempts', 0) < _WEBHOOK_MAX_ATTEMPTS
+        )
+    
+    for key, event in candidates.items():
+        if not _due(event):
+            if isinstance(event, dict) and event.get('attempts', 0) >= _WEBHOOK_MAX_ATTEMPTS:
+                results['exhausted'] += 1
+            continue
+        
+        claim_id = secrets.token_hex(8)
+        
+        def _claim(current):
+            if not _due(current):
+                return current
+            current.update({
+                'status': 'RETRYING',
+                'claim_id': claim_id,
+                'attempts': current.get('attempts', 0) + 1,
+                'updated_at': now_iso,
+            })
+            return current
+        
+        seen_ref = db.reference(f'webhook_seen/{key}')
+        claimed = seen_ref.transaction(_claim)
+        if (claimed or {}).get('claim_id') != claim_id:
+            continue
+        
+        logger.info("[cybersource_webhook] 🔁 Replaying %s (attempt %s)", claimed.get('notification_id') or key, claimed['attempts'])
+        try:
+            applied = _process_webhook(claimed.get('event_type'), claimed.get('payloads') or [], now_iso, seen_ref)
+        except Exception as e:
+            logger.exception("[cybersource_webhook] ❌ Replay of %s failed: %s", key, e)
+            applied = False
+        results['replayed' if applied else 'failed'] += 1
+    
+    return results
+
+
 def handle_webhook():
     """
     Handle CyberSource webhook notifications.
@@ -676,15 +1282,14 @@ def handle_webhook():
     - risk.casemanagement.decision.reject: Fraud case rejected
     - risk.casemanagement.decision.accept: Fraud case accepted (after review)
     """
-    print(f"[cybersource_webhook] ========== Webhook Received ==========")
+    logger.info("[cybersource_webhook] ========== Webhook Received ==========")
     
     # Get the CyberSource client from app context
-    from flask import current_app
-    cybersource_client = current_app.config.get('cybersource_client')
+    cybersource_client = get_cybersource_client()
     webhook_secret = Config.CYBERSOURCE_WEBHOOK_SECRET
     
     if not webhook_secret:
-        print(f"[cybersource_webhook] ⚠️ Webhook secret not configured, skipping validation")
+        logger.warning("[cybersource_webhook] ⚠️ Webhook secret not configured, skipping validation")
     
     # Get headers
     signature_header = request.headers.get('V-C-Signature', '')
@@ -693,16 +1298,22 @@ def handle_webhook():
     product_name = request.headers.get('V-C-Product-Name', '')
     webhook_id = request.headers.get('V-C-Webhook-Id', '')
     
-    print(f"[cybersource_webhook] Event Type: {event_type}")
-    print(f"[cybersource_webhook] Organization ID: {organization_id}")
-    print(f"[cybersource_webhook] Product: {product_name}")
-    print(f"[cybersource_webhook] Webhook ID: {webhook_id}")
+    logger.info("[cybersource_webhook] Event Type: %s", event_type)
+    logger.info("[cybersource_webhook] Organization ID: %s", organization_id)
+    logger.info("[cybersource_webhook] Product: %s", product_name)
+    logger.info("[cybersource_webhook] Webhook ID: %s", webhook_id)
     
     # Get raw body
+    if (request.content_length or 0) > _MAX_WEBHOOK_BODY_BYTES:
+        logger.warning("[cybersource_webhook] ⚠️ Payload too large: %s bytes", request.content_length)
+        return jsonify({'error': 'Payload too large'}), 413
     raw_body = request.get_data(as_text=True)
     
-    # Validate signature if configured
-    if webhook_secret and cybersource_client:
+    # Validate signature if configured; never process an unverified body when a secret is set
+    if webhook_secret and not cybersource_client:
+        logger.error("[cybersource_webhook] ❌ Webhook secret set but CyberSource client unavailable to verify it")
+        return jsonify({'error': 'Webhook verification unavailable'}), 503
+    if webhook_secret:
         is_valid = cybersource_client.validate_webhook_signature(
             signature_header=signature_header,
             payload=raw_body,
@@ -710,241 +1321,58 @@ def handle_webhook():
         )
         
         if not is_valid:
-            print(f"[cybersource_webhook] ❌ Invalid signature")
+            logger.warning("[cybersource_webhook] ⚠️ Invalid signature")
             return jsonify({'error': 'Invalid signature'}), 401
     
-    # Parse webhook body
+    _, now_iso = _now_utc()
+    
+    # Parse webhook body from the raw bytes already read for the signature check
     try:
-        webhook_data = request.get_json()
-        print(f"[cybersource_webhook] Webhook data: {webhook_data}")
+        webhook_data = current_app.json.loads(raw_body)
+        logger.debug("[cybersource_webhook] Webhook data: %s", webhook_data)
         
         notification_id = webhook_data.get('notificationId')
         event_date = webhook_data.get('eventDate')
         payloads = webhook_data.get('payloads', [])
         
-        print(f"[cybersource_webhook] Notification ID: {notification_id}")
-        print(f"[cybersource_webhook] Event Date: {event_date}")
-        print(f"[cybersource_webhook] Payloads count: {len(payloads)}")
+        logger.info("[cybersource_webhook] Notification ID: %s", notification_id)
+        logger.info("[cybersource_webhook] Event Date: %s", event_date)
+        logger.info("[cybersource_webhook] Payloads count: %s", len(payloads))
         
-        # Process each payload
-        for payload_item in payloads:
-            data = payload_item.get('data', {})
-            organization_id_payload = payload_item.get('organizationId')
-            
-            # Extract relevant payment information
-            if event_type == 'payByLink.merchant.payment':
-                # Pay by Link payment completed
-                transaction_id = data.get('transactionId') or data.get('id')
-                amount = float(data.get('amount', 0))
-                currency = data.get('currency', 'USD')
-                status = data.get('status', 'UNKNOWN')
-                customer_email = data.get('email') or data.get('customerEmail')
-                reference_code = data.get('referenceCode') or data.get('clientReferenceCode')
-                
-                print(f"[cybersource_webhook] Pay by Link Payment:")
-                print(f"[cybersource_webhook]   Transaction ID: {transaction_id}")
-                print(f"[cybersource_webhook]   Amount: {amount} {currency}")
-                print(f"[cybersource_webhook]   Status: {status}")
-                print(f"[cybersource_webhook]   Reference: {reference_code}")
-                print(f"[cybersource_webhook]   Customer: {customer_email}")
-                
-                # Find user by email or reference code
-                # For now, we'll use reference code to match user
-                if reference_code and reference_code.startswith('CS_'):
-                    # Extract user_id from reference code format: CS_{user_id}_{random}
-                    try:
-                        user_id_part = reference_code.split('_')[1]
-                        
-                        # Search for user
-                        users_ref = db.reference('registeredUser')
-                        all_users = users_ref.get() or {}
-                        
-                        matched_user_id = None
-                        for uid, user_data in all_users.items():
-                            if uid.startswith(user_id_part):
-                                matched_user_id = uid
-                                break
-                        
-                        if matched_user_id:
-                            print(f"[cybersource_webhook] ✅ Matched user: {matched_user_id}")
-                            
-                            # Update payment record
-                            payments_ref = db.reference(f'payments/{matched_user_id}')
-                            payment_record = payments_ref.child(reference_code).get()
-                            
-                            if payment_record:
-                                payments_ref.child(reference_code).update({
-                                    'transaction_id': transaction_id,
-                                    'status': 'COMPLETED' if status in ['AUTHORIZED', 'COMPLETED'] else status,
-                                    'webhook_data': data,
-                                    'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                                })
-                            
-                            # Add credits if payment successful
-                            if status in ['AUTHORIZED', 'COMPLETED', 'SUCCESS']:
-                                user_ref = db.reference(f'registeredUser/{matched_user_id}')
-                                user_data = user_ref.get() or {}
-                                current_credit = float(user_data.get('credit_balance', 0))
-                                new_credit = current_credit + amount
-                                
-                                user_ref.update({
-                                    'credit_balance': new_credit,
-                                    'total_payments': float(user_data.get('total_payments', 0)) + amount,
-                                    'last_payment_date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                                    'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                                })
-                                
-                                print(f"[cybersource_webhook] ✅ Added {amount} credits. New balance: {new_credit}")
-                        else:
-                            print(f"[cybersource_webhook] ⚠️ No user matched for reference: {reference_code}")
-                    
-                    except Exception as e:
-                        print(f"[cybersource_webhook] ❌ Error processing payment: {e}")
-                        import traceback
-                        print(f"[cybersource_webhook] Traceback: {traceback.format_exc()}")
-            
-            elif event_type in ['payments.capture.status.accepted', 'payments.capture.status.updated']:
-                # Standard payment events
-                print(f"[cybersource_webhook] Payment capture event: {event_type}")
-                # Similar processing logic as above
-                pass
-            
-            # Decision Manager (Fraud Management) Events
-            elif event_type == 'risk.profile.decision.reject':
-                # Transaction rejected by fraud profile
-                print(f"[cybersource_webhook] ⚠️ Fraud Decision: Transaction REJECTED")
-                transaction_id = data.get('id') or data.get('transactionId')
-                reference_code = data.get('clientReferenceInformation', {}).get('code') or data.get('referenceCode')
-                risk_score = data.get('riskInformation', {}).get('score', {}).get('value')
-                risk_factors = data.get('riskInformation', {}).get('factors', [])
-                
-                print(f"[cybersource_webhook]   Transaction ID: {transaction_id}")
-                print(f"[cybersource_webhook]   Reference Code: {reference_code}")
-                print(f"[cybersource_webhook]   Risk Score: {risk_score}")
-                print(f"[cybersource_webhook]   Risk Factors: {risk_factors}")
-                
-                # Find and update payment record to mark as fraud-rejected
-                if reference_code and reference_code.startswith('CS_'):
-                    try:
-                        user_id_part = reference_code.split('_')[1]
-                        users_ref = db.reference('registeredUser')
-                        all_users = users_ref.get() or {}
-                        
-                        matched_user_id = None
-                        for uid, user_data in all_users.items():
-                            if uid.startswith(user_id_part):
-                                matched_user_id = uid
-                                break
-                        
-                        if matched_user_id:
-                            payments_ref = db.reference(f'payments/{matched_user_id}')
-                            payment_record = payments_ref.child(reference_code).get()
-                            
-                            if payment_record:
-                                payments_ref.child(reference_code).update({
-                                    'status': 'FRAUD_REJECTED',
-                                    'fraud_decision': 'REJECT',
-                                    'fraud_score': risk_score,
-                                    'fraud_factors': risk_factors,
-                                    'webhook_data': data,
-                                    'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                                })
-                                print(f"[cybersource_webhook] ✅ Payment marked as FRAUD_REJECTED")
-                    except Exception as e:
-                        print(f"[cybersource_webhook] ❌ Error processing fraud rejection: {e}")
-            
-            elif event_type == 'risk.casemanagement.decision.reject':
-                # Fraud case rejected
-                print(f"[cybersource_webhook] ⚠️ Fraud Case Decision: REJECTED")
-                case_id = data.get('id') or data.get('caseId')
-                transaction_id = data.get('transactionId')
-                reference_code = data.get('clientReferenceInformation', {}).get('code') or data.get('referenceCode')
-                
-                print(f"[cybersource_webhook]   Case ID: {case_id}")
-                print(f"[cybersource_webhook]   Transaction ID: {transaction_id}")
-                print(f"[cybersource_webhook]   Reference Code: {reference_code}")
-                
-                # Update payment record if found
-                if reference_code and reference_code.startswith('CS_'):
-                    try:
-                        user_id_part = reference_code.split('_')[1]
-                        users_ref = db.reference('registeredUser')
-                        all_users = users_ref.get() or {}
-                        
-                        matched_user_id = None
-                        for uid, user_data in all_users.items():
-                            if uid.startswith(user_id_part):
-                                matched_user_id = uid
-                                break
-                        
-                        if matched_user_id:
-                            payments_ref = db.reference(f'payments/{matched_user_id}')
-                            payment_record = payments_ref.child(reference_code).get()
-                            
-                            if payment_record:
-                                payments_ref.child(reference_code).update({
-                                    'status': 'FRAUD_CASE_REJECTED',
-                                    'fraud_case_id': case_id,
-                                    'fraud_decision': 'CASE_REJECT',
-                                    'webhook_data': data,
-                                    'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                                })
-                                print(f"[cybersource_webhook] ✅ Payment marked as FRAUD_CASE_REJECTED")
-                    except Exception as e:
-                        print(f"[cybersource_webhook] ❌ Error processing fraud case rejection: {e}")
-            
-            elif event_type == 'risk.casemanagement.decision.accept':
-                # Fraud case accepted (transaction approved after review)
-                print(f"[cybersource_webhook] ✅ Fraud Case Decision: ACCEPTED")
-                case_id = data.get('id') or data.get('caseId')
-                transaction_id = data.get('transactionId')
-                reference_code = data.get('clientReferenceInformation', {}).get('code') or data.get('referenceCode')
-                
-                print(f"[cybersource_webhook]   Case ID: {case_id}")
-                print(f"[cybersource_webhook]   Transaction ID: {transaction_id}")
-                print(f"[cybersource_webhook]   Reference Code: {reference_code}")
-                
-                # Update payment record - case was reviewed and accepted
-                if reference_code and reference_code.startswith('CS_'):
-                    try:
-                        user_id_part = reference_code.split('_')[1]
-                        users_ref = db.reference('registeredUser')
-                        all_users = users_ref.get() or {}
-                        
-                        matched_user_id = None
-                        for uid, user_data in all_users.items():
-                            if uid.startswith(user_id_part):
-                                matched_user_id = uid
-                                break
-                        
-                        if matched_user_id:
-                            payments_ref = db.reference(f'payments/{matched_user_id}')
-                            payment_record = payments_ref.child(reference_code).get()
-                            
-                            if payment_record:
-                                payments_ref.child(reference_code).update({
-                                    'fraud_case_id': case_id,
-                                    'fraud_decision': 'CASE_ACCEPT',
-                                    'fraud_reviewed': True,
-                                    'webhook_data': data,
-                                    'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                                })
-                                print(f"[cybersource_webhook] ✅ Payment fraud case ACCEPTED after review")
-                    except Exception as e:
-                        print(f"[cybersource_webhook] ❌ Error processing fraud case acceptance: {e}")
-            
-            else:
-                # Unknown event type - log for debugging
-                print(f"[cybersource_webhook] ⚠️ Unknown event type: {event_type}")
-                print(f"[cybersource_webhook]   Data: {data}")
+        # CyberSource retries deliveries; acknowledge a notification that was
+        # already received instead of running the updates again
+        dedupe_key = hashlib.sha256((notification_id or raw_body).encode('utf-8')).hexdigest()
+        # Cheap local check first; the claim below is what guarantees one apply
+        if _recently_seen(dedupe_key):
+            logger.info("[cybersource_webhook] ↩️ Duplicate notification, seen by this worker: %s", notification_id or dedupe_key)
+            return jsonify({'status': 'duplicate'}), 200
+        # Claim the key and persist the event in one transaction before
+        # acknowledging it: of two concurrent deliveries only the one that
+        # created the node goes on to apply it. Processing then runs off the
+        # request thread; CyberSource only needs a fast 2xx
+        seen_ref = db.reference(f'webhook_seen/{dedupe_key}')
+        claim_id = secrets.token_hex(8)
+        event_record = {
+            'status': 'RECEIVED',
+            'claim_id': claim_id,
+            'notification_id': notification_id,
+            'event_type': event_type,
+            'received_at': now_iso,
+            'updated_at': now_iso,
+            'payloads': payloads,
+        }
+        stored = seen_ref.transaction(lambda current: current or event_record)
+        _remember_event(dedupe_key)
+        if (stored or {}).get('claim_id') != claim_id:
+            logger.info("[cybersource_webhook] ↩️ Duplicate notification, already received: %s", notification_id or dedupe_key)
+            return jsonify({'status': 'duplicate'}), 200
         
-        print(f"[cybersource_webhook] ✅ Webhook processed successfully")
+        background.submit_job(_process_webhook, event_type, payloads, now_iso, seen_ref)
+        logger.info("[cybersource_webhook] 📥 Webhook accepted for processing")
         return jsonify({'status': 'success'}), 200
     
     except Exception as e:
-        print(f"[cybersource_webhook] ❌ Error processing webhook: {e}")
-        import traceback
-        print(f"[cybersource_webhook] Traceback: {traceback.format_exc()}")
+        logger.exception("[cybersource_webhook] ❌ Error processing webhook: %s", e)
         return jsonify({'error': 'Webhook processing failed'}), 500
 
 
@@ -953,14 +1381,13 @@ def create_subscription():
     Create a monthly subscription (KES 150) using card details.
     Processes the payment immediately and records subscription for future renewals.
     """
-    print(f"[cybersource_subscription] ========== Create Subscription ==========")
+    logger.info("[cybersource_subscription] ========== Create Subscription ==========")
     
     # Get the CyberSource client from app context
-    from flask import current_app
-    cybersource_client = current_app.config.get('cybersource_client')
+    cybersource_client = get_cybersource_client()
     
     if not cybersource_client:
-        print(f"[cybersource_subscription] ❌ CyberSource client not initialized")
+        logger.error("[cybersource_subscription] ❌ CyberSource client not initialized")
         return jsonify({
             'success': False,
             'error': 'Card subscriptions are currently unavailable. Please use M-Pesa for payments.',
@@ -970,6 +1397,13 @@ def create_subscription():
     user_id = getattr(request, 'user_id', None)
     if not user_id:
         return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    
+    if (request.content_length or 0) > _MAX_PAYMENT_BODY_BYTES:
+        logger.warning("[cybersource_subscription] ⚠️ Payload too large: %s bytes", request.content_length)
+        return jsonify({'success': False, 'error': 'Payload too large'}), 413
+    if not request.is_json:
+        logger.warning("[cybersource_subscription] ⚠️ Unsupported content type: %s", request.content_type)
+        return jsonify({'success': False, 'error': 'Expected application/json'}), 415
 
     try:
         data = request.get_json() or {}
@@ -978,34 +1412,32 @@ def create_subscription():
         card = data.get('card', {})
         billing_info = data.get('billingInfo', {})
         
-        print(f"[cybersource_subscription] User: {user_id} Amount: {amount} {currency}")
+        logger.info("[cybersource_subscription] User: %s Amount: %s %s", user_id, amount, currency)
         
         # Validate card fields
-        if not all([
-            card.get('number'),
-            card.get('expirationMonth'),
-            card.get('expirationYear'),
-            card.get('cvv'),
-        ]):
-            return jsonify({'success': False, 'error': 'Missing required card fields'}), 400
+        # Stop at the first missing field and name it in the error
+        missing_card_field = next((name for name in _REQUIRED_CARD_FIELDS if not card.get(name)), None)
+        if missing_card_field:
+            return jsonify({'success': False, 'error': f'Missing card field: {missing_card_field}'}), 400
+        card_number, expiration_month, expiration_year, cvv = _card_details(card)
         
         # Validate billing info
-        required_billing_fields = [
-            'firstName', 'lastName', 'email', 'phoneNumber',
-            'address1', 'locality', 'country'
-        ]
-        missing_fields = [f for f in required_billing_fields if not billing_info.get(f)]
+        missing_fields = _missing_fields(billing_info, _REQUIRED_BILLING_FIELDS)
         if missing_fields:
             return jsonify({
                 'success': False,
-                'error': f"Missing required billing fields: {', '.join(missing_fields)}"
+                'error': 'Missing required billing fields',
+                'fields': missing_fields,
             }), 400
         
         # Generate unique reference for subscription payment
-        payment_id = f"SUB_{user_id[:8]}_{uuid.uuid4().hex[:12]}"
-        print(f"[cybersource_subscription] Payment ID: {payment_id}")
+        payment_id = f"SUB_{user_id[:8]}_{secrets.token_hex(6)}"
+        logger.info("[cybersource_subscription] Payment ID: %s", payment_id)
+        
+        now, now_iso = _now_utc()
         
         # Store subscription payment initiation in Firebase
+        pending_write = None
         try:
             payments_ref = db.reference(f'payments/{user_id}')
             payment_data = {
@@ -1017,32 +1449,42 @@ def create_subscription():
                 'provider': 'CYBERSOURCE',
                 'payment_type': 'SUBSCRIPTION',
                 'status': 'PENDING',
-                'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                'billing_info': {
-                    'name': f"{billing_info.get('firstName')} {billing_info.get('lastName')}",
-                    'email': billing_info.get('email'),
-                    'phone': billing_info.get('phoneNumber'),
-                }
+                'created_at': now_iso,
+                'billing_info': _billing_record(billing_info),
             }
-            payments_ref.child(payment_id).set(payment_data)
-            print(f"[cybersource_subscription] ✅ Payment record created in Firebase")
+            # Written on the background pool so the charge below starts right away,
+            # together with the reference -> uid index the webhook looks up
+            pending_write = background.submit(db.reference('/').update, {
+                f'payments/{user_id}/{payment_id}': payment_data,
+                f'payments_index/{payment_id}': user_id,
+            })
+            _remember_reference(payment_id, user_id)
+            logger.info("[cybersource_subscription] ✅ Payment record queued for Firebase")
         except Exception as e:
-            print(f"[cybersource_subscription] ⚠️ Failed to store payment in Firebase: {e}")
+            logger.warning("[cybersource_subscription] ⚠️ Failed to store payment in Firebase: %s", e)
         
         # Process payment via CyberSource (charge 150 KES immediately)
         try:
             result = cybersource_client.create_payment(
                 amount=amount,
                 currency=currency,
-                card_number=card['number'],
-                expiration_month=card['expirationMonth'],
-                expiration_year=card['expirationYear'],
-                cvv=card['cvv'],
+                card_number=card_number,
+                expiration_month=expiration_month,
+                expiration_year=expiration_year,
+                cvv=cvv,
                 billing_info=billing_info,
                 reference_code=payment_id,
             )
             
-            print(f"[cybersource_subscription] CyberSource response: {result}")
+            logger.debug("[cybersource_subscription] CyberSource response: %s", result)
+            
+            # The PENDING write replaces the whole node; let it land before
+            # the final status is written
+            if pending_write is not None:
+                background.settle(pending_write)
+            
+            # One timestamp for every record written from this response
+            now, now_iso = _now_utc()
             
             if result.get('ok'):
                 # Payment successful
@@ -1050,68 +1492,75 @@ def create_subscription():
                 transaction_id = response_data.get('id')
                 status = response_data.get('status')
                 
-                # Update payment record
-                try:
-                    payments_ref.child(payment_id).update({
-                        'transaction_id': transaction_id,
-                        'status': 'COMPLETED' if status == 'AUTHORIZED' else status,
-                        'cybersource_response': response_data,
-                        'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                    })
+                sub_id = f"SUB_{secrets.token_hex(6)}"
+                
+                next_billing = (now + datetime.timedelta(days=30)).isoformat()
+                sub_doc = {
+                    'subscription_id': sub_id,
+                    'user_id': user_id,
+                    'amount': amount,
+                    'currency': currency,
+                    'status': 'ACTIVE',
+                    'provider': 'CYBERSOURCE',
+                    'payment_id': payment_id,
+                    'transaction_id': transaction_id,
+                    'created_at': now_iso,
+                    'next_billing_date': next_billing,
+                    'billing_email': billing_info.get('email'),
+                }
+                
+                payment_path = f'payments/{user_id}/{payment_id}'
+                cybersource_response = archive_cybersource_response(payment_id, response_data)
+                
+                # Credit first: the payment is only recorded COMPLETED and the
+                # subscription ACTIVE once the user has the days
+                if status == 'AUTHORIZED':
+                    # Convert to KES for credit calculation (handles USD or KES)
+                    amount_in_kes = convert_amount_to_kes(amount, currency)
+                    logger.info("[cybersource_subscription]   - Using %.2f KES for credit calculation from %s %s", amount_in_kes, amount, currency)
                     
-                    # Add credits to user account
-                    if status == 'AUTHORIZED':
-                        # Convert to KES for credit calculation (handles USD or KES)
-                        amount_in_kes = convert_amount_to_kes(amount, currency)
-                        print(f"[cybersource_subscription]   - Using {amount_in_kes:.2f} KES for credit calculation from {amount} {currency}")
-                        
-                        user_ref = db.reference(f'registeredUser/{user_id}')
-                        user_data = user_ref.get() or {}
-                        current_credit_raw = user_data.get('credit_balance', 0)
-                        if isinstance(current_credit_raw, float):
-                            current_credit = int(current_credit_raw)
-                        elif isinstance(current_credit_raw, int):
-                            current_credit = current_credit_raw
-                        else:
-                            try:
-                                current_credit = int(float(current_credit_raw))
-                            except (ValueError, TypeError):
-                                current_credit = 0
-                        
-                        daily_rate = Config.DAILY_RATE if Config.DAILY_RATE else 1
-                        credit_days, rounded_kes = compute_credit_days_from_kes(amount_in_kes, daily_rate)
-                        new_credit = current_credit + credit_days
-                        
-                        user_ref.update({
-                            'credit_balance': int(new_credit),
-                            'total_payments': float(user_data.get('total_payments', 0)) + amount,
-                            'last_payment_date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                            'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    daily_rate = _DAILY_RATE
+                    credit_days, rounded_kes = compute_credit_days_from_kes(amount_in_kes, daily_rate)
+                    try:
+                        updated_user = user_credit.credit_user(
+                            db, user_id, credit_days, amount,
+                            now_iso,
+                        )
+                    except Exception as e:
+                        # The card is charged: the retry sweep credits the user
+                        # and activates the subscription
+                        logger.exception("[cybersource_subscription] ❌ Payment authorized but credit failed: %s", e)
+                        _record_uncredited(user_id, payment_id, {
+                            'transaction_id': transaction_id,
+                            'cybersource_response': cybersource_response,
+                            'updated_at': now_iso,
+                        }, {
+                            'credit_days': credit_days,
+                            'amount': amount,
+                        }, subscription=sub_doc)
+                        return _credit_pending_response({
+                            'subscription_id': sub_id,
+                            'payment_id': payment_id,
+                            'transaction_id': transaction_id,
+                            'amount': amount,
+                            'currency': currency,
                         })
-                        
-                        print(f"[cybersource_subscription] ✅ Added {credit_days} credit days ({rounded_kes:.2f} KES / {daily_rate} KES/day). New balance: {new_credit} days")
-                    
-                    # Record subscription for future renewals
-                    subs_ref = db.reference(f'subscriptions/{user_id}')
-                    sub_id = f"SUB_{uuid.uuid4().hex[:12]}"
-                    subs_ref.child(sub_id).set({
-                        'subscription_id': sub_id,
-                        'user_id': user_id,
-                        'amount': amount,
-                        'currency': currency,
-                        'status': 'ACTIVE',
-                        'provider': 'CYBERSOURCE',
-                        'payment_id': payment_id,
-                        'transaction_id': transaction_id,
-                        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                        'next_billing_date': (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=30)).isoformat(),
-                        'billing_email': billing_info.get('email'),
+                    new_credit = updated_user['credit_balance']
+                    logger.info("[cybersource_subscription] ✅ Added %s credit days (%.2f KES / %s KES/day). New balance: %s days", credit_days, rounded_kes, daily_rate, new_credit)
+                
+                # Payment record and subscription (for future renewals) go out
+                # as one multi-path update
+                try:
+                    db.reference('/').update({
+                        f'{payment_path}/transaction_id': transaction_id,
+                        f'{payment_path}/status': 'COMPLETED' if status == 'AUTHORIZED' else status,
+                        f'{payment_path}/cybersource_response': cybersource_response,
+                        f'{payment_path}/updated_at': now_iso,
+                        f'subscriptions/{user_id}/{sub_id}': sub_doc,
                     })
-                    
-                    print(f"[cybersource_subscription] ✅ Subscription recorded: {sub_id}")
-                    
+                    logger.info("[cybersource_subscription] ✅ Subscription recorded: %s", sub_id)
                 except Exception as e:
-                    print(f"[cybersource_subscription] ⚠️ Failed to update records: {e}")
+                    logger.warning("[cybersource_subscription] ⚠️ Failed to update records: %s", e, exc_info=True)
                 
                 return jsonify({
                     'success': True,
@@ -1133,10 +1582,10 @@ def create_subscription():
                     payments_ref.child(payment_id).update({
                         'status': 'FAILED',
                         'error': str(error),
-                        'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                        'updated_at': now_iso,
                     })
                 except Exception as e:
-                    print(f"[cybersource_subscription] ⚠️ Failed to update payment record: {e}")
+                    logger.warning("[cybersource_subscription] ⚠️ Failed to update payment record: %s", e)
                 
                 return jsonify({
                     'success': False,
@@ -1145,21 +1594,17 @@ def create_subscription():
                 }), 400
         
         except Exception as e:
-            print(f"[cybersource_subscription] ❌ Payment processing error: {e}")
-            import traceback
-            print(f"[cybersource_subscription] Traceback: {traceback.format_exc()}")
+            logger.exception("[cybersource_subscription] ❌ Payment processing error: %s", e)
             return jsonify({
                 'success': False,
                 'error': 'Payment processing failed',
             }), 500
 
     except (ValueError, TypeError) as e:
-        print(f"[cybersource_subscription] ❌ Invalid request data: {e}")
+        logger.warning("[cybersource_subscription] ⚠️ Invalid request data: %s", e)
         return jsonify({'success': False, 'error': 'Invalid request data'}), 400
     except Exception as e:
-        print(f"[cybersource_subscription] ❌ Unexpected error: {e}")
-        import traceback
-        print(f"[cybersource_subscription] Traceback: {traceback.format_exc()}")
+        logger.exception("[cybersource_subscription] ❌ Unexpected error: %s", e)
         return jsonify({'success': False, 'error': 'Subscription setup failed'}), 500
 
 
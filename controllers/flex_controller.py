@@ -1,13 +1,29 @@
 """Flex (tokenized card) payment controller."""
 import datetime
+import logging
 import uuid
 from typing import Any, Dict
 
-from flask import request, jsonify, current_app
+from flask import request, jsonify
 from firebase_admin import db
 
 from config import Config
-from controllers.cybersource_controller import require_auth
+from controllers.cybersource_controller import (
+    _MAX_PAYMENT_BODY_BYTES,
+    archive_cybersource_response,
+    get_cybersource_client,
+    require_auth,
+)
+from core import background, user_credit
+
+# Config is read-only, so bind the per-request limits and rates once at import
+_MIN_AMOUNT = Config.VALIDATION_RULES["min_amount"]
+_MAX_AMOUNT = Config.VALIDATION_RULES["max_amount"]
+_USD_MIN_AMOUNT = 1.0
+_USD_TO_KES_RATE = getattr(Config, "USD_TO_KES_RATE", 130.0)
+_DAILY_RATE = float(getattr(Config, "DAILY_RATE", 5.0))
+
+logger = logging.getLogger(__name__)
 
 
 @require_auth
@@ -33,16 +49,16 @@ def flex_charge() -> Any:
         }
     }
     """
-    print("[flex_charge] ========== Flex Token Payment ==========")
+    logger.info("[flex_charge] ========== Flex Token Payment ==========")
 
     user_id = getattr(request, "user_id", None)
     if not user_id:
-        print("[flex_charge] ❌ No user_id on request")
+        logger.warning("[flex_charge] ⚠️ No user_id on request")
         return jsonify({"error": "Unauthorized"}), 401
 
-    cybersource_client = current_app.config.get("cybersource_client")
+    cybersource_client = get_cybersource_client()
     if not cybersource_client:
-        print("[flex_charge] ❌ CyberSource client not configured")
+        logger.error("[flex_charge] ❌ CyberSource client not configured")
         return (
             jsonify(
                 {
@@ -53,88 +69,96 @@ def flex_charge() -> Any:
             503,
         )
 
-    data: Dict[str, Any] = request.get_json(force=True) or {}
-    print(f"[flex_charge] 🔍 Raw payload keys: {list(data.keys()) if data else 'None'}")
+    if (request.content_length or 0) > _MAX_PAYMENT_BODY_BYTES:
+        logger.warning("[flex_charge] ⚠️ Payload too large: %s bytes", request.content_length)
+        return jsonify({"success": False, "error": "Payload too large"}), 413
+    if not request.is_json:
+        logger.warning("[flex_charge] ⚠️ Unsupported content type: %s", request.content_type)
+        return jsonify({"success": False, "error": "Expected application/json"}), 415
+
+    data: Dict[str, Any] = request.get_json() or {}
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[flex_charge] 🔍 Raw payload keys: %s", list(data.keys()) if data else 'None')
 
     amount = float(data.get("amount") or 0)
     currency = str(data.get("currency") or "USD").upper()
     transient_token = (data.get("transientToken") or "").strip()
     billing_info = data.get("billingInfo") or {}
 
-    print(f"[flex_charge] 💰 Amount: {amount} {currency}")
-    print(
-        "[flex_charge] 📍 Billing: "
-        f"{billing_info.get('firstName', 'N/A')} {billing_info.get('lastName', 'N/A')}, "
-        f"{billing_info.get('email', 'N/A')}, {billing_info.get('phoneNumber', 'N/A')}"
-    )
+    logger.info("[flex_charge] 💰 Amount: %s %s", amount, currency)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "[flex_charge] 📍 Billing: %s %s, %s, %s",
+            billing_info.get("firstName", "N/A"),
+            billing_info.get("lastName", "N/A"),
+            billing_info.get("email", "N/A"),
+            billing_info.get("phoneNumber", "N/A"),
+        )
 
     if not transient_token:
-        print("[flex_charge] ❌ Missing transientToken")
+        logger.warning("[flex_charge] ⚠️ Missing transientToken")
         return jsonify({"error": "transientToken is required"}), 400
 
     # Validate amount limits (USD cards use their own minimum)
-    min_amount = 1.0 if currency == "USD" else Config.VALIDATION_RULES["min_amount"]
-    max_amount = Config.VALIDATION_RULES["max_amount"]
+    min_amount = _USD_MIN_AMOUNT if currency == "USD" else _MIN_AMOUNT
+    max_amount = _MAX_AMOUNT
     if amount < min_amount:
-        print(f"[flex_charge] ❌ Amount below minimum: {amount} < {min_amount}")
+        logger.warning("[flex_charge] ⚠️ Amount below minimum: %s < %s", amount, min_amount)
         return jsonify({"error": f"Amount must be at least {min_amount}"}), 400
     if amount > max_amount:
-        print(f"[flex_charge] ❌ Amount above maximum: {amount} > {max_amount}")
+        logger.warning("[flex_charge] ⚠️ Amount above maximum: %s > %s", amount, max_amount)
         return jsonify({"error": f"Amount must not exceed {max_amount}"}), 400
 
     # Convert USD to KES for cap / credit calculations
     currency_upper = currency.upper()
     amount_in_kes = amount
     if currency_upper == "USD":
-        usd_to_kes_rate = getattr(Config, "USD_TO_KES_RATE", 130.0)
+        usd_to_kes_rate = _USD_TO_KES_RATE
         amount_in_kes = amount * usd_to_kes_rate
-        print(
-            f"[flex_charge] 💱 Currency conversion: {amount} USD = "
-            f"{amount_in_kes:.2f} KES (rate={usd_to_kes_rate})"
+        logger.info(
+            "[flex_charge] 💱 Currency conversion: %s USD = %.2f KES (rate=%s)",
+            amount,
+            amount_in_kes,
+            usd_to_kes_rate,
         )
 
     # Monthly cap removed: allow users to pay for up to 12 months (or more) in advance.
     now = datetime.datetime.now(datetime.timezone.utc)
     month_key = now.strftime("%Y-%m")
     
-    user_ref = db.reference(f"registeredUser/{user_id}")
-    user_data = user_ref.get() or {}
-    monthly_paid = user_data.get("monthly_paid", {}) or {}
-    month_spend = float(monthly_paid.get(month_key, 0))
-    
-    print("[flex_charge] 📊 Monthly cap disabled:")
-    print(f"[flex_charge]   - Month: {month_key}")
-    print(f"[flex_charge]   - Current month spend (KES): {month_spend}")
-    print(
-        f"[flex_charge]   - Requested: {amount} {currency_upper} "
-        f"({amount_in_kes:.2f} KES)"
+    logger.debug("[flex_charge] 📊 Monthly cap disabled:")
+    logger.debug("[flex_charge]   - Month: %s", month_key)
+    logger.debug(
+        "[flex_charge]   - Requested: %s %s (%.2f KES)",
+        amount,
+        currency_upper,
+        amount_in_kes,
     )
     
     # Create a payment id / reference
     payment_id = f"FX_{user_id[:8]}_{uuid.uuid4().hex[:12]}"
-    print(f"[flex_charge] 🆔 Payment ID: {payment_id}")
+    logger.info("[flex_charge] 🆔 Payment ID: %s", payment_id)
 
-    # Persist initial payment record
+    # Persist initial payment record on the background pool so it overlaps
+    # the CyberSource call below
     payments_ref = db.reference(f"payments/{user_id}")
-    try:
-        payments_ref.child(payment_id).set(
-            {
-                "payment_id": payment_id,
-                "user_id": user_id,
-                "amount": amount,
-                "currency": currency_upper,
-                "payment_method": "CARD",
-                "provider": "CYBERSOURCE_FLEX",
-                "status": "PENDING",
-                "created_at": now.isoformat(),
-            }
-        )
-        print("[flex_charge] 💾 Payment record stored (PENDING)")
-    except Exception as e:
-        print(f"[flex_charge] ⚠️ Failed to store payment record: {e}")
+    pending_write = background.submit(
+        payments_ref.child(payment_id).set,
+        {
+            "payment_id": payment_id,
+            "user_id": user_id,
+            "amount": amount,
+            "currency": currency_upper,
+            "payment_method": "CARD",
+            "provider": "CYBERSOURCE_FLEX",
+            "status": "PENDING",
+            "created_at": now.isoformat(),
+        },
+    )
+    logger.info("[flex_charge] 💾 Payment record queued (PENDING)")
 
     # Call CyberSource with transient token
-    print("[flex_charge] 🚀 Calling CyberSource create_payment_with_transient_token")
+    logger.info("[flex_charge] 🚀 Calling CyberSource create_payment_with_transient_token")
     result = cybersource_client.create_payment_with_transient_token(
         amount=amount,
         currency=currency_upper,
@@ -142,24 +166,26 @@ def flex_charge() -> Any:
         reference_code=payment_id,
         capture=True,
     )
+    # set() replaces the node; let it land before the final status is written
+    background.settle(pending_write)
+    # One timestamp for every record written from this response
+    now_iso = datetime.datetime.now(datetime.timezone.utc).isoformat()
 
     ok = bool(result.get("ok"))
     status_code = int(result.get("status_code") or 500)
     if not ok:
         error = result.get("error") or "Payment failed"
-        print(f"[flex_charge] ❌ CyberSource error: {error}")
+        logger.error("[flex_charge] ❌ CyberSource error: %s", error)
         try:
             payments_ref.child(payment_id).update(
                 {
                     "status": "FAILED",
                     "cybersource_error": error,
-                    "updated_at": datetime.datetime.now(
-                        datetime.timezone.utc
-                    ).isoformat(),
+                    "updated_at": now_iso,
                 }
             )
         except Exception as e:
-            print(f"[flex_charge] ⚠️ Failed to update failed payment: {e}")
+            logger.warning("[flex_charge] ⚠️ Failed to update failed payment: %s", e)
         return (
             jsonify(
                 {
@@ -174,58 +200,53 @@ def flex_charge() -> Any:
     resp = result.get("response") or {}
     transaction_id = resp.get("id")
     status = (resp.get("status") or "").upper()
-    print(f"[flex_charge] ✅ CyberSource payment ok: status={status}, id={transaction_id}")
+    logger.info("[flex_charge] ✅ CyberSource payment ok: status=%s, id=%s", status, transaction_id)
 
     # Compute credits (reuse DAILY_RATE logic)
-    daily_rate = float(getattr(Config, "DAILY_RATE", 5.0))
+    daily_rate = _DAILY_RATE
     credit_days = max(1, int(amount_in_kes / daily_rate)) if daily_rate > 0 else int(
         amount_in_kes
     )
-    print(f"[flex_charge] 💰 Credit days from amount: {credit_days}")
+    logger.info("[flex_charge] 💰 Credit days from amount: %s", credit_days)
 
     # Update user credit & monthly stats
     try:
-        user_data = user_ref.get() or {}
-        current_credit = int(float(user_data.get("credit_balance", 0) or 0))
-        monthly = user_data.get("monthly_paid", {}) or {}
-        monthly[month_key] = float(monthly.get(month_key, 0) or 0) + float(amount_in_kes)
-
-        new_credit = current_credit + credit_days
-        now_iso = datetime.datetime.now(datetime.timezone.utc).isoformat()
-
-        user_ref.update(
-            {
-                "credit_balance": int(new_credit),
-                "total_payments": float(
-                    user_data.get("total_payments", 0) or 0
-                )
-                + float(amount_in_kes),
-                "monthly_paid": monthly,
-                "last_payment_date": now_iso,
-                "updated_at": now_iso,
-            }
+        # Read-modify-write of the user's counters happens inside an RTDB
+        # transaction so concurrent payments cannot overwrite each other
+        updated_user = user_credit.credit_user(
+            db,
+            user_id,
+            credit_days,
+            float(amount_in_kes),
+            now_iso,
+            month_key=month_key,
+            month_kes=float(amount_in_kes),
         )
-        # Keep legacy path in sync if present
-        try:
-            legacy_ref = db.reference(f"users/{user_id}")
-            legacy_ref.update({"credit_balance": int(new_credit)})
-        except Exception as e:
-            print(f"[flex_charge] ⚠️ Failed updating legacy user credit: {e}")
+        new_credit = updated_user["credit_balance"]
 
-        payments_ref.child(payment_id).update(
+        # Legacy credit mirror and payment record in one multi-path write
+        payment_path = f"payments/{user_id}/{payment_id}"
+        db.reference("/").update(
             {
-                "status": "COMPLETED",
-                "transaction_id": transaction_id,
-                "cybersource_response": resp,
-                "updated_at": now_iso,
-                "credit_days": credit_days,
+                f"users/{user_id}/credit_balance": int(new_credit),
+                f"{payment_path}/status": "COMPLETED",
+                f"{payment_path}/transaction_id": transaction_id,
+                f"{payment_path}/cybersource_response": archive_cybersource_response(
+                    payment_id, resp
+                ),
+                f"{payment_path}/updated_at": now_iso,
+                f"{payment_path}/credit_days": credit_days,
             }
         )
-        print(
-            f"[flex_charge] ✅ Credit + payment updated: new_credit={new_credit}, credit_days={credit_days}"
+        logger.info(
+            "[flex_charge] ✅ Credit + payment updated: new_credit=%s, credit_days=%s",
+            new_credit,
+            credit_days,
         )
     except Exception as e:
-        print(f"[flex_charge] ⚠️ Failed to update user credit/payment record: {e}")
+        logger.warning(
+            "[flex_charge] ⚠️ Failed to update user credit/payment record: %s", e, exc_info=True
+        )
 
     return (
         jsonify(
@@ -2,11 +2,16 @@
 import base64
 import datetime
 import json
+import traceback
 import uuid
 from flask import request, jsonify, current_app
 from controllers.subscription_controller import require_auth
 from services.cybersource_helper_client import CyberSourceHelperError
 from services.exchange_rate_service import convert_amount_to_kes, compute_credit_days_from_kes
+from core import db_refs, user_credit
+
+# Helper statuses that mark a Google Pay charge as completed
+_COMPLETED_STATUSES = frozenset({'AUTHORIZED', 'PENDING', 'SETTLED'})
 
 
 class GooglePayController:
@@ -19,14 +24,16 @@ class GooglePayController:
     def capture_context(self):
         """Create a Unified Checkout capture-context via CyberSource."""
         try:
+            # Bail out before parsing/logging the body if the helper is missing
+            helper_client = current_app.config.get('cybersource_helper')
+            if not helper_client:
+                return jsonify({'error': 'CyberSource helper not configured'}), 503
+
             raw_payload = request.get_json(silent=True) or {}
             print(
                 "[googlepay_capture_context] 🔍 Incoming request: "
                 f"{json.dumps(raw_payload, default=str)}"
             )
-            helper_client = current_app.config.get('cybersource_helper')
-            if not helper_client:
-                return jsonify({'error': 'CyberSource helper not configured'}), 503
 
             data = raw_payload
             # Derive default origin from BASE_URL
@@ -117,7 +124,6 @@ class GooglePayController:
                 'details': helper_err.response or helper_err.args[0],
             }), helper_err.status_code or 500
         except Exception as e:
-            import traceback
             print(f"[googlepay_capture_context] ERROR: {e}")
             traceback.print_exc()
             return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
@@ -176,7 +182,7 @@ class GooglePayController:
             billing_info = {}
             if user_id:
                 try:
-                    user_ref = self.db.reference(f'registeredUser/{user_id}')
+                    user_ref = db_refs.user_ref(self.db, user_id)
                     user_data = user_ref.get() or {}
                     billing_info = self._build_billing_info(user_data)
                 except Exception as err:
@@ -197,7 +203,7 @@ class GooglePayController:
                 'transientToken_present': bool(transient_token),
                 'googlePayToken_present': bool(google_pay_token),
             }
-            self.db.reference(f'payments/{payment_id}').set(payment_info)
+            db_refs.payment_ref(self.db, payment_id).set(payment_info)
             print(f"[googlepay_charge] payment created id={payment_id}")
 
             if (processor or '').strip().lower() == 'cybersource':
@@ -249,7 +255,7 @@ class GooglePayController:
                             "[googlepay_charge] ❌ Helper Google Pay error: "
                             f"status_code={status_code}, error={error_payload}"
                         )
-                        self.db.reference(f'payments/{payment_id}').update({
+                        db_refs.payment_ref(self.db, payment_id).update({
                             'status': 'failed',
                             'provider_error': error_payload,
                             'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
@@ -270,7 +276,7 @@ class GooglePayController:
                             "[googlepay_charge] ❌ CyberSource payment error (helper): "
                             f"{error_payload}"
                         )
-                        self.db.reference(f'payments/{payment_id}').update({
+                        db_refs.payment_ref(self.db, payment_id).update({
                             'status': 'failed',
                             'provider_error': error_payload,
                             'provider_data': resp,
@@ -323,7 +329,7 @@ class GooglePayController:
                             "[googlepay_charge] ❌ Helper transientToken error: "
                             f"status_code={status_code}, error={error_payload}"
                         )
-                        self.db.reference(f'payments/{payment_id}').update({
+                        db_refs.payment_ref(self.db, payment_id).update({
                             'status': 'failed',
                             'provider_error': error_payload,
                             'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
@@ -344,7 +350,7 @@ class GooglePayController:
                             "[googlepay_charge] ❌ CyberSource payment error (helper transientToken): "
                             f"{error_payload}"
                         )
-                        self.db.reference(f'payments/{payment_id}').update({
+                        db_refs.payment_ref(self.db, payment_id).update({
                             'status': 'failed',
                             'provider_error': error_payload,
                             'provider_data': resp,
@@ -368,48 +374,39 @@ class GooglePayController:
                 amount_in_kes = convert_amount_to_kes(amount, currency)
                 credit_days, rounded_kes = compute_credit_days_from_kes(amount_in_kes, daily_rate)
 
+                payment_path = f'payments/{payment_id}'
+                updates = {
+                    f'{payment_path}/status': 'completed' if status in _COMPLETED_STATUSES else status.lower() or 'completed',
+                    f'{payment_path}/provider_data': resp,
+                    f'{payment_path}/credit_days': credit_days,
+                    f'{payment_path}/completed_at': now_iso,
+                    f'{payment_path}/updated_at': now_iso,
+                }
+
                 # Update user credit
                 try:
-                    registered_user_ref = self.db.reference(f'registeredUser/{user_id}')
-                    legacy_user_ref = self.db.reference(f'users/{user_id}')
-                    user_data = registered_user_ref.get() or {}
-                    current_credit = int(float(user_data.get('credit_balance', 0) or 0))
-
                     # Monthly spend tracking
                     month_key = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m')
-                    monthly = user_data.get('monthly_paid', {}) or {}
                     # Track monthly spend in KES so everything is on the same unit.
-                    monthly[month_key] = float(monthly.get(month_key, 0) or 0) + float(amount_in_kes)
-
-                    new_credit = current_credit + credit_days
-                    registered_user_ref.update({
-                        'credit_balance': int(new_credit),
-                        'total_payments': float(user_data.get('total_payments', 0) or 0) + float(amount),
-                        'monthly_paid': monthly,
-                        'last_payment_date': now_iso,
-                        'updated_at': now_iso,
+                    # Credit, totals and month are updated atomically in one transaction.
+                    updated_user = user_credit.credit_user(
+                        self.db, user_id, credit_days, float(amount), now_iso,
+                        month_key=month_key, month_kes=float(amount_in_kes),
+                    )
+                    # Keep the legacy users/ path in sync (same write as the payment record)
+                    legacy_path = f'users/{user_id}'
+                    updates.update({
+                        f'{legacy_path}/credit_balance': updated_user['credit_balance'],
+                        f'{legacy_path}/total_payments': updated_user['total_payments'],
+                        f'{legacy_path}/monthly_paid': updated_user['monthly_paid'],
+                        f'{legacy_path}/last_payment_date': now_iso,
+                        f'{legacy_path}/updated_at': now_iso,
                     })
-                    try:
-                        legacy_user_ref.update({
-                            'credit_balance': int(new_credit),
-                            'total_payments': float(user_data.get('total_payments', 0) or 0) + float(amount),
-                            'monthly_paid': monthly,
-                            'last_payment_date': now_iso,
-                            'updated_at': now_iso,
-                        })
-                    except Exception as legacy_err:
-                        print(f"[googlepay_charge] ⚠️ Legacy users/ path update failed: {legacy_err}")
                 except Exception as ue:
                     print(f"[googlepay_charge] ⚠️ User credit update error: {ue}")
 
-                # Update payment record
-                self.db.reference(f'payments/{payment_id}').update({
-                    'status': 'completed' if status in ['AUTHORIZED', 'PENDING', 'SETTLED'] else status.lower() or 'completed',
-                    'provider_data': resp,
-                    'credit_days': credit_days,
-                    'completed_at': now_iso,
-                    'updated_at': now_iso,
-                })
+                # Payment record (and legacy mirror) in one multi-path update
+                self.db.reference('/').update(updates)
 
                 return jsonify({
                     'success': True,
@@ -421,7 +418,6 @@ class GooglePayController:
             # No processor configured
             return jsonify({'error': 'GOOGLE_PAY_PROCESSOR not configured'}), 501
         except Exception as e:
-            import traceback
             print(f"[googlepay_charge] ERROR: {e}")
             traceback.print_exc()
             return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
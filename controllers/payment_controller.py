@@ -1,35 +1,44 @@
 """Payment controller for handling M-Pesa payments."""
 import datetime
+import logging
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from flask import request, jsonify, current_app
 from functools import wraps
 from firebase_admin import auth
+from config import Config
+from core import auth_cache, db_refs, user_credit
+
+logger = logging.getLogger(__name__)
 
 
 def require_auth(f):
     """Decorator to require Firebase authentication."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        print(f"[Auth] ========== Authentication Check ==========")
-        print(f"[Auth] Endpoint: {request.endpoint}")
-        print(f"[Auth] Method: {request.method}")
-        print(f"[Auth] Headers: {dict(request.headers)}")
+        # CORS preflights carry no credentials; answer them without auth work
+        if request.method == 'OPTIONS':
+            return '', 204
+        logger.debug("[Auth] ========== Authentication Check ==========")
+        logger.debug("[Auth] Endpoint: %s", request.endpoint)
+        logger.debug("[Auth] Method: %s", request.method)
+        logger.debug("[Auth] Headers: %s", dict(request.headers))
         
         try:
             db = current_app.config.get('DB')
             if db is None:
-                print(f"[Auth] ❌ DB is None - Authentication service unavailable")
+                logger.error("[Auth] ❌ DB is None - Authentication service unavailable")
                 return jsonify({'error': 'Authentication service unavailable'}), 503
             
             auth_header = request.headers.get('Authorization')
-            print(f"[Auth] Authorization header: {auth_header[:30] + '...' if auth_header and len(auth_header) > 30 else auth_header}")
+            logger.debug("[Auth] Authorization header: %s", auth_header[:30] + '...' if auth_header and len(auth_header) > 30 else auth_header)
             
             if not auth_header or not auth_header.startswith('Bearer '):
-                print(f"[Auth] ⚠️ No Bearer token found")
+                logger.warning("[Auth] ⚠️ No Bearer token found")
                 # Allow unauth testing when enabled
                 cfg = current_app.config.get('CONFIG')
                 allow_test = getattr(cfg, 'ALLOW_UNAUTH_TEST', False)
-                print(f"[Auth] ALLOW_UNAUTH_TEST: {allow_test}")
+                logger.debug("[Auth] ALLOW_UNAUTH_TEST: %s", allow_test)
                 
                 if allow_test:
                     test_user = request.args.get('user_id')
@@ -37,83 +46,60 @@ def require_auth(f):
                         body = request.get_json(silent=True) or {}
                         test_user = body.get('user_id')
                     if test_user:
-                        print(f"[Auth] ✅ Test mode: Using user_id={test_user}")
+                        logger.info("[Auth] ✅ Test mode: Using user_id=%s", test_user)
                         request.user_id = test_user
                         return f(*args, **kwargs)
                     else:
-                        print(f"[Auth] ❌ Test mode enabled but no user_id provided")
+                        logger.warning("[Auth] ⚠️ Test mode enabled but no user_id provided")
                 else:
-                    print(f"[Auth] ❌ No token and test mode disabled")
+                    logger.warning("[Auth] ⚠️ No token and test mode disabled")
                 return jsonify({'error': 'No token provided'}), 401
             
-            token = auth_header.split('Bearer ')[1]
-            print(f"[Auth] Token extracted (length: {len(token)}, preview: {token[:20]}...)")
+            token = auth_header[7:].strip()
+            logger.debug("[Auth] Token extracted (length: %s, preview: %s...)", len(token), token[:20])
+            
+            cached_uid = auth_cache.get_uid(token)
+            if cached_uid:
+                request.user_id = cached_uid
+                return f(*args, **kwargs)
             
             try:
-                print(f"[Auth] Verifying Firebase token...")
-                decoded_token = auth.verify_id_token(token)
+                logger.debug("[Auth] Verifying Firebase token...")
+                decoded_token = auth.verify_id_token(token, clock_skew_seconds=Config.AUTH_CLOCK_SKEW_SECONDS)
+                auth_cache.remember(token, decoded_token)
                 user_id = decoded_token['uid']
-                print(f"[Auth] ✅ Token verified successfully")
-                print(f"[Auth] User ID: {user_id}")
+                logger.info("[Auth] ✅ Token verified successfully")
+                logger.info("[Auth] User ID: %s", user_id)
                 request.user_id = user_id
                 return f(*args, **kwargs)
             except Exception as e:
                 error_str = str(e)
                 error_type = type(e).__name__
-                print(f"[Auth] ❌ Token verification failed: {error_type}: {error_str}")
+                logger.warning("[Auth] ⚠️ Token verification failed: %s: %s", error_type, error_str)
                 
-                # Handle clock skew errors (token used too early/late)
-                # For small clock skews (1-5 seconds), wait and retry
-                if 'clock' in error_str.lower() or 'too early' in error_str.lower() or 'too late' in error_str.lower():
-                    print(f"[Auth] ⚠️ Clock skew detected, checking time difference...")
-                    import re
-                    time_match = re.search(r'(\d+) < (\d+)', error_str)
-                    if time_match:
-                        server_time = int(time_match.group(1))
-                        token_time = int(time_match.group(2))
-                        diff = abs(token_time - server_time)
-                        print(f"[Auth] ⚠️ Time difference: {diff} seconds")
-                        
-                        if diff <= 5:  # Allow up to 5 seconds difference
-                            print(f"[Auth] ⚠️ Small clock skew ({diff}s) detected, waiting {diff + 1} seconds and retrying...")
-                            import time as time_module
-                            time_module.sleep(diff + 1)  # Wait for the time difference + 1 second buffer
-                            try:
-                                print(f"[Auth] Retrying token verification after delay...")
-                                decoded_token = auth.verify_id_token(token)
-                                user_id = decoded_token['uid']
-                                print(f"[Auth] ✅ Token verified after delay, User ID: {user_id}")
-                                request.user_id = user_id
-                                return f(*args, **kwargs)
-                            except Exception as retry_error:
-                                print(f"[Auth] ❌ Retry after delay also failed: {retry_error}")
-                        else:
-                            print(f"[Auth] ❌ Clock skew too large ({diff}s), rejecting token")
-                    else:
-                        print(f"[Auth] ⚠️ Clock skew detected but couldn't parse time difference, waiting 2 seconds and retrying...")
-                        import time as time_module
-                        time_module.sleep(2)
-                        try:
-                            decoded_token = auth.verify_id_token(token)
-                            user_id = decoded_token['uid']
-                            print(f"[Auth] ✅ Token verified after delay, User ID: {user_id}")
-                            request.user_id = user_id
-                            return f(*args, **kwargs)
-                        except Exception as retry_error:
-                            print(f"[Auth] ❌ Retry after delay failed: {retry_error}")
-                
-                import traceback
-                print(f"[Auth] Traceback: {traceback.format_exc()}")
+                logger.debug("[Auth] Token verification failure", exc_info=True)
                 return jsonify({'error': 'Invalid Firebase token', 'details': error_str}), 401
         except Exception as e:
-            print(f"[Auth] ❌ Authentication service error: {type(e).__name__}: {str(e)}")
-            import traceback
-            print(f"[Auth] Traceback: {traceback.format_exc()}")
+            logger.exception("[Auth] ❌ Authentication service error: %s: %s", type(e).__name__, str(e))
             return jsonify({'error': 'Authentication service error', 'details': str(e)}), 500
     
     return decorated_function
 
 
+# Written when a completed claim is released because the credit failed: back
+# to pending, without the fields the claim set, so it does not look half-done
+_CLAIM_RELEASE = {
+    'status': 'pending',
+    'completed_at': None,
+    'provider_data': None,
+    'credit_days_added': None,
+}
+
+
+class _AlreadyCompleted(Exception):
+    """Raised inside the payment claim transaction when it is already completed."""
+
+
 class PaymentController:
     """Controller for payment operations."""
     
@@ -151,60 +137,212 @@ class PaymentController:
         
         return None
     
+    def _claim_payment(self, payment_ref, now_iso, extra_fields):
+        """Atomically flip a payment to 'completed'; False if it already was."""
+        def _claim(payment):
+            if not payment or payment.get('status') == 'completed':
+                raise _AlreadyCompleted()
+            payment.update({'status': 'completed', 'completed_at': now_iso, **extra_fields})
+            return payment
+        
+        try:
+            payment_ref.transaction(_claim)
+        except _AlreadyCompleted:
+            return False
+        return True
+    
+    def _credit_user(self, user_id, payment_amount, credit_days, now):
+        """Credit the user through core.user_credit; returns the new balance.
+
+        monthly_paid is kept in KES, which M-Pesa amounts already are.
+        """
+        return user_credit.credit_user(
+            self.db, user_id, credit_days, payment_amount,
+            now.isoformat(),
+            month_key=now.strftime('%Y-%m'), month_kes=payment_amount,
+        )['credit_balance']
+    
+    def _grant_credit_once(self, payment_ref, user_id, payment_amount, credit_days, now, extra_fields):
+        """Mark a payment completed and credit the user exactly once.
+
+        The payment status is claimed in a transaction first, so a duplicate
+        callback racing this one sees 'completed' and backs off. Returns the
+        user's new credit balance, or None if the payment was already completed.
+        """
+        if not self._claim_payment(payment_ref, now.isoformat(), extra_fields):
+            return None
+        try:
+            return self._credit_user(user_id, payment_amount, credit_days, now)
+        except Exception:
+            # Release the claim so a retried callback can still credit the user
+            payment_ref.update(_CLAIM_RELEASE)
+            raise
+    
+    def _credit_days_for(self, payment):
+        """Credit days stored at initiation, recalculated for older records."""
+        stored_credit_days = payment.get('credit_days')
+        if stored_credit_days is not None:
+            return int(stored_credit_days)
+        return int(float(payment.get('amount', 0)) / self.config.DAILY_RATE)
+    
+    def _pending_payments_for(self, user_id):
+        """Return {payment_id: payment} for the user's pending STK pushes."""
+        payments_ref = self.db.reference('payments')
+        try:
+            # Needs ".indexOn": ["user_id"] on /payments
+            user_payments = payments_ref.order_by_child('user_id').equal_to(user_id).get() or {}
+        except Exception as e:
+            logger.warning("[mpesa_reconcile] ⚠️ Indexed query failed (%s), scanning all payments", e)
+            user_payments = {
+                pid: pdata for pid, pdata in (payments_ref.get() or {}).items()
+                if isinstance(pdata, dict) and pdata.get('user_id') == user_id
+            }
+        return {
+            pid: pdata for pid, pdata in user_payments.items()
+            if pdata.get('status') == 'pending' and pdata.get('checkout_request_id')
+        }
+    
+    def reconcile_pending_payments(self):
+        """Resolve the user's pending M-Pesa payments via STK push queries.
+
+        Used when callbacks were missed (e.g. during an outage): each pending
+        push is queried concurrently, failures are written in one multi-path
+        update and all successful payments are credited in a single user
+        transaction.
+        """
+        try:
+            if not self.mpesa_client:
+                return jsonify({'error': 'M-Pesa not configured'}), 503
+            
+            user_id = request.user_id
+            now = datetime.datetime.now(datetime.timezone.utc)
+            now_iso = now.isoformat()
+            pending = self._pending_payments_for(user_id)
+            logger.info("[mpesa_reconcile] User %s has %s pending payment(s)", user_id, len(pending))
+            if not pending:
+                return jsonify({'checked': 0, 'completed': 0, 'failed': 0, 'credit_added': 0})
+            
+            with ThreadPoolExecutor(max_workers=min(10, len(pending))) as pool:
+                results = dict(zip(pending, pool.map(
+                    lambda payment: self.mpesa_client.query_stk_status(payment['checkout_request_id']),
+                    pending.values(),
+                )))
+            
+            failed_updates = {}
+            completed_amount = 0.0
+            completed_days = 0
+            completed_ids = []
+            failed_ids = []
+            for payment_id, result in results.items():
+                response = result.get('response') or {}
+                result_code = response.get('ResultCode')
+                if result_code is None:
+                    # Still processing, or the query itself failed; leave pending
+                    continue
+                if str(result_code) == '0':
+                    payment = pending[payment_id]
+                    credit_days = self._credit_days_for(payment)
+                    claimed = self._claim_payment(
+                        db_refs.payment_ref(self.db, payment_id), now_iso,
+                        {'provider_data': response, 'credit_days_added': credit_days},
+                    )
+                    if claimed:
+                        completed_amount += float(payment.get('amount', 0))
+                        completed_days += credit_days
+                        completed_ids.append(payment_id)
+                else:
+                    failed_ids.append(payment_id)
+                    failed_updates[f'payments/{payment_id}/status'] = 'failed'
+                    failed_updates[f'payments/{payment_id}/provider_data'] = response
+                    failed_updates[f'payments/{payment_id}/completed_at'] = now_iso
+                    failed_updates[f'payments/{payment_id}/failure_reason'] = response.get('ResultDesc')
+            
+            if failed_updates:
+                self.db.reference('/').update(failed_updates)
+            
+            new_credit = None
+            if completed_ids:
+                try:
+                    new_credit = self._credit_user(user_id, completed_amount, completed_days, now)
+                except Exception:
+                    # Release the claims so a later reconcile or callback can credit them
+                    self.db.reference('/').update({
+                        f'payments/{pid}/{field}': value
+                        for pid in completed_ids
+                        for field, value in _CLAIM_RELEASE.items()
+                    })
+                    raise
+            
+            logger.info(
+                "[mpesa_reconcile] ✅ user=%s completed=%s failed=%s credit_added=%s",
+                user_id, len(completed_ids), len(failed_ids), completed_days,
+            )
+            return jsonify({
+                'checked': len(pending),
+                'completed': len(completed_ids),
+                'failed': len(failed_ids),
+                'credit_added': completed_days,
+                'credit_balance': new_credit,
+            })
+        except Exception as e:
+            logger.exception("[mpesa_reconcile] ❌ ERROR: %s", e)
+            return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
+    
     def initiate_payment(self):
         """Initiate an M-Pesa STK push payment."""
         try:
-            print("[mpesa_initiate] ========== M-Pesa Payment Initiation ==========")
-            print(f"[mpesa_initiate] Handler called at: {datetime.datetime.now(datetime.timezone.utc).isoformat()}")
-            print(f"[mpesa_initiate] Request method: {request.method}")
-            print(f"[mpesa_initiate] Request URL: {request.url}")
-            print(f"[mpesa_initiate] Request headers: {dict(request.headers)}")
+            logger.info("[mpesa_initiate] ========== M-Pesa Payment Initiation ==========")
+            now = datetime.datetime.now(datetime.timezone.utc)
+            now_iso = now.isoformat()
+            logger.info("[mpesa_initiate] Handler called at: %s", now_iso)
+            logger.info("[mpesa_initiate] Request method: %s", request.method)
+            logger.info("[mpesa_initiate] Request URL: %s", request.url)
+            logger.debug("[mpesa_initiate] Request headers: %s", dict(request.headers))
             
             if self.mpesa_client is None:
-                print("[mpesa_initiate] ❌ mpesa_client is None - M-Pesa not configured")
+                logger.error("[mpesa_initiate] ❌ mpesa_client is None - M-Pesa not configured")
                 return jsonify({'error': 'M-Pesa not configured'}), 503
         
-            print(f"[mpesa_initiate] ✅ M-Pesa client available")
+            logger.info("[mpesa_initiate] ✅ M-Pesa client available")
             
             data = request.get_json(force=True) or {}
-            print(f"[mpesa_initiate] Request body keys: {list(data.keys())}")
-            print(f"[mpesa_initiate] Request body: {data}")
+            logger.info("[mpesa_initiate] Request body keys: %s", list(data.keys()))
+            logger.debug("[mpesa_initiate] Request body: %s", data)
             
             amount = float(data.get('amount', 0))
             phone_raw = (data.get('phone') or '').strip()
             user_id = getattr(request, 'user_id', None)
             
-            print(f"[mpesa_initiate] Extracted data:")
-            print(f"[mpesa_initiate]   User ID: {user_id}")
-            print(f"[mpesa_initiate]   Amount (raw): {data.get('amount')}")
-            print(f"[mpesa_initiate]   Amount (float): {amount}")
-            print(f"[mpesa_initiate]   Phone (raw): {phone_raw}")
+            logger.info("[mpesa_initiate] Extracted data:")
+            logger.info("[mpesa_initiate]   User ID: %s", user_id)
+            logger.info("[mpesa_initiate]   Amount (raw): %s", data.get('amount'))
+            logger.info("[mpesa_initiate]   Amount (float): %s", amount)
+            logger.info("[mpesa_initiate]   Phone (raw): %s", phone_raw)
             
             # Validate and format phone number
             phone = self._format_phone_number(phone_raw)
             if not phone:
-                print(f"[mpesa_initiate] invalid phone format: {phone_raw}")
+                logger.warning("[mpesa_initiate] invalid phone format: %s", phone_raw)
                 return jsonify({
                     'error': 'Invalid phone number. Must start with +254, 254, 07, or 01'
                 }), 400
             
-            print(f"[mpesa_initiate] formatted phone: {phone}")
+            logger.info("[mpesa_initiate] formatted phone: %s", phone)
         
             if amount < self.config.VALIDATION_RULES.get('min_amount', 10.0):
-                print(f"[mpesa_initiate] amount below minimum: {amount}")
+                logger.warning("[mpesa_initiate] amount below minimum: %s", amount)
                 return jsonify({
                     'error': f"Minimum amount is KES {int(self.config.VALIDATION_RULES.get('min_amount', 10))}"
                 }), 400
         
             # Monthly cap removed: allow users to pay for up to 12 months (or more) in advance.
             user_id = request.user_id
-            now = datetime.datetime.now(datetime.timezone.utc)
             month_key = now.strftime('%Y-%m')
-            user_ref = self.db.reference(f'registeredUser/{user_id}')
+            user_ref = db_refs.user_ref(self.db, user_id)
             user_data = user_ref.get() or {}
             monthly = user_data.get('monthly_paid', {})
             month_spend = float(monthly.get(month_key, 0))
-            print(f"[mpesa_initiate] month_spend={month_spend} (monthly cap disabled, allowing long-term top-ups)")
+            logger.info("[mpesa_initiate] month_spend=%s (monthly cap disabled, allowing long-term top-ups)", month_spend)
         
             # Create payment record
             payment_id = str(uuid.uuid4())
@@ -216,47 +354,47 @@ class PaymentController:
                 'credit_days': credit_days,
                 'status': 'pending',
                 'provider': 'mpesa',
-                'created_at': datetime.datetime.now().isoformat(),
+                'created_at': now_iso,
                 'phone_e164': phone,
                 'month_key': month_key,
                 'month_spend_before': month_spend,
                 'monthly_cap_max': self.config.MONTHLY_CAP_KES
             }
-            self.db.reference(f'payments/{payment_id}').set(payment_info)
-            print(f"[mpesa_initiate] payment created id={payment_id} credit_days={credit_days}")
+            db_refs.payment_ref(self.db, payment_id).set(payment_info)
+            logger.info("[mpesa_initiate] payment created id=%s credit_days=%s", payment_id, credit_days)
         
             # Fire STK push
             description = 'KileKitabu Credits'
-            print(f"[mpesa_initiate] ========== Calling M-Pesa STK Push ==========")
-            print(f"[mpesa_initiate] Parameters:")
-            print(f"[mpesa_initiate]   Amount: {amount}")
-            print(f"[mpesa_initiate]   Phone: {phone}")
-            print(f"[mpesa_initiate]   Payment ID: {payment_id}")
-            print(f"[mpesa_initiate]   Description: {description}")
+            logger.info("[mpesa_initiate] ========== Calling M-Pesa STK Push ==========")
+            logger.info("[mpesa_initiate] Parameters:")
+            logger.info("[mpesa_initiate]   Amount: %s", amount)
+            logger.info("[mpesa_initiate]   Phone: %s", phone)
+            logger.info("[mpesa_initiate]   Payment ID: %s", payment_id)
+            logger.info("[mpesa_initiate]   Description: %s", description)
             
             result = self.mpesa_client.initiate_stk_push(amount, phone, payment_id, description)
             
-            print(f"[mpesa_initiate] ========== M-Pesa STK Push Response ==========")
-            print(f"[mpesa_initiate] Result keys: {list(result.keys())}")
-            print(f"[mpesa_initiate] Result 'ok': {result.get('ok')}")
-            print(f"[mpesa_initiate] Result 'status_code': {result.get('status_code')}")
-            print(f"[mpesa_initiate] Result 'response': {result.get('response')}")
-            print(f"[mpesa_initiate] Result 'error': {result.get('error')}")
+            logger.info("[mpesa_initiate] ========== M-Pesa STK Push Response ==========")
+            logger.info("[mpesa_initiate] Result keys: %s", list(result.keys()))
+            logger.info("[mpesa_initiate] Result 'ok': %s", result.get('ok'))
+            logger.info("[mpesa_initiate] Result 'status_code': %s", result.get('status_code'))
+            logger.info("[mpesa_initiate] Result 'response': %s", result.get('response'))
+            logger.info("[mpesa_initiate] Result 'error': %s", result.get('error'))
             
             if not result.get('ok'):
-                print(f"[mpesa_initiate] ❌ STK Push failed")
-                print(f"[mpesa_initiate] Error details: {result.get('error')}")
+                logger.error("[mpesa_initiate] ❌ STK Push failed")
+                logger.error("[mpesa_initiate] Error details: %s", result.get('error'))
                 return jsonify({'error': 'Failed to initiate M-Pesa', 'details': result}), 500
             
             # Store CheckoutRequestID for callback matching
             checkout_request_id = result.get('response', {}).get('CheckoutRequestID')
             if checkout_request_id:
-                print(f"[mpesa_initiate] ✅ CheckoutRequestID received: {checkout_request_id}")
-                payment_ref = self.db.reference(f'payments/{payment_id}')
+                logger.info("[mpesa_initiate] ✅ CheckoutRequestID received: %s", checkout_request_id)
+                payment_ref = db_refs.payment_ref(self.db, payment_id)
                 payment_ref.update({'checkout_request_id': checkout_request_id})
-                print(f"[mpesa_initiate] ✅ Stored CheckoutRequestID in payment record")
+                logger.info("[mpesa_initiate] ✅ Stored CheckoutRequestID in payment record")
             else:
-                print(f"[mpesa_initiate] ⚠️ No CheckoutRequestID in response")
+                logger.warning("[mpesa_initiate] ⚠️ No CheckoutRequestID in response")
             
             response_data = {
                 'payment_id': payment_id,
@@ -265,71 +403,71 @@ class PaymentController:
                 'mpesa': result.get('response', {})
             }
             
-            print(f"[mpesa_initiate] ✅ Payment initiated successfully")
-            print(f"[mpesa_initiate] Response data: {response_data}")
-            print(f"[mpesa_initiate] ========== M-Pesa Payment Initiation Complete ==========")
+            logger.info("[mpesa_initiate] ✅ Payment initiated successfully")
+            logger.info("[mpesa_initiate] Response data: %s", response_data)
+            logger.info("[mpesa_initiate] ========== M-Pesa Payment Initiation Complete ==========")
             
             return jsonify(response_data)
         except Exception as e:
-            import traceback
-            print(f"[mpesa_initiate] ERROR: {e}")
-            traceback.print_exc()
+            logger.exception("[mpesa_initiate] ❌ ERROR: %s", e)
             return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
     
     def handle_callback(self):
         """Handle M-Pesa STK push callback."""
-        print(f"[mpesa_callback] ========== M-Pesa Callback Received ==========")
-        print(f"[mpesa_callback] Timestamp: {datetime.datetime.now(datetime.timezone.utc).isoformat()}")
-        print(f"[mpesa_callback] Request method: {request.method}")
-        print(f"[mpesa_callback] Request URL: {request.url}")
-        print(f"[mpesa_callback] Remote address: {request.remote_addr}")
-        print(f"[mpesa_callback] User-Agent: {request.headers.get('User-Agent', 'N/A')}")
-        print(f"[mpesa_callback] Content-Type: {request.content_type}")
-        print(f"[mpesa_callback] Content-Length: {request.content_length}")
-        print(f"[mpesa_callback] Request headers:")
+        now = datetime.datetime.now(datetime.timezone.utc)
+        now_iso = now.isoformat()
+        logger.info("[mpesa_callback] ========== M-Pesa Callback Received ==========")
+        logger.info("[mpesa_callback] Timestamp: %s", now_iso)
+        logger.info("[mpesa_callback] Request method: %s", request.method)
+        logger.info("[mpesa_callback] Request URL: %s", request.url)
+        logger.info("[mpesa_callback] Remote address: %s", request.remote_addr)
+        logger.info("[mpesa_callback] User-Agent: %s", request.headers.get('User-Agent', 'N/A'))
+        logger.info("[mpesa_callback] Content-Type: %s", request.content_type)
+        logger.info("[mpesa_callback] Content-Length: %s", request.content_length)
+        logger.debug("[mpesa_callback] Request headers:")
         for key, value in request.headers.items():
-            print(f"[mpesa_callback]   {key}: {value}")
+            logger.debug("[mpesa_callback]   %s: %s", key, value)
         
         try:
             # Get raw body first
             raw_body = request.get_data(as_text=True)
-            print(f"[mpesa_callback] Raw request body (text): {raw_body}")
-            print(f"[mpesa_callback] Raw request body length: {len(raw_body)} bytes")
+            logger.debug("[mpesa_callback] Raw request body (text): %s", raw_body)
+            logger.info("[mpesa_callback] Raw request body length: %s bytes", len(raw_body))
             
             payload = request.get_json(force=True) or {}
-            print(f"[mpesa_callback] Parsed payload type: {type(payload).__name__}")
-            print(f"[mpesa_callback] Parsed payload keys: {list(payload.keys())}")
-            print(f"[mpesa_callback] Parsed payload: {payload}")
+            logger.info("[mpesa_callback] Parsed payload type: %s", type(payload).__name__)
+            logger.info("[mpesa_callback] Parsed payload keys: %s", list(payload.keys()))
+            logger.debug("[mpesa_callback] Parsed payload: %s", payload)
             
             # Extract STK callback data
             body = (payload or {}).get('Body') or {}
-            print(f"[mpesa_callback] Body keys: {list(body.keys())}")
-            print(f"[mpesa_callback] Body: {body}")
+            logger.info("[mpesa_callback] Body keys: %s", list(body.keys()))
+            logger.debug("[mpesa_callback] Body: %s", body)
             
             stk = body.get('stkCallback') or {}
-            print(f"[mpesa_callback] STK callback type: {type(stk).__name__}")
-            print(f"[mpesa_callback] STK callback keys: {list(stk.keys())}")
-            print(f"[mpesa_callback] STK callback full data: {stk}")
+            logger.info("[mpesa_callback] STK callback type: %s", type(stk).__name__)
+            logger.info("[mpesa_callback] STK callback keys: %s", list(stk.keys()))
+            logger.debug("[mpesa_callback] STK callback full data: %s", stk)
             
             result_code = stk.get('ResultCode')
-            print(f"[mpesa_callback] ResultCode: {result_code} (type: {type(result_code).__name__})")
+            logger.info("[mpesa_callback] ResultCode: %s (type: %s)", result_code, type(result_code).__name__)
             
             result_desc = stk.get('ResultDesc')
-            print(f"[mpesa_callback] ResultDesc: {result_desc} (type: {type(result_desc).__name__ if result_desc else 'None'})")
+            logger.info("[mpesa_callback] ResultDesc: %s (type: %s)", result_desc, type(result_desc).__name__ if result_desc else 'None')
             
             merchant_request_id = stk.get('MerchantRequestID')
-            print(f"[mpesa_callback] MerchantRequestID: {merchant_request_id}")
+            logger.info("[mpesa_callback] MerchantRequestID: %s", merchant_request_id)
             
             checkout_request_id = stk.get('CheckoutRequestID')
-            print(f"[mpesa_callback] CheckoutRequestID: {checkout_request_id}")
+            logger.info("[mpesa_callback] CheckoutRequestID: %s", checkout_request_id)
             
             callback_metadata = stk.get('CallbackMetadata') or {}
-            print(f"[mpesa_callback] CallbackMetadata keys: {list(callback_metadata.keys())}")
-            print(f"[mpesa_callback] CallbackMetadata: {callback_metadata}")
+            logger.info("[mpesa_callback] CallbackMetadata keys: %s", list(callback_metadata.keys()))
+            logger.debug("[mpesa_callback] CallbackMetadata: %s", callback_metadata)
             
             metadata_items = callback_metadata.get('Item') or []
-            print(f"[mpesa_callback] Metadata items type: {type(metadata_items).__name__}")
-            print(f"[mpesa_callback] Metadata items count: {len(metadata_items)}")
+            logger.info("[mpesa_callback] Metadata items type: %s", type(metadata_items).__name__)
+            logger.info("[mpesa_callback] Metadata items count: %s", len(metadata_items))
             
             # Extract amount and reference from metadata
             amount = None
@@ -338,35 +476,35 @@ class PaymentController:
             transaction_date = None
             phone_number = None
             
-            print(f"[mpesa_callback] ========== Extracting Metadata Items ==========")
+            logger.info("[mpesa_callback] ========== Extracting Metadata Items ==========")
             for idx, item in enumerate(metadata_items):
                 name = item.get('Name')
                 value = item.get('Value')
-                print(f"[mpesa_callback] Metadata item [{idx}]: Name='{name}', Value='{value}' (type: {type(value).__name__})")
+                logger.info("[mpesa_callback] Metadata item [%s]: Name='%s', Value='%s' (type: %s)", idx, name, value, type(value).__name__)
                 
                 if name == 'Amount':
                     amount = float(value) if value else 0
-                    print(f"[mpesa_callback]   ✅ Extracted Amount: {amount}")
+                    logger.info("[mpesa_callback]   ✅ Extracted Amount: %s", amount)
                 elif name == 'AccountReference':
                     payment_id_from_ref = value
-                    print(f"[mpesa_callback]   ✅ Extracted AccountReference: {payment_id_from_ref}")
+                    logger.info("[mpesa_callback]   ✅ Extracted AccountReference: %s", payment_id_from_ref)
                 elif name == 'MpesaReceiptNumber':
                     receipt_number = value
-                    print(f"[mpesa_callback]   ✅ Extracted MpesaReceiptNumber: {receipt_number}")
+                    logger.info("[mpesa_callback]   ✅ Extracted MpesaReceiptNumber: %s", receipt_number)
                 elif name == 'TransactionDate':
                     transaction_date = value
-                    print(f"[mpesa_callback]   ✅ Extracted TransactionDate: {transaction_date}")
+                    logger.info("[mpesa_callback]   ✅ Extracted TransactionDate: %s", transaction_date)
                 elif name == 'PhoneNumber':
                     phone_number = value
-                    print(f"[mpesa_callback]   ✅ Extracted PhoneNumber: {phone_number}")
+                    logger.info("[mpesa_callback]   ✅ Extracted PhoneNumber: %s", phone_number)
             
-            print(f"[mpesa_callback] ========== Extracted Values Summary ==========")
-            print(f"[mpesa_callback]   Amount: {amount}")
-            print(f"[mpesa_callback]   AccountReference (payment_id): {payment_id_from_ref}")
-            print(f"[mpesa_callback]   MpesaReceiptNumber: {receipt_number}")
-            print(f"[mpesa_callback]   TransactionDate: {transaction_date}")
-            print(f"[mpesa_callback]   PhoneNumber: {phone_number}")
-            print(f"[mpesa_callback]   CheckoutRequestID: {checkout_request_id}")
+            logger.info("[mpesa_callback] ========== Extracted Values Summary ==========")
+            logger.info("[mpesa_callback]   Amount: %s", amount)
+            logger.info("[mpesa_callback]   AccountReference (payment_id): %s", payment_id_from_ref)
+            logger.info("[mpesa_callback]   MpesaReceiptNumber: %s", receipt_number)
+            logger.info("[mpesa_callback]   TransactionDate: %s", transaction_date)
+            logger.info("[mpesa_callback]   PhoneNumber: %s", phone_number)
+            logger.info("[mpesa_callback]   CheckoutRequestID: %s", checkout_request_id)
             
             # Find payment by CheckoutRequestID (preferred) or AccountReference
             payment = None
@@ -374,142 +512,82 @@ class PaymentController:
             payment_ref = None
             
             if checkout_request_id:
-                print(f"[mpesa_callback] Searching for payment by CheckoutRequestID: {checkout_request_id}")
+                logger.info("[mpesa_callback] Searching for payment by CheckoutRequestID: %s", checkout_request_id)
                 payments_ref = self.db.reference('payments')
                 all_payments = payments_ref.get() or {}
                 for pid, pdata in all_payments.items():
                     if pdata.get('checkout_request_id') == checkout_request_id:
-                        print(f"[mpesa_callback] ✅ Found payment by CheckoutRequestID: {pid}")
+                        logger.info("[mpesa_callback] ✅ Found payment by CheckoutRequestID: %s", pid)
                         payment = pdata
                         payment_id = pid
-                        payment_ref = self.db.reference(f'payments/{pid}')
+                        payment_ref = db_refs.payment_ref(self.db, pid)
                         break
             
             # Fallback: try AccountReference if available and payment not found
             if not payment and payment_id:
-                print(f"[mpesa_callback] Payment not found by CheckoutRequestID, trying AccountReference: {payment_id}")
-                payment_ref = self.db.reference(f'payments/{payment_id}')
+                logger.info("[mpesa_callback] Payment not found by CheckoutRequestID, trying AccountReference: %s", payment_id)
+                payment_ref = db_refs.payment_ref(self.db, payment_id)
                 payment = payment_ref.get()
                 
                 # If not found and payment_id is 12 chars, search for payments starting with this prefix
                 if not payment and len(payment_id) == 12:
-                    print(f"[mpesa_callback] Payment not found with exact ID, searching by prefix: {payment_id}")
+                    logger.info("[mpesa_callback] Payment not found with exact ID, searching by prefix: %s", payment_id)
                     payments_ref = self.db.reference('payments')
                     all_payments = payments_ref.get() or {}
                     for pid, pdata in all_payments.items():
                         if pid.startswith(payment_id):
-                            print(f"[mpesa_callback] Found payment by prefix: {pid}")
+                            logger.info("[mpesa_callback] Found payment by prefix: %s", pid)
                             payment = pdata
                             payment_id = pid
-                            payment_ref = self.db.reference(f'payments/{pid}')
+                            payment_ref = db_refs.payment_ref(self.db, pid)
                             break
             
-            print(f"[mpesa_callback] Payment record: {payment}")
+            logger.debug("[mpesa_callback] Payment record: %s", payment)
             
             if not payment:
-                print(f"[mpesa_callback] ❌ Payment not found - CheckoutRequestID: {checkout_request_id}, AccountReference: {payment_id}")
+                logger.error("[mpesa_callback] ❌ Payment not found - CheckoutRequestID: %s, AccountReference: %s", checkout_request_id, payment_id)
                 return jsonify({'status': 'ignored', 'reason': 'payment_not_found'}), 200
             
             user_id = payment.get('user_id')
-            print(f"[mpesa_callback] User ID: {user_id}")
+            logger.info("[mpesa_callback] User ID: %s", user_id)
             
             # Check if payment was already processed to prevent duplicate credit additions
             payment_status = payment.get('status', 'pending')
             if payment_status == 'completed':
-                print(f"[mpesa_callback] ⚠️ Payment already processed (status: {payment_status}). Skipping credit update.")
+                logger.warning("[mpesa_callback] ⚠️ Payment already processed (status: %s). Skipping credit update.", payment_status)
                 return jsonify({'status': 'ok', 'message': 'already_processed'}), 200
             
-            user_ref = self.db.reference(f'registeredUser/{user_id}')
-            user_data = user_ref.get() or {}
-            print(f"[mpesa_callback] Current user data - credit_balance: {user_data.get('credit_balance')}, total_payments: {user_data.get('total_payments')}")
-            
             if result_code == 0 or result_code == '0':
-                print(f"[mpesa_callback] ✅ Payment successful (ResultCode: {result_code})")
+                logger.info("[mpesa_callback] ✅ Payment successful (ResultCode: %s)", result_code)
                 
-                # Get credit_days from payment record (already calculated during initiation)
-                # Fallback to recalculating if not stored
-                stored_credit_days = payment.get('credit_days')
+                # credit_days stored at initiation (recalculated for older records)
                 payment_amount = float(payment.get('amount', 0))
+                credit_days = self._credit_days_for(payment)
+                logger.info("[mpesa_callback] Credit days for payment: %s", credit_days)
                 
-                if stored_credit_days is not None:
-                    credit_days = int(stored_credit_days)
-                    print(f"[mpesa_callback] Using stored credit_days: {credit_days}")
-                else:
-                    # Fallback: recalculate if not stored
-                    credit_days = int(payment_amount / self.config.DAILY_RATE)
-                    print(f"[mpesa_callback] ⚠️ credit_days not stored, recalculated: {credit_days} (amount={payment_amount}, rate={self.config.DAILY_RATE})")
-                
-                # Get current credit balance (handle both int and float from Firebase)
-                current_credit_raw = user_data.get('credit_balance', 0)
-                if isinstance(current_credit_raw, float):
-                    current_credit = int(current_credit_raw)
-                elif isinstance(current_credit_raw, int):
-                    current_credit = current_credit_raw
-                else:
-                    try:
-                        current_credit = int(float(current_credit_raw))
-                    except (ValueError, TypeError):
-                        current_credit = 0
-                
-                new_credit = current_credit + credit_days
+                new_credit = self._grant_credit_once(
+                    payment_ref, user_id, payment_amount, credit_days, now,
+                    {'provider_data': stk, 'credit_days_added': credit_days},  # Store for audit
+                )
+                if new_credit is None:
+                    logger.warning("[mpesa_callback] ⚠️ Payment already processed concurrently. Skipping credit update.")
+                    return jsonify({'status': 'ok', 'message': 'already_processed'}), 200
                 
-                print(f"[mpesa_callback] Credit calculation: current={current_credit}, adding={credit_days}, new={new_credit}")
-                
-                # Update monthly spend
-                now = datetime.datetime.now(datetime.timezone.utc)
-                month_key = now.strftime('%Y-%m')
-                monthly = user_data.get('monthly_paid', {}) or {}
-                month_spend = float(monthly.get(month_key, 0))
-                month_spend += payment_amount
-                monthly[month_key] = month_spend
-                
-                # Update user with credit and payment info
-                # Store credit_balance as integer to match app expectations
-                now_iso = datetime.datetime.now(datetime.timezone.utc).isoformat()
-                update_data = {
-                    'credit_balance': int(new_credit),  # Store as integer
-                    'total_payments': float(user_data.get('total_payments', 0)) + payment_amount,
-                    'monthly_paid': monthly,
-                    'last_payment_date': now_iso,  # Prevent credit deduction on payment day
-                    'updated_at': now_iso,
-                }
-                
-                print(f"[mpesa_callback] Updating user with: {update_data}")
-                user_ref.update(update_data)
-                
-                # Mark payment complete AFTER updating credits
-                payment_ref.update({
-                    'status': 'completed',
-                    'provider_data': stk,
-                    'completed_at': now_iso,
-                    'credit_days_added': credit_days,  # Store for audit
-                })
-                
-                print(f"[mpesa_callback] ✅ Payment completed: user_id={user_id}, amount={payment_amount}, credit_days={credit_days}, new_credit={new_credit}")
-                
-                # Verify the update was successful
-                updated_user_data = user_ref.get() or {}
-                verified_credit = updated_user_data.get('credit_balance')
-                print(f"[mpesa_callback] ✅ Verified update - credit_balance: {verified_credit} (expected: {new_credit})")
-                
-                if verified_credit != new_credit:
-                    print(f"[mpesa_callback] ⚠️ WARNING: Credit balance mismatch! Expected {new_credit}, got {verified_credit}")
+                logger.info("[mpesa_callback] ✅ Payment completed: user_id=%s, amount=%s, credit_days=%s, new_credit=%s", user_id, payment_amount, credit_days, new_credit)
                 
                 return jsonify({'status': 'ok'})
             else:
-                print(f"[mpesa_callback] ❌ Payment failed (ResultCode: {result_code})")
+                logger.error("[mpesa_callback] ❌ Payment failed (ResultCode: %s)", result_code)
                 failure_update = {
                     'status': 'failed',
                     'provider_data': stk,
-                    'completed_at': datetime.datetime.now().isoformat(),
+                    'completed_at': now_iso,
                 }
                 if result_desc:
                     failure_update['failure_reason'] = result_desc
                 payment_ref.update(failure_update)
                 return jsonify({'status': 'failed', 'result_code': result_code, 'result_desc': result_desc})
         except Exception as e:
-            print(f"[mpesa_callback] ❌ Exception: {type(e).__name__}: {str(e)}")
-            import traceback
-            print(f"[mpesa_callback] Traceback: {traceback.format_exc()}")
+            logger.exception("[mpesa_callback] ❌ Exception: %s: %s", type(e).__name__, str(e))
             return jsonify({'status': 'error', 'message': str(e)}), 200
 
@@ -1,5 +1,6 @@
 """Stripe payment controller."""
 import datetime
+import traceback
 import uuid
 from flask import request, jsonify, current_app
 from controllers.subscription_controller import require_auth
@@ -87,7 +88,6 @@ class StripeController:
             }), 200
             
         except Exception as e:
-            import traceback
             print(f"[stripe_create_intent] ERROR: {e}")
             traceback.print_exc()
             return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
@@ -215,7 +215,6 @@ class StripeController:
             }), 200
             
         except Exception as e:
-            import traceback
             print(f"[stripe_confirm] ERROR: {e}")
             traceback.print_exc()
             return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
@@ -336,7 +335,6 @@ class StripeController:
             }), 200
             
         except Exception as e:
-            import traceback
             print(f"[stripe_charge_card] ERROR: {e}")
             traceback.print_exc()
             return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
@@ -448,7 +446,6 @@ class StripeController:
             return jsonify({'received': True}), 200
             
         except Exception as e:
-            import traceback
             print(f"[stripe_webhook] ERROR: {e}")
             traceback.print_exc()
             return jsonify({'error': 'Webhook processing failed', 'message': str(e)}), 500
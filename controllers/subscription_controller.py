@@ -1,89 +1,65 @@
 """Subscription controller for managing user credits and usage."""
 import datetime
+import logging
 import uuid
 from flask import request, jsonify, current_app
 from functools import wraps
 from firebase_admin import auth
 
+from config import Config
+from core import auth_cache, background, db_refs
+
+logger = logging.getLogger(__name__)
+
 
 def require_auth(f):
     """Decorator to require Firebase authentication."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
+        # CORS preflights carry no credentials; answer them without auth work
+        if request.method == 'OPTIONS':
+            return '', 204
         try:
             db = current_app.config.get('DB')
             if db is None:
-                print("[Auth] ❌ DB not configured; auth unavailable")
+                logger.error("[Auth] ❌ DB not configured; auth unavailable")
                 return jsonify({'error': 'Authentication service unavailable'}), 503
             
             auth_header = request.headers.get('Authorization')
-            print(f"[Auth] Checking authentication for {request.path}")
-            print(f"[Auth] Authorization header present: {bool(auth_header)}")
+            logger.debug("[Auth] Checking authentication for %s", request.path)
+            logger.debug("[Auth] Authorization header present: %s", bool(auth_header))
             if not auth_header or not auth_header.startswith('Bearer '):
                 # Allow unauth testing when enabled
                 cfg = current_app.config.get('CONFIG')
                 if getattr(cfg, 'ALLOW_UNAUTH_TEST', False):
                     test_user = request.args.get('user_id') or (request.json or {}).get('user_id') if request.is_json else None
                     if test_user:
-                        print(f"[Auth] ALLOW_UNAUTH_TEST enabled, using test user_id={test_user}")
+                        logger.info("[Auth] ALLOW_UNAUTH_TEST enabled, using test user_id=%s", test_user)
                         request.user_id = test_user
                         return f(*args, **kwargs)
-                print("[Auth] ❌ No Bearer token provided")
+                logger.warning("[Auth] ⚠️ No Bearer token provided")
                 return jsonify({'error': 'No token provided'}), 401
             
-            token = auth_header.split('Bearer ')[1]
+            token = auth_header[7:].strip()
+            cached_uid = auth_cache.get_uid(token)
+            if cached_uid:
+                request.user_id = cached_uid
+                return f(*args, **kwargs)
             try:
-                print(f"[Auth] Attempting to verify Firebase ID token...")
-                decoded_token = auth.verify_id_token(token)
+                logger.debug("[Auth] Attempting to verify Firebase ID token...")
+                decoded_token = auth.verify_id_token(token, clock_skew_seconds=Config.AUTH_CLOCK_SKEW_SECONDS)
+                auth_cache.remember(token, decoded_token)
                 request.user_id = decoded_token['uid']
-                print(f"[Auth] ✅ Token verified successfully, User ID: {request.user_id}")
+                logger.info("[Auth] ✅ Token verified successfully, User ID: %s", request.user_id)
                 return f(*args, **kwargs)
             except Exception as e:
                 error_str = str(e)
                 error_type = type(e).__name__
-                print(f"[Auth] ❌ Firebase token verification failed: {error_type}: {error_str}")
-                
-                # Handle clock skew errors (token used too early/late)
-                # For small clock skews (1-5 seconds), wait and retry
-                if 'clock' in error_str.lower() or 'too early' in error_str.lower() or 'too late' in error_str.lower():
-                    print(f"[Auth] ⚠️ Clock skew detected, checking time difference...")
-                    import re
-                    time_match = re.search(r'(\d+) < (\d+)', error_str)
-                    if time_match:
-                        token_time = int(time_match.group(1))
-                        server_time = int(time_match.group(2))
-                        diff = abs(server_time - token_time)
-                        print(f"[Auth] ⚠️ Time difference: {diff} seconds (token_time={token_time}, server_time={server_time})")
-                        
-                        if diff <= 5:  # Allow up to 5 seconds difference
-                            print(f"[Auth] ⚠️ Small clock skew ({diff}s) detected, waiting {diff + 1} seconds and retrying...")
-                            import time as time_module
-                            time_module.sleep(diff + 1)  # Wait for the time difference + 1 second buffer
-                            try:
-                                print(f"[Auth] Retrying token verification after delay...")
-                                decoded_token = auth.verify_id_token(token)
-                                request.user_id = decoded_token['uid']
-                                print(f"[Auth] ✅ Token verified after delay, User ID: {request.user_id}")
-                                return f(*args, **kwargs)
-                            except Exception as retry_error:
-                                print(f"[Auth] ❌ Retry after delay also failed: {retry_error}")
-                        else:
-                            print(f"[Auth] ❌ Clock skew too large ({diff}s), rejecting token")
-                    else:
-                        print(f"[Auth] ⚠️ Clock skew detected but couldn't parse time difference, waiting 2 seconds and retrying...")
-                        import time as time_module
-                        time_module.sleep(2)
-                        try:
-                            decoded_token = auth.verify_id_token(token)
-                            request.user_id = decoded_token['uid']
-                            print(f"[Auth] ✅ Token verified after delay, User ID: {request.user_id}")
-                            return f(*args, **kwargs)
-                        except Exception as retry_error:
-                            print(f"[Auth] ❌ Retry after delay failed: {retry_error}")
+                logger.warning("[Auth] ⚠️ Firebase token verification failed: %s: %s", error_type, error_str)
                 
                 return jsonify({'error': 'Invalid Firebase token', 'details': error_str}), 401
         except Exception as e:
-            print(f"[Auth] ❌ Authentication service error: {e}")
+            logger.error("[Auth] ❌ Authentication service error: %s", e)
             return jsonify({'error': 'Authentication service error'}), 500
     
     return decorated_function
@@ -97,7 +73,7 @@ def check_credit_required(f):
         config = current_app.config.get('CONFIG')
         user_id = request.user_id
         
-        user_ref = db.reference(f'registeredUser/{user_id}')
+        user_ref = db_refs.user_ref(db, user_id)
         user_data = user_ref.get()
         
         if not user_data:
@@ -129,6 +105,10 @@ def check_credit_required(f):
     return decorated_function
 
 
+class _NoDeduction(Exception):
+    """Raised inside the usage transaction to abort it without writing."""
+
+
 class SubscriptionController:
     """Controller for subscription and credit operations."""
     
@@ -139,10 +119,10 @@ class SubscriptionController:
     def get_credit_info(self):
         """Get user's credit information."""
         user_id = request.user_id
-        print(f"[get_credit_info] User ID: {user_id}")
-        user_ref = self.db.reference(f'registeredUser/{user_id}')
+        logger.info("[get_credit_info] User ID: %s", user_id)
+        user_ref = db_refs.user_ref(self.db, user_id)
         user_data = user_ref.get()
-        print(f"[get_credit_info] User data: {user_data}")
+        logger.debug("[get_credit_info] User data: %s", user_data)
         
         current_time = datetime.datetime.now(datetime.timezone.utc)
         
@@ -162,7 +142,7 @@ class SubscriptionController:
                 }
                 
                 user_ref.set(user_data)
-                print(f"[get_credit_info] New user {user_id} registered with fresh trial starting {current_time.isoformat()}")
+                logger.info("[get_credit_info] New user %s registered with fresh trial starting %s", user_id, current_time.isoformat())
             except Exception as e:
                 return jsonify({'error': f'Failed to create user: {str(e)}'}), 500
         
@@ -174,7 +154,7 @@ class SubscriptionController:
         # Always reset if user doesn't have registration_date (old users from export)
         if not registration_date_str:
             should_reset = True
-            print(f"[get_credit_info] User {user_id} missing registration_date - resetting for fresh trial")
+            logger.info("[get_credit_info] User %s missing registration_date - resetting for fresh trial", user_id)
         
         # Also reset if RESET_USERS_ON_LOGIN is enabled (for all existing users)
         elif getattr(self.config, 'RESET_USERS_ON_LOGIN', False):
@@ -183,7 +163,7 @@ class SubscriptionController:
             if not trial_reset_date_str:
                 # User hasn't been reset yet in this cycle, reset them now
                 should_reset = True
-                print(f"[get_credit_info] User {user_id} needs reset (RESET_USERS_ON_LOGIN enabled)")
+                logger.info("[get_credit_info] User %s needs reset (RESET_USERS_ON_LOGIN enabled)", user_id)
             else:
                 # Check if reset was before the current reset date threshold
                 try:
@@ -192,14 +172,14 @@ class SubscriptionController:
                     days_since_reset = (current_time - reset_date).days
                     if days_since_reset >= self.config.FREE_TRIAL_DAYS:
                         should_reset = True
-                        print(f"[get_credit_info] User {user_id} trial expired ({days_since_reset} days ago) - resetting")
+                        logger.info("[get_credit_info] User %s trial expired (%s days ago) - resetting", user_id, days_since_reset)
                 except Exception as e:
-                    print(f"[get_credit_info] Error parsing trial_reset_date: {e}")
+                    logger.warning("[get_credit_info] Error parsing trial_reset_date: %s", e)
                     should_reset = True  # Reset if we can't parse the date
         
         # Reset user for fresh trial if needed
         if should_reset:
-            print(f"[get_credit_info] 🔄 Resetting user {user_id} for fresh 14-day trial")
+            logger.info("[get_credit_info] 🔄 Resetting user %s for fresh 14-day trial", user_id)
             reset_time = datetime.datetime.now(datetime.timezone.utc)
             
             # Reset trial-related fields but keep payment history and user info
@@ -215,7 +195,7 @@ class SubscriptionController:
             
             user_ref.update(update_data)
             user_data.update(update_data)
-            print(f"[get_credit_info] ✅ User {user_id} reset successfully. Fresh trial starts: {reset_time.isoformat()}")
+            logger.info("[get_credit_info] ✅ User %s reset successfully. Fresh trial starts: %s", user_id, reset_time.isoformat())
         
         registration_date_str = user_data.get('registration_date')
         
@@ -247,83 +227,107 @@ class SubscriptionController:
                 'max_top_up_kes': self.config.MONTHLY_CAP_KES * max_prepay_months
             }
         }
-        print(f"[get_credit_info] Response: credit_balance={credit_balance}, is_in_trial={is_in_trial}, trial_days_remaining={trial_days_remaining}")
+        logger.info("[get_credit_info] Response: credit_balance=%s, is_in_trial=%s, trial_days_remaining=%s", credit_balance, is_in_trial, trial_days_remaining)
         return jsonify(response_data)
     
-    def record_usage(self):
-        """Record app usage and deduct credit."""
-        user_id = request.user_id
-        usage_data = request.json
-        action_type = usage_data.get('action_type')
-        
-        user_ref = self.db.reference(f'registeredUser/{user_id}')
-        user_data = user_ref.get()
+    def _in_free_trial(self, user_data, now):
+        """Return True while the user's free trial is still running."""
+        registration_date_str = user_data.get('registration_date')
+        if not registration_date_str or getattr(self.config, 'FORCE_TRIAL_END', False):
+            return False
+        registration_date = datetime.datetime.fromisoformat(
+            registration_date_str.replace('Z', '+00:00')
+        )
+        return now < registration_date + datetime.timedelta(days=self.config.FREE_TRIAL_DAYS)
+    
+    def _should_deduct_credit(self, user_data, current_date, month_key, charged_days_cap):
+        """Decide whether this usage is a new chargeable day for the user."""
+        current_date_only = current_date.date()
         
-        current_date = datetime.datetime.now(datetime.timezone.utc)
+        # Only the first usage of a day is chargeable
         last_usage_date_str = user_data.get('last_usage_date')
-        last_payment_date_str = user_data.get('last_payment_date')
-        
-        # Check if this is a new day of usage
-        should_deduct_credit = False
-        if not last_usage_date_str:
-            should_deduct_credit = True
-        else:
+        if last_usage_date_str:
             last_usage_date = datetime.datetime.fromisoformat(
                 last_usage_date_str.replace('Z', '+00:00')
             )
-            last_usage_date_only = last_usage_date.date()
-            current_date_only = current_date.date()
-            if current_date_only > last_usage_date_only:
-                should_deduct_credit = True
+            if current_date_only <= last_usage_date.date():
+                return False
         
         # Prevent credit deduction if payment was made today
+        last_payment_date_str = user_data.get('last_payment_date')
         if last_payment_date_str:
             last_payment_date = datetime.datetime.fromisoformat(
                 last_payment_date_str.replace('Z', '+00:00')
             )
-            last_payment_date_only = last_payment_date.date()
-            if current_date_only == last_payment_date_only:
-                should_deduct_credit = False
+            if current_date_only == last_payment_date.date():
+                return False
         
         # Enforce monthly cap on chargeable usage
-        charged_days_cap = int(self.config.MONTHLY_CAP_KES / self.config.DAILY_RATE)
-        month_key = current_date.strftime('%Y-%m')
         monthly_charged = int((user_data.get('monthly_charged_days') or {}).get(month_key, 0))
+        if monthly_charged >= charged_days_cap:
+            return False
         
-        if should_deduct_credit and monthly_charged >= charged_days_cap:
-            should_deduct_credit = False
+        # Trial users are not charged and balances never go negative
+        if self._in_free_trial(user_data, current_date):
+            return False
+        return user_data.get('credit_balance', 0) > 0
+    
+    def record_usage(self):
+        """Record app usage and deduct credit."""
+        user_id = request.user_id
+        usage_data = request.json
+        action_type = usage_data.get('action_type')
         
-        if should_deduct_credit:
-            # Deduct one day of credit
-            current_credit = user_data.get('credit_balance', 0)
-            new_credit = current_credit - 1
-            
-            user_ref.update({
-                'credit_balance': new_credit,
-                'last_usage_date': current_date.isoformat()
-            })
-            
-            # Record usage
-            usage_id = str(uuid.uuid4())
-            usage_info = {
-                'usage_id': usage_id,
-                'user_id': user_id,
-                'action_type': action_type,
-                'credit_deducted': 1,
-                'remaining_credit': new_credit,
-                'timestamp': current_date.isoformat()
-            }
-            
-            self.db.reference(f'usage_logs/{usage_id}').set(usage_info)
-            
+        user_ref = db_refs.user_ref(self.db, user_id)
+        current_date = datetime.datetime.now(datetime.timezone.utc)
+        now_iso = current_date.isoformat()
+        month_key = current_date.strftime('%Y-%m')
+        charged_days_cap = int(self.config.MONTHLY_CAP_KES / self.config.DAILY_RATE)
+        seen = {}
+        
+        def _deduct(user_data):
+            # Runs inside an RTDB transaction and may be retried on contention;
+            # raising _NoDeduction aborts without writing anything.
+            seen['user_data'] = user_data or {}
+            if not user_data or not self._should_deduct_credit(
+                user_data, current_date, month_key, charged_days_cap
+            ):
+                raise _NoDeduction()
+            user_data['credit_balance'] = user_data.get('credit_balance', 0) - 1
+            user_data['last_usage_date'] = now_iso
             # Track charged day for monthly cap accounting
-            monthly = user_data.get('monthly_charged_days', {})
-            monthly[month_key] = monthly_charged + 1
-            user_ref.update({'monthly_charged_days': monthly})
+            monthly = user_data.get('monthly_charged_days') or {}
+            monthly[month_key] = int(monthly.get(month_key, 0)) + 1
+            user_data['monthly_charged_days'] = monthly
+            return user_data
+        
+        try:
+            updated = user_ref.transaction(_deduct)
+        except _NoDeduction:
+            return jsonify({
+                'message': 'Usage recorded',
+                'credit_deducted': 0,
+                'remaining_credit': seen.get('user_data', {}).get('credit_balance', 0)
+            })
+        
+        new_credit = updated.get('credit_balance', 0)
+        
+        # Record usage
+        usage_id = str(uuid.uuid4())
+        usage_info = {
+            'usage_id': usage_id,
+            'user_id': user_id,
+            'action_type': action_type,
+            'credit_deducted': 1,
+            'remaining_credit': new_credit,
+            'timestamp': now_iso
+        }
+        
+        # Audit log only; the response does not wait for it
+        background.submit(self.db.reference(f'usage_logs/{usage_id}').set, usage_info)
         
         return jsonify({
             'message': 'Usage recorded',
-            'credit_deducted': 1 if should_deduct_credit else 0,
-            'remaining_credit': user_data.get('credit_balance', 0) - (1 if should_deduct_credit else 0)
+            'credit_deducted': 1,
+            'remaining_credit': new_credit
         })
-
@@ -1,33 +1,38 @@
 """Unified Checkout controller for both card and Google Pay payments."""
 import datetime
 import json
+import traceback
 import uuid
 from flask import request, jsonify, current_app
 from controllers.subscription_controller import require_auth
 from services.cybersource_helper_client import CyberSourceHelperError
 from services.exchange_rate_service import convert_amount_to_kes, compute_credit_days_from_kes
+from core import db_refs, user_credit
+
+# Helper statuses that mark a Unified Checkout charge as completed
+_COMPLETED_STATUSES = frozenset({'AUTHORIZED', 'CAPTURED', 'PENDING', 'SETTLED'})
 
 
 @require_auth
 def unified_checkout_capture_context():
     """Create a Unified Checkout capture context for both card and Google Pay."""
-    import traceback
     try:
         print(f"[UC:CAPTURE_CONTEXT] ========== STEP 1: REQUEST RECEIVED ==========")
         print(f"[UC:CAPTURE_CONTEXT] Timestamp: {datetime.datetime.now(datetime.timezone.utc).isoformat()}")
         print(f"[UC:CAPTURE_CONTEXT] Request method: {request.method}")
         print(f"[UC:CAPTURE_CONTEXT] Request headers: {dict(request.headers)}")
         
-        raw_payload = request.get_json(silent=True) or {}
-        print(f"[UC:CAPTURE_CONTEXT] 🔍 STEP 2: Parsing request payload")
-        print(f"[UC:CAPTURE_CONTEXT] Raw payload keys: {list(raw_payload.keys())}")
-        print(f"[UC:CAPTURE_CONTEXT] Raw payload: {json.dumps(raw_payload, indent=2)}")
-        
+        # Bail out before parsing/logging the body if the helper is missing
         helper_client = current_app.config.get('cybersource_helper')
         if not helper_client:
             print(f"[UC:CAPTURE_CONTEXT] ❌ ERROR: CyberSource helper not configured")
             return jsonify({'error': 'CyberSource helper not configured'}), 503
-        print(f"[UC:CAPTURE_CONTEXT] ✅ STEP 3: Helper client available")
+        print(f"[UC:CAPTURE_CONTEXT] ✅ STEP 2: Helper client available")
+        
+        raw_payload = request.get_json(silent=True) or {}
+        print(f"[UC:CAPTURE_CONTEXT] 🔍 STEP 3: Parsing request payload")
+        print(f"[UC:CAPTURE_CONTEXT] Raw payload keys: {list(raw_payload.keys())}")
+        print(f"[UC:CAPTURE_CONTEXT] Raw payload: {json.dumps(raw_payload, indent=2)}")
 
         data = raw_payload
         # Derive default origin from BASE_URL
@@ -71,7 +76,7 @@ def unified_checkout_capture_context():
             try:
                 db = current_app.config.get('DB')
                 if db:
-                    user_ref = db.reference(f'registeredUser/{user_id}')
+                    user_ref = db_refs.user_ref(db, user_id)
                     user_data = user_ref.get() or {}
                     billing_info = _build_billing_info(user_data)
                     print(f"[UC:CAPTURE_CONTEXT]   - Billing info loaded for pre-fill: {bool(billing_info)}")
@@ -192,7 +197,6 @@ def unified_checkout_capture_context():
             'status_code': helper_err.status_code,
         }), helper_err.status_code or 500
     except Exception as e:
-        import traceback
         print(f"[UC:CAPTURE_CONTEXT] ❌ STEP X: Unexpected error occurred")
         print(f"[UC:CAPTURE_CONTEXT] Error type: {type(e).__name__}")
         print(f"[UC:CAPTURE_CONTEXT] Error message: {str(e)}")
@@ -205,7 +209,6 @@ def unified_checkout_capture_context():
 @require_auth
 def unified_checkout_charge():
     """Charge a payment using Unified Checkout transient token (for both card and Google Pay)."""
-    import traceback
     try:
         print(f"[UC:CHARGE] ========== STEP 1: CHARGE REQUEST RECEIVED ==========")
         print(f"[UC:CHARGE] Timestamp: {datetime.datetime.now(datetime.timezone.utc).isoformat()}")
@@ -286,7 +289,7 @@ def unified_checkout_charge():
         print(f"[UC:CHARGE] ✅ STEP 7: Loading user data from Firebase")
         if user_id:
             try:
-                user_ref = db.reference(f'registeredUser/{user_id}')
+                user_ref = db_refs.user_ref(db, user_id)
                 user_data = user_ref.get() or {}
                 print(f"[UC:CHARGE]   - User data loaded: {bool(user_data)}")
                 print(f"[UC:CHARGE]   - User data keys: {list(user_data.keys()) if user_data else []}")
@@ -294,7 +297,6 @@ def unified_checkout_charge():
                 print(f"[UC:CHARGE]   - Billing info from user data: {json.dumps(billing_info, indent=2)}")
             except Exception as err:
                 print(f"[UC:CHARGE] ⚠️ WARNING: Unable to load user profile: {err}")
-                import traceback
                 traceback.print_exc()
         
         # Merge client-provided billing info
@@ -434,34 +436,22 @@ def unified_checkout_charge():
         now_iso = datetime.datetime.now(datetime.timezone.utc).isoformat()
         print(f"[UC:CHARGE] ✅ STEP 18: Updating user credit in Firebase")
         try:
-            registered_user_ref = db.reference(f'registeredUser/{user_id}')
-            user_data = registered_user_ref.get() or {}
-            current_credit = int(float(user_data.get('credit_balance', 0) or 0))
-            print(f"[UC:CHARGE]   - Current credit: {current_credit} days")
-            
-            # Monthly spend tracking
+            # Monthly spend tracking (KES); credit, totals and month are
+            # updated atomically in one transaction
             month_key = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m')
-            monthly = user_data.get('monthly_paid', {}) or {}
-            monthly[month_key] = float(monthly.get(month_key, 0) or 0) + float(amount_in_kes)
-            
-            new_credit = current_credit + credit_days
-            print(f"[UC:CHARGE]   - New credit: {new_credit} days")
-            registered_user_ref.update({
-                'credit_balance': int(new_credit),
-                'total_payments': float(user_data.get('total_payments', 0) or 0) + float(amount),
-                'monthly_paid': monthly,
-                'last_payment_date': now_iso,
-                'updated_at': now_iso,
-            })
-            print(f"[UC:CHARGE] ✅ User credit updated: {current_credit} -> {new_credit} days")
+            updated_user = user_credit.credit_user(
+                db, user_id, credit_days, float(amount), now_iso,
+                month_key=month_key, month_kes=float(amount_in_kes),
+            )
+            new_credit = updated_user['credit_balance']
+            print(f"[UC:CHARGE] ✅ User credit updated: +{credit_days} -> {new_credit} days")
         except Exception as ue:
             print(f"[UC:CHARGE] ⚠️ WARNING: User credit update error: {ue}")
-            import traceback
             traceback.print_exc()
         
         # Update payment record
         print(f"[UC:CHARGE] ✅ STEP 19: Updating payment record status to 'completed'")
-        final_status = 'completed' if status in ['AUTHORIZED', 'CAPTURED', 'PENDING', 'SETTLED'] else status.lower() or 'completed'
+        final_status = 'completed' if status in _COMPLETED_STATUSES else status.lower() or 'completed'
         print(f"[UC:CHARGE]   - Final status: {final_status}")
         db.reference(f'payments/{user_id}/{payment_id}').update({
             'status': final_status,
@@ -486,7 +476,6 @@ def unified_checkout_charge():
         return jsonify(final_response), 200
         
     except Exception as e:
-        import traceback
         print(f"[UC:CHARGE] ❌ STEP X: Unexpected error occurred")
         print(f"[UC:CHARGE] Error type: {type(e).__name__}")
         print(f"[UC:CHARGE] Error message: {str(e)}")
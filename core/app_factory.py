@@ -1,11 +1,13 @@
 from flask import Flask
 from flask_cors import CORS
 
+from core.json_provider import OrjsonProvider, orjson
+
 
 def create_app(config_object) -> Flask:
     app = Flask(__name__)
     app.config.from_object(config_object)
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
     CORS(app)
     return app
-
-
@@ -0,0 +1,55 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from config import Config
+
+# Verified Firebase ID tokens, keyed by a digest so raw tokens are never
+# held in memory: digest -> (uid, expires_at). Entries never outlive the
+# token's own exp claim.
+_MAX_ENTRIES = 10_000
+_TTL_SECONDS = Config.AUTH_CACHE_TTL
+# Stop serving a token this long before it expires so the downstream
+# handler never runs with a token that lapses mid-request
+_EXPIRY_MARGIN_SECONDS = 60
+
+_lock = threading.Lock()
+_cache: 'OrderedDict[bytes, tuple]' = OrderedDict()
+
+
+def _key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode('utf-8'), digest_size=16).digest()
+
+
+def get_uid(token: str) -> Optional[str]:
+    """Return the uid for a previously verified, still-valid token."""
+    key = _key(token)
+    with _lock:
+        entry = _cache.get(key)
+        if entry is None:
+            return None
+        uid, expires_at = entry
+        if expires_at <= time.time():
+            del _cache[key]
+            return None
+        _cache.move_to_end(key)
+        return uid
+
+
+def remember(token: str, decoded_token: dict) -> None:
+    """Cache a verified token until min(exp - margin, now + TTL)."""
+    now = time.time()
+    expires_at = min(
+        float(decoded_token.get('exp', now)) - _EXPIRY_MARGIN_SECONDS,
+        now + _TTL_SECONDS,
+    )
+    if expires_at <= now:
+        return
+    key = _key(token)
+    with _lock:
+        _cache[key] = (decoded_token['uid'], expires_at)
+        _cache.move_to_end(key)
+        while len(_cache) > _MAX_ENTRIES:
+            _cache.popitem(last=False)
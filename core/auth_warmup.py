@@ -0,0 +1,76 @@
+import logging
+import os
+import re
+import threading
+import time
+
+import firebase_admin
+from firebase_admin import auth
+from firebase_admin._token_gen import ID_TOKEN_CERT_URI
+
+logger = logging.getLogger(__name__)
+
+# Re-fetch the certs this long before Google's max-age runs out, so
+# verify_id_token() never finds the cached copy stale
+_REFRESH_MARGIN_SECONDS = 300
+_MIN_REFRESH_SECONDS = 60
+_DEFAULT_MAX_AGE_SECONDS = 3600
+_MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
+# pid of the process that started the refresher; forked workers do not inherit it
+_started_pid = None
+_started_lock = threading.Lock()
+
+
+def _fetch_certs(force: bool = False) -> int:
+    """Fetch the ID token certs into the SDK's session cache; returns max-age.
+
+    verify_id_token() fetches these through a cache-control aware session
+    owned by the auth client, so requesting them here means real verifies
+    are served from that cache instead of the network. force bypasses the
+    cache so a still-fresh copy is replaced before it expires.
+    """
+    verifier = auth._get_client(None)._token_verifier
+    headers = {'Cache-Control': 'no-cache'} if force else None
+    response = verifier.request(ID_TOKEN_CERT_URI, method='GET', headers=headers)
+    match = _MAX_AGE_RE.search(response.headers.get('cache-control', ''))
+    return int(match.group(1)) if match else _DEFAULT_MAX_AGE_SECONDS
+
+
+def warm_token_certs() -> int:
+    """Prefetch the certs once; returns seconds until the next refresh."""
+    try:
+        max_age = _fetch_certs()
+        logger.info("[auth_warmup] ✅ Firebase ID token certs cached (max-age %ss)", max_age)
+        return max(_MIN_REFRESH_SECONDS, max_age - _REFRESH_MARGIN_SECONDS)
+    except Exception as e:
+        logger.warning("[auth_warmup] ⚠️ Could not prefetch ID token certs: %s", e)
+        return _MIN_REFRESH_SECONDS
+
+
+def _refresh_loop() -> None:
+    delay = warm_token_certs()
+    while True:
+        time.sleep(delay)
+        try:
+            max_age = _fetch_certs(force=True)
+            logger.debug("[auth_warmup] ID token certs refreshed (max-age %ss)", max_age)
+            delay = max(_MIN_REFRESH_SECONDS, max_age - _REFRESH_MARGIN_SECONDS)
+        except Exception as e:
+            logger.warning("[auth_warmup] ⚠️ ID token cert refresh failed: %s", e)
+            delay = _MIN_REFRESH_SECONDS
+
+
+def start() -> None:
+    """Warm and keep refreshing the cert cache on a daemon thread (once per process)."""
+    global _started_pid
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        # Firebase is not initialized (mock DB); nothing to warm
+        return
+    with _started_lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+    threading.Thread(target=_refresh_loop, name='auth-certs', daemon=True).start()
@@ -0,0 +1,65 @@
+import atexit
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+logger = logging.getLogger(__name__)
+
+# Shared pool for writes the HTTP response does not need to wait for
+# (audit logs and similar). Threads are spawned lazily on first submit,
+# so each gunicorn worker gets its own after fork.
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='bg-write')
+atexit.register(_executor.shutdown, wait=True)
+
+# Separate pool for longer jobs that make several round trips (webhook
+# processing), so a burst of them never queues ahead of the short writes
+# request handlers settle() on
+_job_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='bg-job')
+atexit.register(_job_executor.shutdown, wait=True)
+
+# Longest a request handler waits in settle() for one of its writes
+_SETTLE_TIMEOUT_SECONDS = 5.0
+
+
+def _run(fn, args, kwargs):
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        logger.exception("Background task %s failed", getattr(fn, '__qualname__', fn))
+        raise
+
+
+def submit(fn, *args, **kwargs) -> Future:
+    """Run fn(*args, **kwargs) on the shared background write pool."""
+    future = _executor.submit(_run, fn, args, kwargs)
+    # Kept so settle() can run the call inline if it is still queued
+    future._bg_call = (fn, args, kwargs)
+    return future
+
+
+def submit_job(fn, *args, **kwargs) -> Future:
+    """Run a longer fn(*args, **kwargs) on the job pool."""
+    return _job_executor.submit(_run, fn, args, kwargs)
+
+
+def settle(future: Future, timeout: float = _SETTLE_TIMEOUT_SECONDS) -> None:
+    """Wait up to timeout for a submitted write; its failure is already logged.
+
+    If it is still queued when the timeout expires it is cancelled and run
+    inline, so it cannot land after the caller's own later writes. One that
+    is already running is left to finish.
+    """
+    try:
+        future.result(timeout=timeout)
+    except TimeoutError:
+        call = getattr(future, '_bg_call', None)
+        if call is not None and future.cancel():
+            logger.warning("Background write still queued after %ss; running it inline", timeout)
+            fn, args, kwargs = call
+            try:
+                _run(fn, args, kwargs)
+            except Exception:
+                pass
+        else:
+            logger.warning("Background write still running after %ss; not waiting for it", timeout)
+    except Exception:
+        pass
@@ -0,0 +1,26 @@
+from flask import g, has_app_context
+
+
+def _cached_ref(db, path: str):
+    """Return db.reference(path), reused for the rest of the current request."""
+    if not has_app_context():
+        return db.reference(path)
+    refs = g.setdefault('_db_refs', {})
+    # Keyed by the db handle too, so two databases never share a reference
+    key = (id(db), path)
+    ref = refs.get(key)
+    if ref is None:
+        ref = refs[key] = db.reference(path)
+    return ref
+
+
+def user_ref(db, user_id: str):
+    return _cached_ref(db, f'registeredUser/{user_id}')
+
+
+def payment_ref(db, payment_id: str):
+    return _cached_ref(db, f'payments/{payment_id}')
+
+
+def user_payment_ref(db, user_id: str, payment_id: str):
+    return _cached_ref(db, f'payments/{user_id}/{payment_id}')
@@ -1,14 +1,51 @@
+import atexit
 import logging
+import os
+import queue
 import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, Union
 
+# Request threads only enqueue records; formatting and the stdout write
+# happen on the listener thread
+_queue_handler: Optional[QueueHandler] = None
+_listener: Optional[QueueListener] = None
+
+
+def _start_listener(handler: logging.Handler) -> None:
+    global _listener
+    log_queue = queue.SimpleQueue()
+    _queue_handler.queue = log_queue
+    _listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_listener_after_fork() -> None:
+    # The listener thread does not survive fork (gunicorn preload_app); give
+    # the child its own queue and thread so its records are not stranded
+    if _listener is not None:
+        _start_listener(_listener.handlers[0])
+
+
+def _stop_listener() -> None:
+    if _listener is not None:
+        _listener.stop()
+
+
+def init_logging(level: Union[int, str] = logging.INFO) -> None:
+    global _queue_handler
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+        if not isinstance(level, int):
+            level = logging.INFO
 
-def init_logging(level: int = logging.INFO) -> None:
     logger = logging.getLogger()
     logger.setLevel(level)
 
     # Clear default handlers
     for h in list(logger.handlers):
         logger.removeHandler(h)
+    _stop_listener()
 
     handler = logging.StreamHandler(sys.stdout)
     formatter = logging.Formatter(
@@ -16,6 +53,14 @@ def init_logging(level: int = logging.INFO) -> None:
         datefmt='%Y-%m-%dT%H:%M:%S%z'
     )
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
 
+    first_init = _queue_handler is None
+    if first_init:
+        _queue_handler = QueueHandler(queue.SimpleQueue())
+    _start_listener(handler)
+    logger.addHandler(_queue_handler)
 
+    if first_init:
+        # Stop (and drain) the listener at exit so buffered records are written
+        atexit.register(_stop_listener)
+        os.register_at_fork(after_in_child=_restart_listener_after_fork)
@@ -0,0 +1,44 @@
+from core import db_refs
+
+
+def as_float(data, key):
+    """data[key] as a number; 0.0 when missing or empty.
+
+    Numbers (what RTDB hands back for values we wrote) are returned as-is;
+    only legacy string values go through float().
+    """
+    value = data.get(key)
+    if isinstance(value, (int, float)):
+        return value
+    return float(value) if value else 0.0
+
+
+def credit_user(db, user_id, credit_days, amount, now_iso, month_key=None, month_kes=0.0):
+    """Add paid credit days to a user in one RTDB transaction.
+
+    Returns the updated user node. amount is added to total_payments; when
+    month_key is given, month_kes is added to monthly_paid[month_key] in the
+    same transaction, so concurrent payments cannot overwrite each other.
+    """
+    amount = float(amount)
+    month_kes = float(month_kes)
+
+    def _credit(user_data):
+        user_data = user_data or {}
+        try:
+            current_credit = int(as_float(user_data, 'credit_balance'))
+        except (ValueError, TypeError):
+            current_credit = 0
+        user_data.update({
+            'credit_balance': current_credit + int(credit_days),
+            'total_payments': as_float(user_data, 'total_payments') + amount,
+            'last_payment_date': now_iso,
+            'updated_at': now_iso,
+        })
+        if month_key:
+            monthly = user_data.get('monthly_paid') or {}
+            monthly[month_key] = as_float(monthly, month_key) + month_kes
+            user_data['monthly_paid'] = monthly
+        return user_data
+
+    return db_refs.user_ref(db, user_id).transaction(_credit)
@@ -3,10 +3,20 @@ import os
 # Gunicorn configuration file
 bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
 workers = 1
-worker_class = "sync"
+# Threaded worker so one slow Firebase/CyberSource call does not block
+# every other request in the (single) worker process
+worker_class = "gthread"
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
 worker_connections = 1000
 timeout = 30
 keepalive = 2
 max_requests = 1000
 max_requests_jitter = 50
-preload_app = True 
\ No newline at end of file
+preload_app = True 
+
+
+def post_worker_init(worker):
+    # preload_app imports the app in the master; warm the ID token cert cache
+    # again in each worker so its first authenticated request does not fetch it
+    from core import auth_warmup
+    auth_warmup.start()
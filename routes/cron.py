@@ -143,3 +143,66 @@ def cron_all_notifications():
         logger.error(f"❌ Error in cron all notifications: {e}")
         return jsonify({'error': str(e)}), 500
 
+
+
+@bp.route('/webhooks/cybersource/replay', methods=['GET'])
+def cron_replay_cybersource_webhooks():
+    """Cron endpoint to re-apply CyberSource webhooks that never finished
+    
+    Usage with cron-jobs.org:
+    GET https://your-app.onrender.com/api/cron/webhooks/cybersource/replay?key=YOUR_SECRET_KEY
+    
+    Webhooks are acknowledged before they are applied, so events left
+    RECEIVED/FAILED (e.g. by a worker restart) are only applied by this sweep.
+    Processed markers older than CyberSource's 24h retry window are deleted.
+    
+    Schedule: Every 15 minutes
+    """
+    if not _check_cron_auth():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        from controllers.cybersource_controller import replay_unfinished_webhooks
+        results = replay_unfinished_webhooks()
+        
+        logger.info("✅ CyberSource webhook replay via cron: %s", results)
+        return jsonify({
+            'status': 'success',
+            'message': 'Webhook replay completed',
+            'results': results,
+            'timestamp': datetime.now().isoformat()
+        }), 200
+    except Exception as e:
+        logger.exception("❌ Error in cron webhook replay: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+@bp.route('/payments/cybersource/retry-credit', methods=['GET'])
+def cron_retry_uncredited_payments():
+    """Cron endpoint to credit card payments that were charged but not credited
+    
+    Usage with cron-jobs.org:
+    GET https://your-app.onrender.com/api/cron/payments/cybersource/retry-credit?key=YOUR_SECRET_KEY
+    
+    Payments whose credit transaction failed after the charge are left
+    PAID_UNCREDITED; this applies the credit and completes them.
+    
+    Schedule: Every 15 minutes
+    """
+    if not _check_cron_auth():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        from controllers.cybersource_controller import retry_uncredited_payments
+        results = retry_uncredited_payments()
+        
+        logger.info("✅ Uncredited card payment retry via cron: %s", results)
+        return jsonify({
+            'status': 'success',
+            'message': 'Credit retry completed',
+            'results': results,
+            'timestamp': datetime.now().isoformat()
+        }), 200
+    except Exception as e:
+        logger.exception("❌ Error in cron credit retry: %s", e)
+        return jsonify({'error': str(e)}), 500
@@ -1,17 +1,29 @@
 """CyberSource payment routes."""
-from flask import Blueprint, current_app, jsonify
+import json
+import traceback
+
+from flask import Blueprint, current_app, jsonify, request
 from controllers.cybersource_controller import (
     initiate_card_payment,
     handle_webhook,
     require_auth,
     create_subscription,
     check_payment_status,
+    get_cybersource_helper,
+    init_app as init_cybersource_controller,
 )
 from controllers.flex_controller import flex_charge
+from services.cybersource_helper_client import CyberSourceHelperError
 
 cybersource_bp = Blueprint("cybersource", __name__, url_prefix="/api/cybersource")
 
 
+@cybersource_bp.record_once
+def _bind_clients(state):
+    # app.py sets the clients in app.config before registering blueprints
+    init_cybersource_controller(state.app)
+
+
 # Card payment initiation (requires authentication)
 @cybersource_bp.route("/initiate", methods=["POST"])
 @require_auth
@@ -69,9 +81,6 @@ def status():
 @require_auth
 def search_transactions():
     """Search for transactions by reference code via Node.js backend."""
-    from flask import request, jsonify
-    from services.cybersource_helper_client import CyberSourceHelperError
-    
     print(f"[cybersource_search] ========== Search Transactions ==========")
     
     # Get reference code from query params or JSON body
@@ -89,7 +98,7 @@ def search_transactions():
     print(f"[cybersource_search] Limit: {limit}")
     
     # Get CyberSource helper client
-    cybersource_helper = current_app.config.get('cybersource_helper')
+    cybersource_helper = get_cybersource_helper()
     if not cybersource_helper:
         print(f"[cybersource_search] ❌ CyberSource helper not configured")
         return jsonify({
@@ -127,7 +136,6 @@ def search_transactions():
     
     except Exception as e:
         print(f"[cybersource_search] ❌ Unexpected error: {e}")
-        import traceback
         print(f"[cybersource_search] Traceback: {traceback.format_exc()}")
         
         return jsonify({
@@ -140,9 +148,6 @@ def search_transactions():
 @cybersource_bp.route("/webhook/log", methods=["POST"])
 def webhook_log():
     """Simple webhook endpoint that only logs received requests."""
-    from flask import request
-    import json
-    
     print("=" * 80)
     print("[WEBHOOK_LOG] ========== Webhook Request Received ==========")
     print("=" * 80)
@@ -1,7 +1,10 @@
 """Payment routes."""
+import logging
 from flask import Blueprint, current_app, request
 from controllers.payment_controller import PaymentController, require_auth
 
+logger = logging.getLogger(__name__)
+
 bp = Blueprint('payment', __name__, url_prefix='/api')
 
 
@@ -9,51 +12,62 @@ bp = Blueprint('payment', __name__, url_prefix='/api')
 @require_auth
 def initiate_payment():
     """Initiate M-Pesa payment."""
-    print(f"[mpesa_route] ========== /api/mpesa/initiate Request ==========")
-    print(f"[mpesa_route] Method: {request.method}")
-    print(f"[mpesa_route] Headers: {dict(request.headers)}")
-    print(f"[mpesa_route] Content-Type: {request.content_type}")
-    print(f"[mpesa_route] Content-Length: {request.content_length}")
+    logger.info("[mpesa_route] ========== /api/mpesa/initiate Request ==========")
+    logger.info("[mpesa_route] Method: %s", request.method)
+    logger.debug("[mpesa_route] Headers: %s", dict(request.headers))
+    logger.info("[mpesa_route] Content-Type: %s", request.content_type)
+    logger.info("[mpesa_route] Content-Length: %s", request.content_length)
     
     db = current_app.config.get('DB')
     mpesa_client = current_app.config.get('MPESA_CLIENT')
     config = current_app.config.get('CONFIG')
     
-    print(f"[mpesa_route] DB available: {db is not None}")
-    print(f"[mpesa_route] M-Pesa client available: {mpesa_client is not None}")
-    print(f"[mpesa_route] Config available: {config is not None}")
+    logger.info("[mpesa_route] DB available: %s", db is not None)
+    logger.info("[mpesa_route] M-Pesa client available: %s", mpesa_client is not None)
+    logger.info("[mpesa_route] Config available: %s", config is not None)
     
     controller = PaymentController(db, mpesa_client, config)
     result = controller.initiate_payment()
     
-    print(f"[mpesa_route] Response status: {result[1] if isinstance(result, tuple) else 'N/A'}")
-    print(f"[mpesa_route] ========== /api/mpesa/initiate Response ==========")
+    logger.info("[mpesa_route] Response status: %s", result[1] if isinstance(result, tuple) else 'N/A')
+    logger.info("[mpesa_route] ========== /api/mpesa/initiate Response ==========")
     return result
 
 
 @bp.route('/mpesa/callback', methods=['POST'])
 def mpesa_callback():
     """Handle M-Pesa callback."""
-    print(f"[mpesa_route] ========== /api/mpesa/callback Request ==========")
-    print(f"[mpesa_route] Method: {request.method}")
-    print(f"[mpesa_route] Headers: {dict(request.headers)}")
-    print(f"[mpesa_route] Content-Type: {request.content_type}")
-    print(f"[mpesa_route] Content-Length: {request.content_length}")
-    print(f"[mpesa_route] Remote Address: {request.remote_addr}")
-    print(f"[mpesa_route] User-Agent: {request.headers.get('User-Agent', 'N/A')}")
+    logger.info("[mpesa_route] ========== /api/mpesa/callback Request ==========")
+    logger.info("[mpesa_route] Method: %s", request.method)
+    logger.debug("[mpesa_route] Headers: %s", dict(request.headers))
+    logger.info("[mpesa_route] Content-Type: %s", request.content_type)
+    logger.info("[mpesa_route] Content-Length: %s", request.content_length)
+    logger.info("[mpesa_route] Remote Address: %s", request.remote_addr)
+    logger.info("[mpesa_route] User-Agent: %s", request.headers.get('User-Agent', 'N/A'))
     
     db = current_app.config.get('DB')
     mpesa_client = current_app.config.get('MPESA_CLIENT')
     config = current_app.config.get('CONFIG')
     
-    print(f"[mpesa_route] DB available: {db is not None}")
-    print(f"[mpesa_route] M-Pesa client available: {mpesa_client is not None}")
-    print(f"[mpesa_route] Config available: {config is not None}")
+    logger.info("[mpesa_route] DB available: %s", db is not None)
+    logger.info("[mpesa_route] M-Pesa client available: %s", mpesa_client is not None)
+    logger.info("[mpesa_route] Config available: %s", config is not None)
     
     controller = PaymentController(db, mpesa_client, config)
     result = controller.handle_callback()
     
-    print(f"[mpesa_route] Response status: {result[1] if isinstance(result, tuple) else 'N/A'}")
-    print(f"[mpesa_route] ========== /api/mpesa/callback Response ==========")
+    logger.info("[mpesa_route] Response status: %s", result[1] if isinstance(result, tuple) else 'N/A')
+    logger.info("[mpesa_route] ========== /api/mpesa/callback Response ==========")
     return result
 
+
+@bp.route('/mpesa/reconcile', methods=['POST'])
+@require_auth
+def reconcile_payments():
+    """Resolve the caller's pending M-Pesa payments (missed callbacks)."""
+    controller = PaymentController(
+        current_app.config.get('DB'),
+        current_app.config.get('MPESA_CLIENT'),
+        current_app.config.get('CONFIG'),
+    )
+    return controller.reconcile_pending_payments()
@@ -5,6 +5,7 @@ import base64
 import hmac
 import hashlib
 import datetime
+import traceback
 from typing import Dict, Optional, Any
 from config import Config
 
@@ -216,7 +217,6 @@ class CyberSourceClient:
             return {"ok": False, "error": str(e), "status_code": 500}
         except Exception as e:
             print(f"[CyberSourceClient] [FlexSessions] ❌ Unexpected error: {e}")
-            import traceback
 
             print(traceback.format_exc())
             return {"ok": False, "error": str(e), "status_code": 500}
@@ -357,7 +357,6 @@ class CyberSourceClient:
             return {'ok': False, 'error': str(e), 'status_code': 500}
         except Exception as e:
             print(f"[CyberSourceClient] [CaptureContext] ❌ Unexpected error: {e}")
-            import traceback
             print(traceback.format_exc())
             return {'ok': False, 'error': str(e), 'status_code': 500}
     
@@ -425,7 +424,6 @@ class CyberSourceClient:
             return {'ok': False, 'error': str(e), 'status_code': 500}
         except Exception as e:
             print(f"[CyberSourceClient] [Payment] ❌ Unexpected error: {e}")
-            import traceback
             print(traceback.format_exc())
             return {'ok': False, 'error': str(e), 'status_code': 500}
 
@@ -552,7 +550,6 @@ class CyberSourceClient:
             return {"ok": False, "error": str(e), "status_code": 500}
         except Exception as e:
             print(f"[CyberSourceClient] [Payment][GooglePay] ❌ Unexpected error: {e}")
-            import traceback
 
             print(traceback.format_exc())
             return {"ok": False, "error": str(e), "status_code": 500}
@@ -780,7 +777,6 @@ class CyberSourceClient:
                     print(f"[CyberSourceClient] [Payment]   - Response body: {e.response.text[:500]}")
                 except Exception:
                     pass
-            import traceback
             print(f"[CyberSourceClient] [Payment] Traceback: {traceback.format_exc()}")
             return {
                 'ok': False,
@@ -790,7 +786,6 @@ class CyberSourceClient:
         except Exception as e:
             print(f"[CyberSourceClient] [Payment] ❌ Unexpected error: {e}")
             print(f"[CyberSourceClient] [Payment]   - Exception type: {type(e).__name__}")
-            import traceback
             print(f"[CyberSourceClient] [Payment] Full traceback: {traceback.format_exc()}")
             return {
                 'ok': False,
@@ -901,7 +896,6 @@ class CyberSourceClient:
             print(f"[CyberSourceClient] [PaymentStatus] ❌ Request exception occurred")
             print(f"[CyberSourceClient] [PaymentStatus]   - Exception type: {type(e).__name__}")
             print(f"[CyberSourceClient] [PaymentStatus]   - Error message: {str(e)}")
-            import traceback
             print(f"[CyberSourceClient] [PaymentStatus] Traceback: {traceback.format_exc()}")
             return {
                 'ok': False,
@@ -910,7 +904,6 @@ class CyberSourceClient:
             }
         except Exception as e:
             print(f"[CyberSourceClient] [PaymentStatus] ❌ Unexpected error: {e}")
-            import traceback
             print(f"[CyberSourceClient] [PaymentStatus] Full traceback: {traceback.format_exc()}")
             return {
                 'ok': False,
@@ -1035,7 +1028,6 @@ class CyberSourceClient:
             
         except requests.exceptions.RequestException as e:
             print(f"[CyberSourceClient] [TransactionSearch] ❌ Request error: {e}")
-            import traceback
             print(f"[CyberSourceClient] [TransactionSearch] Traceback: {traceback.format_exc()}")
             return {
                 'ok': False,
@@ -1044,7 +1036,6 @@ class CyberSourceClient:
             }
         except Exception as e:
             print(f"[CyberSourceClient] [TransactionSearch] ❌ Unexpected error: {e}")
-            import traceback
             print(f"[CyberSourceClient] [TransactionSearch] Full traceback: {traceback.format_exc()}")
             return {
                 'ok': False,
@@ -1120,7 +1111,6 @@ class CyberSourceClient:
             
         except Exception as e:
             print(f"[CyberSourceClient] [Webhook] ❌ Validation error: {e}")
-            import traceback
             print(f"[CyberSourceClient] [Webhook] Traceback: {traceback.format_exc()}")
             return False
 
@@ -5,6 +5,7 @@ Sends notifications for debts due in X days (3 days, 1 day before due date)
 import logging
 import threading
 import time
+import traceback
 from datetime import datetime, timedelta
 from firebase_admin import db
 
@@ -180,7 +181,6 @@ class DebtReminderScheduler:
             
         except Exception as e:
             logger.error(f"❌ Error checking upcoming debts: {e}")
-            import traceback
             logger.error(traceback.format_exc())
     
     def _send_debt_reminder_notification(self, fcm_token, user_id, debts, days_until_due):
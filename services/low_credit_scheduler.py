@@ -5,6 +5,7 @@ Sends daily notifications at 8 AM to users with credits <= 2
 import logging
 import threading
 import time
+import traceback
 from datetime import datetime
 from firebase_admin import db
 
@@ -118,7 +119,6 @@ class LowCreditScheduler:
             
         except Exception as e:
             logger.error(f"❌ Error checking low credits: {e}")
-            import traceback
             logger.error(traceback.format_exc())
     
     def _send_low_credit_notification(self, fcm_token, user_id, credit_balance):
@@ -1,6 +1,7 @@
 import base64
 import datetime
 import requests
+import traceback
 from typing import Optional, Dict, Any
 
 
@@ -37,15 +38,20 @@ class MpesaClient:
         self.passkey = passkey
         self.callback_url = callback_url
         self.env = env  # Store environment for later use
+        self.is_sandbox = env == "sandbox"  # Sandbox uses strings, production uses integers
         self.base = (
-            "https://sandbox.safaricom.co.ke" if env == "sandbox" else "https://api.safaricom.co.ke"
+            "https://sandbox.safaricom.co.ke" if self.is_sandbox else "https://api.safaricom.co.ke"
         )
+        # Endpoint URLs are fixed per client; build them once
+        self.token_url = f"{self.base}/oauth/v1/generate?grant_type=client_credentials"
+        self.stk_push_url = f"{self.base}/mpesa/stkpush/v1/processrequest"
+        self.stk_query_url = f"{self.base}/mpesa/stkpushquery/v1/query"
         print(f"[MpesaClient] Initialization complete")
 
     def _access_token(self) -> Optional[str]:
         print(f"[MpesaClient] [Token] ========== OAuth Token Request ==========")
         print(f"[MpesaClient] [Token] Base URL: {self.base}")
-        print(f"[MpesaClient] [Token] Full URL: {self.base}/oauth/v1/generate?grant_type=client_credentials")
+        print(f"[MpesaClient] [Token] Full URL: {self.token_url}")
         print(f"[MpesaClient] [Token] Consumer Key: {self.consumer_key[:10]}..." if self.consumer_key else "[MpesaClient] [Token] Consumer Key: NOT SET")
         print(f"[MpesaClient] [Token] Consumer Key length: {len(self.consumer_key) if self.consumer_key else 0}")
         print(f"[MpesaClient] [Token] Consumer Secret: {'*' * min(20, len(self.consumer_secret)) if self.consumer_secret else 'NOT SET'}")
@@ -59,7 +65,7 @@ class MpesaClient:
             print(f"[MpesaClient] [Token] 📤 Sending GET request to Safaricom OAuth endpoint...")
             
             resp = requests.get(
-                f"{self.base}/oauth/v1/generate?grant_type=client_credentials",
+                self.token_url,
                 auth=(self.consumer_key, self.consumer_secret),
                 timeout=20,
             )
@@ -110,7 +116,6 @@ class MpesaClient:
             return None
         except Exception as e:
             print(f"[MpesaClient] [Token] ❌ Exception during token generation: {type(e).__name__}: {str(e)}")
-            import traceback
             print(f"[MpesaClient] [Token] Traceback: {traceback.format_exc()}")
             return None
         finally:
@@ -160,7 +165,7 @@ class MpesaClient:
         print(f"[MpesaClient] [STK Push]   Environment: {self.env}")
         
         # Sandbox uses strings, production uses integers
-        if self.env == "sandbox":
+        if self.is_sandbox:
             # Sandbox: Keep as string
             phone_value = phone_clean
             print(f"[MpesaClient] [STK Push] ✅ Phone (string for sandbox): {phone_value}")
@@ -179,7 +184,7 @@ class MpesaClient:
         
         print(f"[MpesaClient] [STK Push] Step 5: Constructing payload...")
         # Sandbox uses strings, production uses integers
-        if self.env == "sandbox":
+        if self.is_sandbox:
             # Sandbox: Use strings for numeric fields
             short_code_value = str(self.short_code)
             till_number_value = str(self.till_number)
@@ -223,7 +228,7 @@ class MpesaClient:
             print(f"[MpesaClient] [STK Push]   TransactionDesc: {payload['TransactionDesc']}")
         
         print(f"[MpesaClient] [STK Push] Step 6: Sending STK Push request...")
-        request_url = f"{self.base}/mpesa/stkpush/v1/processrequest"
+        request_url = self.stk_push_url
         print(f"[MpesaClient] [STK Push]   Base URL: {self.base}")
         print(f"[MpesaClient] [STK Push]   Full URL: {request_url}")
         print(f"[MpesaClient] [STK Push]   Method: POST")
@@ -313,9 +318,43 @@ class MpesaClient:
             return {"ok": False, "error": f"connection_error: {str(e)}"}
         except Exception as e:
             print(f"[MpesaClient] [STK Push] ❌ Exception during STK Push request: {type(e).__name__}: {str(e)}")
-            import traceback
             print(f"[MpesaClient] [STK Push] Traceback: {traceback.format_exc()}")
             print(f"[MpesaClient] [STK Push] ========== STK Push Request Failed ==========")
             return {"ok": False, "error": str(e)}
 
+    def query_stk_status(self, checkout_request_id: str) -> Dict[str, Any]:
+        """Query Daraja for the final result of an STK push.
 
+        Returns {"ok", "response", "status_code"}; a response without a
+        ResultCode means the push is still being processed.
+        """
+        print(f"[MpesaClient] [STK Query] Querying CheckoutRequestID: {checkout_request_id}")
+        token = self._access_token()
+        if not token:
+            print(f"[MpesaClient] [STK Query] ❌ Failed to get access token, aborting")
+            return {"ok": False, "error": "token_failed"}
+
+        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        short_code_value = str(self.short_code) if self.is_sandbox else int(self.short_code)
+        payload = {
+            "BusinessShortCode": short_code_value,
+            "Password": self._password(timestamp),
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id,
+        }
+        try:
+            resp = requests.post(
+                self.stk_query_url,
+                json=payload,
+                headers={"Authorization": f"Bearer {token}"},
+                timeout=30,
+            )
+            try:
+                body = resp.json()
+            except ValueError:
+                body = {"text": resp.text}
+            print(f"[MpesaClient] [STK Query] HTTP {resp.status_code}: {body}")
+            return {"ok": resp.ok, "response": body, "status_code": resp.status_code}
+        except requests.exceptions.RequestException as e:
+            print(f"[MpesaClient] [STK Query] ❌ Request failed: {type(e).__name__}: {str(e)}")
+            return {"ok": False, "error": str(e)}
@@ -1,6 +1,7 @@
 import logging
 import threading
 import time
+import traceback
 from datetime import datetime, timedelta
 from firebase_admin import db
 
@@ -474,7 +475,6 @@ class SimpleDebtScheduler:
         except Exception as e:
             print(f"❌ Error sending manual notification to user {user_id}: {e}")
             print(f"🔍 Error type: {type(e).__name__}")
-            import traceback
             traceback.print_exc()
             logger.error(f"Error sending manual notification to user {user_id}: {e}")
             return False
@@ -404,30 +404,30 @@ class SMSReminderService:
                 return []
             
             # Convert to list format expected by _find_due_reminders
-            debts_list = []
-            for phone_number, phone_data in user_debts.items():
-                if isinstance(phone_data, dict) and 'debts' in phone_data:
-                    for debt_id, debt_data in phone_data.get('debts', {}).items():
-                        debts_list.append({
-                            'user_id': user_id,
-                            'phoneNumber': phone_number,
-                            'accountName': phone_data.get('accountName', 'Unknown'),
-                            'debt_id': debt_id,
-                            'debtAmount': debt_data.get('debtAmount', '0'),
-                            'balance': debt_data.get('balance', '0'),
-                            'description': debt_data.get('description', ''),
-                            'date': debt_data.get('date', ''),
-                            'dueDate': debt_data.get('dueDate', 0),
-                            'isComplete': debt_data.get('isComplete', False)
-                        })
+            debts_list = [
+                {
+                    'user_id': user_id,
+                    'phoneNumber': phone_number,
+                    'accountName': phone_data.get('accountName', 'Unknown'),
+                    'debt_id': debt_id,
+                    'debtAmount': debt_data.get('debtAmount', '0'),
+                    'balance': debt_data.get('balance', '0'),
+                    'description': debt_data.get('description', ''),
+                    'date': debt_data.get('date', ''),
+                    'dueDate': debt_data.get('dueDate', 0),
+                    'isComplete': debt_data.get('isComplete', False)
+                }
+                for phone_number, phone_data in user_debts.items()
+                if isinstance(phone_data, dict) and 'debts' in phone_data
+                for debt_id, debt_data in phone_data.get('debts', {}).items()
+            ]
             
             # Find due reminders
             reminders = self._find_due_reminders(debts_list, window_days=5)
             
             # Convert to dictionary format for API response
-            reminder_dicts = []
-            for reminder in reminders:
-                reminder_dicts.append({
+            return [
+                {
                     'user_id': reminder.user_id,
                     'debtor_name': reminder.debtor_name,
                     'debtor_phone': reminder.debtor_phone,
@@ -436,9 +436,9 @@ class SMSReminderService:
                     'debt_count': reminder.debt_count,
                     'debt_ids': reminder.debt_ids,
                     'message': reminder.message
-                })
-            
-            return reminder_dicts
+                }
+                for reminder in reminders
+            ]
             
         except Exception as e:
             logger.error(f"Error checking due reminders for user {user_id}: {e}")
@@ -493,12 +493,15 @@ class SMSReminderService:
                 logger.warning(f"No FCM token found for user {user_id}")
                 return False
             
+            # Fetch the user's debts once rather than once per debt id
+            user_debts = self.db.reference(f'UserDebts/{user_id}').get()
+            
             # Send individual notification for each debt
             notifications_sent = 0
             for reminder in due_reminders:
                 for i, debt_id in enumerate(reminder.debt_ids):
                     # Get individual debt details
-                    debt_details = self._get_debt_details(user_id, debt_id)
+                    debt_details = self._get_debt_details(user_id, debt_id, user_debts)
                     if debt_details:
                         # Calculate days until due date
                         due_date_ms = debt_details.get('dueDate', 0)
@@ -551,11 +554,11 @@ class SMSReminderService:
             logger.error(f"Error sending FCM notifications to user {user_id}: {str(e)}")
             return False
     
-    def _get_debt_details(self, user_id: str, debt_id: str) -> Optional[Dict]:
-        """Get specific debt details by ID"""
+    def _get_debt_details(self, user_id: str, debt_id: str, user_debts: Optional[Dict] = None) -> Optional[Dict]:
+        """Get specific debt details by ID, optionally from an already-fetched UserDebts tree"""
         try:
-            debts_ref = self.db.reference(f'UserDebts/{user_id}')
-            user_debts = debts_ref.get()
+            if user_debts is None:
+                user_debts = self.db.reference(f'UserDebts/{user_id}').get()
             
             if not user_debts:
                 return None
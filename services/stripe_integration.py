@@ -1,4 +1,5 @@
 """Stripe Payment Gateway Integration."""
+import traceback
 import stripe
 from typing import Dict, Optional, Any
 from config import Config
@@ -126,7 +127,6 @@ class StripeClient:
             }
         except Exception as e:
             print(f"[StripeClient] [PaymentIntent] ❌ Error: {e}")
-            import traceback
             traceback.print_exc()
             return {
                 'ok': False,
@@ -240,7 +240,6 @@ class StripeClient:
             
         except Exception as e:
             print(f"[StripeClient] [GooglePay] ❌ Error: {e}")
-            import traceback
             traceback.print_exc()
             return {
                 'ok': False,
@@ -308,7 +307,6 @@ class StripeClient:
             
         except Exception as e:
             print(f"[StripeClient] [Card] ❌ Error: {e}")
-            import traceback
             traceback.print_exc()
             return {
                 'ok': False,